@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the compression pipeline on the meshes of the repository.
+
+python benchmark.py                    run and compare with the baseline
+python benchmark.py --update-baseline  run and store the results as baseline
+python benchmark.py --fused            same with the fused conquest
+python benchmark.py -f binary -b 12    binary format, quantized coordinates
+python benchmark.py --out-of-core      out of core, in the temporary directory of each run
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from geometry import MAX_BITS
+from out_of_core import MEMORY
+
+MESHES = ['icosphere', 'sphere', 'cow', 'bunny', 'test_cube']
+OBJ_DIRECTORY = './OBJ'
+NB_ITERATIONS = 6
+SEED = 0
+REPEATS = 3
+RESULTS_PATH = './benchmark_results.json'
+BASELINE_PATH = './benchmark_baseline.json'
+
+# Regressions: ratio between the new value and the baseline, and smallest
+# difference counted (the times of the small meshes are noise below it)
+THRESHOLDS = {'total_time': 1.5, 'peak_rss_mb': 1.25, 'output_bytes': 1.02}
+MIN_DELTAS = {'total_time': 0.05, 'peak_rss_mb': 0.0, 'output_bytes': 0}
+
+
+def run_pipeline(name, options):
+    # Encode one mesh with lossless_transmission.encode in a new process
+    # (peak RSS of the process) and decode it, time of each phase of the
+    # encoder in seconds (their sum is the total time) and of the decoding,
+    # and whether the decoded mesh is the obj mesh
+    from lossless_transmission import encode, EXTENSIONS
+    from decoder import decode
+    from verifier import verify_mesh
+    from instrumentation import Instrumentation
+    from stopping import StopCriteria
+
+    obj_path = os.path.join(OBJ_DIRECTORY, name + '.obj')
+    instrumentation = Instrumentation()
+    stopping = StopCriteria(options['target_vertices'], options['max_bytes'],
+                            options['min_ratio'])
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, name)
+        nb_vertices, nb_final, _ = encode(
+            obj_path, output, NB_ITERATIONS, options['format'], options['bits'],
+            options['fused'], options['processes'], instrumentation,
+            work_directory=directory if options['out_of_core'] else None,
+            memory=options['memory'] << 20, stopping=stopping, seed=SEED)
+        # Only the encoded file, not the mesh of each iteration
+        path = output + EXTENSIONS[options['format']]
+        start = time.perf_counter()
+        mesh = decode(path)
+        decode_time = time.perf_counter() - start
+        lossless = verify_mesh(obj_path, mesh, options['bits'])['same']
+        output_bytes = os.path.getsize(path)
+
+    phases = instrumentation.timers
+    conquests = sum(phases.get(phase, 0.0) for phase in
+                    ('decimating_conquest', 'cleaning_conquest', 'sew_conquest', 'fused_conquest'))
+    return {
+        'phases': phases,
+        'total_time': sum(phases.values()),
+        'decode_time': decode_time,
+        'lossless': lossless,
+        'vertices': nb_vertices,
+        'final_vertices': nb_final,
+        'vertices_removed_per_second': (nb_vertices - nb_final) / conquests if conquests > 0 else 0.0,
+        'output_bytes': output_bytes,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'counters': instrumentation.counters,
+    }
+
+
+def benchmark(meshes, options):
+    # Run of the median total time over the repeats (all its values), each
+    # run in a fresh process (not a daemon, the parallel conquest starts its
+    # own workers)
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for name in meshes:
+        runs = []
+        for _ in range(REPEATS):
+            with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+                runs.append(executor.submit(run_pipeline, name, options).result())
+        median = sorted(runs, key=lambda run: run['total_time'])[len(runs) // 2]
+        results[name] = median
+        print('{:<12}{:>10.3f} s{:>10.3f} s decode{:>12.0f} v/s{:>12} B{:>10.1f} MB{:>10}'.format(
+            name, median['total_time'], median['decode_time'],
+            median['vertices_removed_per_second'], median['output_bytes'],
+            median['peak_rss_mb'], 'lossless' if median['lossless'] else 'LOSSY'))
+    return {
+        'seed': SEED,
+        'iterations': NB_ITERATIONS,
+        'repeats': REPEATS,
+        'options': options,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'meshes': results,
+    }
+
+
+def compare(results, baseline):
+    # Return the regressions (mesh, metric, baseline, new value)
+    regressions = []
+    for name, result in results['meshes'].items():
+        reference = baseline['meshes'].get(name)
+        if reference is None:
+            continue
+        for metric, threshold in THRESHOLDS.items():
+            if (reference[metric] > 0 and result[metric] > threshold * reference[metric]
+                    and result[metric] - reference[metric] > MIN_DELTAS[metric]):
+                regressions.append((name, metric, reference[metric], result[metric]))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the compression pipeline')
+    parser.add_argument('meshes', nargs='*', default=MESHES)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--fused', action='store_true')
+    parser.add_argument('-f', '--format', choices=['obja', 'binary'], default='obja')
+    parser.add_argument('-b', '--bits', type=int, default=None,
+                        choices=range(1, MAX_BITS + 1), metavar='BITS')
+    parser.add_argument('-p', '--processes', type=int, default=1)
+    parser.add_argument('--out-of-core', action='store_true',
+                        help='encode out of core in the temporary directory of the run')
+    parser.add_argument('--memory', type=int, default=MEMORY >> 20)
+    parser.add_argument('--target-vertices', type=int, default=None)
+    parser.add_argument('--max-bytes', type=int, default=None)
+    parser.add_argument('--min-ratio', type=float, default=0.0)
+    args = parser.parse_args()
+    if args.bits is not None and args.format != 'binary':
+        parser.error('--bits needs --format binary')
+    options = {'fused': args.fused, 'format': args.format, 'bits': args.bits,
+               'processes': args.processes, 'out_of_core': args.out_of_core,
+               'memory': args.memory, 'target_vertices': args.target_vertices,
+               'max_bytes': args.max_bytes, 'min_ratio': args.min_ratio}
+
+    results = benchmark(args.meshes, options)
+    with open(RESULTS_PATH, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    # A run that does not decode to its obj mesh fails, whatever its times
+    lossy = [name for name, result in results['meshes'].items() if not result['lossless']]
+    if lossy:
+        print('Not lossless: {}'.format(', '.join(lossy)))
+        sys.exit(1)
+
+    if args.update_baseline:
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(results, f, indent=2)
+    elif os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+        if baseline.get('options') != options:
+            print('Baseline of other options, not compared')
+            sys.exit(0)
+        regressions = compare(results, baseline)
+        for name, metric, reference, value in regressions:
+            print('Regression {} {}: {:.3f} -> {:.3f}'.format(name, metric, reference, value))
+        if regressions:
+            sys.exit(1)
+        print('No regression')
@@ -0,0 +1,232 @@
+import struct
+
+import numpy as np
+
+from obja_writer import (VERTEX, FACE, DELETED_FACE, BASE, DECIMATING, CLEANING, LAYER_NAMES,
+                         RecordNumbers)
+from mapped_arrays import blocks
+from range_coder import AdaptiveModel, RangeEncoder
+from geometry import BOX, bounding_box, quantize, predict
+
+# Binary progressive file:
+#   header         magic, version, quantization bits (0 for float64
+#                  coordinates), number of base vertices, base faces, base
+#                  twins, layers
+#   box            bounding box of the quantization grid (quantized only)
+#   base mesh      vertices (uint16 or float64), int32 faces (obja numbering),
+#                  int32 twins of the half-edges of the non-manifold edges
+#                  (3 * face + corner)
+#   layers         in decoding order, each one with a small header
+#                  (kind, inserted vertices, connectivity size, geometry size)
+#                  followed by its connectivity and geometry
+# The decimating layers store the first gate (left, right and third vertex of
+# its face) and the range coded codes of the conquest (null patch, valence
+# of the removed vertex, or stop at the border of the region of a parallel
+# conquest), the decoder replays the conquest on the coarse mesh to find the
+# patches and their signs.
+# The cleaning layers store the face to split (delta of the face numbers) and
+# the vertex of the face where the chain starts, the sewing layers the edge
+# to split and the third vertex of its face, undone in reverse order.
+# Quantized geometry is predicted by the barycenter of the chain of the
+# inserted vertex, only the range coded residuals are stored. The chain of a
+# sewed vertex can hold vertices sewed after it in the same layer, the
+# decoder predicts these ones after them.
+MAGIC = b'OBJB'
+VERSION = 4
+HEADER = struct.Struct('<4sBBIIII')
+LAYER_HEADER = struct.Struct('<BIII')
+GATE = struct.Struct('<iii')
+
+NB_CODES = 6
+NB_LENGTHS = 34
+
+
+def write_binary(obja, vertices, path, bits=None, storage=None):
+    # Write the layers of the obja writer in the binary format, with the
+    # coordinates quantized on bits per axis (float64 when bits is None),
+    # return the report of the layers (in decoding order). The records are
+    # read by blocks (of storage, whole layers without it) and the arrays
+    # over all the vertices or faces are mapped arrays of storage
+    zeros = np.zeros if storage is None else storage.zeros
+    block_size = None if storage is None else storage.block_size
+    quantized = None
+    if bits is not None:
+        boxes = [bounding_box(vertices[start:stop])
+                 for start, stop in blocks(len(vertices), storage)] or [bounding_box(vertices)]
+        low = np.min([box[0] for box in boxes], axis=0)
+        high = np.max([box[1] for box in boxes], axis=0)
+        quantized = zeros((len(vertices), 3), np.int64)
+        for start, stop in blocks(len(vertices), storage):
+            quantized[start:stop] = quantize(vertices[start:stop], low, high, bits)
+
+    numbers = RecordNumbers(obja, len(vertices), block_size, storage)
+    obja_vertex = numbers.obja_vertex
+    face_vertices = zeros((obja.counts()[FACE], 3), np.int64)
+    nb_faces = 0
+    for index, records in obja.blocks(block_size, storage):
+        faces = records[records['kind'] == FACE]
+        face_vertices[nb_faces:nb_faces + len(faces)] = \
+            obja_vertex[np.stack([faces['a'], faces['b'], faces['c']], axis=1)]
+        nb_faces += len(faces)
+
+    # Layers in decoding order
+    base = None
+    layers = []
+    for index in reversed(range(len(obja.layer_kinds))):
+        if obja.layer_kinds[index] == BASE:
+            base = index
+        elif obja.layer_size(index) > 0:
+            layers.append(index)
+
+    report = []
+    with open(path, 'wb') as file:
+        # Base mesh
+        counts = obja.layer_counts[base] if base is not None else np.zeros(3, dtype=np.int64)
+        twins = obja.base_twins
+        file.write(HEADER.pack(MAGIC, VERSION, bits or 0, int(counts[VERTEX]), int(counts[FACE]),
+                               len(twins), len(layers)))
+        if quantized is not None:
+            file.write(BOX.pack(*low, *high))
+        base_blocks = [] if base is None else obja.layer_blocks(base, block_size)
+        for records in base_blocks:
+            base_vertices = records['a'][records['kind'] == VERTEX]
+            if quantized is None:
+                file.write(vertices[base_vertices - 1].astype('<f8').tobytes())
+            else:
+                file.write(quantized[base_vertices - 1].astype('<u2').tobytes())
+            release(storage)
+        base_blocks = [] if base is None else obja.layer_blocks(base, block_size)
+        for records in base_blocks:
+            faces = records[records['kind'] == FACE]
+            base_faces = obja_vertex[np.stack([faces['a'], faces['b'], faces['c']], axis=1)]
+            file.write(base_faces.astype('<i4').tobytes())
+            release(storage)
+        file.write(twins.astype('<i4').tobytes())
+        report.append(('base', int(counts[VERTEX]), 12 * int(counts[FACE]) + 8 * len(twins),
+                       (8 * 3 if quantized is None else 2 * 3) * int(counts[VERTEX])))
+
+        # Layers, only the range coded bytes of a layer are kept at once
+        for index in layers:
+            kind = obja.layer_kinds[index]
+            nb_inserted = int(obja.layer_counts[index][VERTEX])
+            if kind == DECIMATING:
+                left, right, front = obja.first_gates[index]
+                codes = (code for block in obja.code_blocks(index, block_size)
+                         for code in block.tolist())
+                connectivity = (GATE.pack(obja_vertex[left], obja_vertex[right], obja_vertex[front])
+                                + encode_codes(codes))
+            elif kind == CLEANING:
+                connectivity = encode_cleaning(obja.layer_blocks(index, block_size), numbers,
+                                               face_vertices)
+            else:
+                connectivity = encode_sewing(sewing_blocks(obja, index, block_size, obja_vertex))
+            if quantized is None:
+                geometry = None
+                nb_geometry = 8 * 3 * nb_inserted
+            else:
+                geometry = encode_residuals(residual_blocks(obja, index, block_size, quantized))
+                nb_geometry = len(geometry)
+            file.write(LAYER_HEADER.pack(kind, nb_inserted, len(connectivity), nb_geometry))
+            file.write(connectivity)
+            if geometry is None:
+                for records in obja.layer_blocks(index, block_size):
+                    inserted = records['a'][records['kind'] == VERTEX]
+                    file.write(vertices[inserted - 1].astype('<f8').tobytes())
+                    release(storage)
+            else:
+                file.write(geometry)
+            report.append((LAYER_NAMES[kind], nb_inserted, len(connectivity), nb_geometry))
+    return report
+
+
+def release(storage):
+    if storage is not None:
+        storage.release()
+
+
+def sewing_blocks(obja, index, block_size, obja_vertex):
+    # Sewed edges of a layer (last two vertices of every other added face)
+    # and the third vertex of their face in the coarse mesh (the codes), by
+    # blocks of records
+    nb_faces = 0
+    nb_sewed = 0
+    for records in obja.layer_blocks(index, block_size):
+        faces = records[records['kind'] == FACE]
+        edges = faces[nb_faces % 2::2]
+        nb_faces += len(faces)
+        sewed = obja_vertex[np.stack([edges['b'], edges['c']], axis=1)]
+        thirds = obja_vertex[obja.layer_codes(index, nb_sewed, nb_sewed + len(edges))]
+        nb_sewed += len(edges)
+        yield sewed, thirds
+
+
+def residual_blocks(obja, index, block_size, quantized):
+    # Residuals of the prediction of the inserted vertices of a layer, by
+    # blocks of records (the faces around a vertex are in its block)
+    for records in obja.layer_blocks(index, block_size):
+        inserted = records['a'][records['kind'] == VERTEX]
+        faces = records[records['kind'] == FACE]
+        faces = np.stack([faces['a'], faces['b'], faces['c']], axis=1)
+        yield quantized[inserted - 1] - predict(inserted, faces, quantized)
+
+
+def encode_codes(codes):
+    encoder = RangeEncoder()
+    model = AdaptiveModel(NB_CODES)
+    for code in codes:
+        encoder.encode_symbol(model, code)
+    return encoder.finish()
+
+
+def encode_cleaning(blocks, numbers, face_vertices):
+    # One deleted face per removed vertex: its number (delta with the previous
+    # one) and the position of the first vertex of the chain in the face,
+    # from the blocks of records of the layer
+    encoder = RangeEncoder()
+    deltas = AdaptiveModel(NB_LENGTHS)
+    rotations = AdaptiveModel(3)
+    previous = 0
+    for records in blocks:
+        removed = records[records['kind'] == DELETED_FACE]
+        deleted = numbers.deleted(removed)
+        chains = numbers.obja_vertex[removed['a']]
+        rotation = np.argmax(face_vertices[deleted - 1] == chains[:, None], axis=1)
+        for number, shift in zip(deleted.tolist(), rotation.tolist()):
+            encoder.encode_int(deltas, number - previous)
+            encoder.encode_symbol(rotations, shift)
+            previous = number
+    return encoder.finish()
+
+
+def encode_residuals(blocks):
+    encoder = RangeEncoder()
+    models = [AdaptiveModel(NB_LENGTHS) for _ in range(3)]
+    for residuals in blocks:
+        for residual in residuals.tolist():
+            for model, value in zip(models, residual):
+                encoder.encode_int(model, value)
+    return encoder.finish()
+
+
+def encode_sewing(blocks):
+    # Each sewed edge, with the third vertex of its face in the coarse mesh
+    # (an edge can be sewed several times), given by blocks of (edges, third
+    # vertices)
+    encoder = RangeEncoder()
+    model = AdaptiveModel(NB_LENGTHS)
+    for sewed, thirds in blocks:
+        for (first, second), third in zip(sewed.tolist(), thirds.tolist()):
+            encoder.encode_uint(model, first)
+            encoder.encode_uint(model, second)
+            encoder.encode_uint(model, third)
+    return encoder.finish()
+
+
+def print_report(report):
+    # Bytes and bits per vertex of the connectivity and of the geometry
+    print('{:<12}{:>10}{:>14}{:>10}{:>12}{:>10}'.format(
+        'layer', 'vertices', 'connectivity', 'bpv', 'geometry', 'bpv'))
+    for name, nb_vertices, connectivity, geometry in report:
+        count = max(nb_vertices, 1)
+        print('{:<12}{:>10}{:>14}{:>10.2f}{:>12}{:>10.2f}'.format(
+            name, nb_vertices, connectivity, 8 * connectivity / count, geometry, 8 * geometry / count))
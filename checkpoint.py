@@ -0,0 +1,115 @@
+import glob
+import os
+import random
+import re
+import zipfile
+
+import numpy as np
+
+from mesh import Mesh, CONNECTIVITY
+from obja_writer import ObjaWriter, RECORD
+
+# Changes with the content of the checkpoints
+VERSION = 3
+# Checkpoints kept on disk, the previous one in case the last is damaged
+NB_KEPT = 2
+
+
+def checkpoint_path(base, iteration):
+    return '{}.checkpoint_{}.npz'.format(base, iteration)
+
+
+def source_key(obj_path):
+    # The checkpoints of a mesh are only valid for the same obj file
+    stat = os.stat(obj_path)
+    return np.array([VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def save_checkpoint(base, obj_path, settings, iteration, nb_active, mesh, active_vertices,
+                    vertices, faces, obja):
+    # State of the encoder after the iteration: mesh, active vertices, layers
+    # written so far and state of the random gates, for the settings (a
+    # string of the options of the encoder the layers depend on). The file
+    # is written under another name then renamed, an interrupted save leaves
+    # the previous checkpoints as they were
+    state = {name: getattr(mesh, name) for name in CONNECTIVITY}
+    state['free_half_edge'] = np.array(mesh.free_half_edge)
+    state['free_face'] = np.array(mesh.free_face)
+    state['source'] = source_key(obj_path)
+    state['settings'] = np.array(settings)
+    state['iteration'] = np.array(iteration)
+    state['nb_active'] = np.array(-1 if nb_active is None else nb_active)
+    state['active_vertices'] = np.array(sorted(active_vertices), dtype=np.int64)
+    state['vertices'] = vertices
+    state['faces'] = np.asarray(faces)
+
+    nb_layers = len(obja.layer_kinds)
+    state['layer_kinds'] = np.array(obja.layer_kinds, dtype=np.int8)
+    state['layer_sizes'] = np.array([len(obja.layer(k)) for k in range(nb_layers)], dtype=np.int64)
+    state['records'] = np.concatenate([obja.layer(k) for k in range(nb_layers)] +
+                                      [np.zeros(0, dtype=RECORD)])
+    codes = [obja.layer_codes(k) for k in range(nb_layers)]
+    state['code_sizes'] = np.array([len(layer_codes) for layer_codes in codes], dtype=np.int64)
+    state['codes'] = np.concatenate(codes + [np.zeros(0, dtype=np.int32)])
+    state['first_gates'] = np.array(obja.first_gates, dtype=np.int64).reshape(-1, 3)
+
+    version, internal, gauss = random.getstate()
+    state['random'] = np.array((version,) + internal, dtype=np.int64)
+
+    path = checkpoint_path(base, iteration)
+    with open(path + '.tmp', 'wb') as file:
+        np.savez(file, **state)
+    os.replace(path + '.tmp', path)
+    for old in checkpoints(base):
+        if old < iteration - NB_KEPT + 1:
+            os.remove(checkpoint_path(base, old))
+
+
+def checkpoints(base):
+    # Iterations of the checkpoints on disk
+    pattern = re.compile(re.escape(base) + r'\.checkpoint_(\d+)\.npz$')
+    matches = (pattern.match(path) for path in glob.glob(glob.escape(base) + '.checkpoint_*.npz'))
+    return sorted(int(match.group(1)) for match in matches if match)
+
+
+def load_checkpoint(base, obj_path, settings, max_iteration, spool_path=None):
+    # Deepest valid checkpoint of at most max_iteration, of the same obj file
+    # and settings (the checkpoints of other options are never resumed),
+    # None if there is none. Return the iteration, the number of active
+    # vertices before it, the mesh, the active vertices, the vertices, the
+    # faces and the obja writer (spooled to spool_path if given), and restore
+    # the state of the random gates
+    for iteration in reversed(checkpoints(base)):
+        if iteration > max_iteration:
+            continue
+        try:
+            with np.load(checkpoint_path(base, iteration)) as state:
+                if not (np.array_equal(state['source'], source_key(obj_path))
+                        and str(state['settings']) == settings):
+                    continue
+                state = dict(state)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            continue
+        return (iteration, None if state['nb_active'] < 0 else int(state['nb_active'])) \
+            + restore(state, spool_path)
+    return None
+
+
+def restore(state, spool_path=None):
+    mesh = Mesh.from_arrays(state, int(state['free_half_edge']), int(state['free_face']))
+
+    obja = ObjaWriter(spool_path)
+    records = np.split(state['records'], np.cumsum(state['layer_sizes'])[:-1])
+    codes = np.split(state['codes'], np.cumsum(state['code_sizes'])[:-1])
+    for kind, layer, layer_codes, first_gate in zip(
+            state['layer_kinds'].tolist(), records, codes, state['first_gates'].tolist()):
+        obja.new_layer(kind)
+        obja.add_records(layer)
+        obja.add_codes(layer_codes)
+        obja.set_first_gate(*first_gate)
+
+    internal = state['random'].tolist()
+    random.setstate((internal[0], tuple(internal[1:]), None))
+    # The encoder never depends on the order of the set
+    active_vertices = set(state['active_vertices'].tolist())
+    return mesh, active_vertices, state['vertices'], state['faces'], obja
@@ -0,0 +1,88 @@
+import numpy as np
+
+# First size of the buffer of the queued gates, doubled when it is full
+QUEUE_SIZE = 1 << 12
+
+
+class ConquestQueue:
+    # FIFO of gates (half-edges) for the conquests.
+    # Each entry keeps the time it was pushed, a gate invalidated after
+    # that time is skipped when popped (tombstone). With unique=True a
+    # gate is only returned the first time it is popped. The arrays of the
+    # half-edges are created by zeros (see Mesh.zeros).
+
+    def __init__(self, nb_half_edges, unique=False, zeros=np.zeros):
+        self.gates = np.zeros(QUEUE_SIZE, dtype=np.int32)
+        self.stamps = np.zeros(QUEUE_SIZE, dtype=np.int64)
+        self.head = 0
+        self.tail = 0
+        self.time = 1
+        self.zeros = zeros
+        self.invalidated = zeros(max(nb_half_edges, 16), np.int64)
+        self.done = zeros(max(nb_half_edges, 16), bool) if unique else None
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def push(self, gate):
+        if gate >= len(self.invalidated):
+            self.grow_half_edges(gate + 1)
+        if self.tail == len(self.gates):
+            self.grow()
+        self.gates[self.tail] = gate
+        self.stamps[self.tail] = self.time
+        self.tail += 1
+        self.time += 1
+
+    def pop(self):
+        # Return the next valid gate, -1 when the queue is empty
+        while self.head < self.tail:
+            gate = self.gates[self.head]
+            stamp = self.stamps[self.head]
+            self.head += 1
+            if stamp <= self.invalidated[gate]:
+                continue
+            if self.done is not None:
+                if self.done[gate]:
+                    continue
+                self.done[gate] = True
+            return gate
+        return -1
+
+    def clear(self):
+        # Empty the queue for another conquest, keeping its arrays: the gates
+        # invalidated so far are older than the ones pushed next
+        self.head = 0
+        self.tail = 0
+        if self.done is not None:
+            self.done[:] = False
+
+    def invalidate(self, gates):
+        # Tombstone the gates already in the queue
+        gates = np.asarray(gates)
+        if len(gates) > 0 and gates.max() >= len(self.invalidated):
+            self.grow_half_edges(gates.max() + 1)
+        self.invalidated[gates] = self.time
+        self.time += 1
+
+    def grow(self):
+        # Drop the popped entries, or double the size
+        size = self.tail - self.head
+        if self.head >= len(self.gates) // 2:
+            self.gates[:size] = self.gates[self.head:self.tail]
+            self.stamps[:size] = self.stamps[self.head:self.tail]
+        else:
+            self.gates = np.concatenate([self.gates[self.head:self.tail], np.zeros(len(self.gates), dtype=np.int32)])
+            self.stamps = np.concatenate([self.stamps[self.head:self.tail], np.zeros(len(self.stamps), dtype=np.int64)])
+        self.head = 0
+        self.tail = size
+
+    def grow_half_edges(self, nb_half_edges):
+        size = max(nb_half_edges, 2 * len(self.invalidated))
+        invalidated = self.zeros(size, np.int64)
+        invalidated[:len(self.invalidated)] = self.invalidated
+        self.invalidated = invalidated
+        if self.done is not None:
+            done = self.zeros(size, bool)
+            done[:len(self.done)] = self.done
+            self.done = done
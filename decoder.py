@@ -0,0 +1,423 @@
+import itertools
+import os
+import re
+
+import numpy as np
+
+from mesh import Mesh, FREE, CONQUERED, NULL, PLUS, MINUS
+from conquest_queue import ConquestQueue
+from obj_io import WHITESPACE, record_tokens
+from obja_writer import DECIMATING, CLEANING, SEWING, NULL_PATCH, STOP, LAYER_NAMES
+from binary_format import MAGIC, VERSION, HEADER, LAYER_HEADER, GATE, NB_CODES, NB_LENGTHS
+from range_coder import AdaptiveModel, RangeDecoder
+from geometry import BOX, dequantize, predict
+from patches import PATCHES, patch_case
+
+# Bytes read at once from a file
+CHUNK_SIZE = 1 << 20
+# Comment line starting a layer of an obja text
+LAYER_COMMENT = re.compile(rb'^#[ \t]*layer[ \t]+(\S+)[ \t\r]*$', re.MULTILINE)
+
+class DecodedMesh:
+    # Vertices and faces decoded so far, numbered as in the stream.
+    # The buffers grow by doubling and the faces are never moved, a deleted
+    # face is only marked as dead, so a layer costs its own size.
+
+    def __init__(self):
+        self.vertex_buffer = np.zeros((1024, 3))
+        self.face_buffer = np.zeros((1024, 3), dtype=np.int32)
+        self.alive_buffer = np.zeros(1024, dtype=bool)
+        self.nb_vertices = 0
+        self.nb_faces = 0
+
+    @property
+    def vertices(self):
+        return self.vertex_buffer[:self.nb_vertices]
+
+    @property
+    def faces(self):
+        # All the faces, alive or not (face n is faces[n - 1])
+        return self.face_buffer[:self.nb_faces]
+
+    @property
+    def alive(self):
+        return self.alive_buffer[:self.nb_faces]
+
+    def triangles(self):
+        return self.faces[self.alive]
+
+    def add_vertices(self, positions):
+        end = self.nb_vertices + len(positions)
+        if end > len(self.vertex_buffer):
+            self.vertex_buffer = grow(self.vertex_buffer, end)
+        self.vertex_buffer[self.nb_vertices:end] = positions
+        self.nb_vertices = end
+
+    def add_faces(self, faces):
+        end = self.nb_faces + len(faces)
+        if end > len(self.face_buffer):
+            self.face_buffer = grow(self.face_buffer, end)
+            self.alive_buffer = grow(self.alive_buffer, end)
+        self.face_buffer[self.nb_faces:end] = faces
+        self.alive_buffer[self.nb_faces:end] = True
+        self.nb_faces = end
+
+    def delete_faces(self, numbers):
+        self.alive_buffer[np.asarray(numbers, dtype=np.int64) - 1] = False
+
+
+def grow(array, size):
+    grown = np.zeros((max(size, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def decode(source, callback=None):
+    # Decode an obja or a binary stream, call callback(name, mesh) after each
+    # layer and return the final mesh. The source is a path, a binary file
+    # object, bytes or an iterable of chunks of bytes: each layer is decoded
+    # as soon as its bytes have arrived
+    stream = ByteStream(byte_chunks(source))
+    if stream.peek(len(MAGIC)) == MAGIC:
+        layers = iterate_binary(stream)
+    else:
+        layers = iterate_obja(stream.chunks())
+    mesh = DecodedMesh()
+    for name, mesh in layers:
+        if callback is not None:
+            callback(name, mesh)
+    return mesh
+
+
+def byte_chunks(source):
+    # Chunks of bytes of a path, a binary file object, bytes or an iterable
+    # of chunks
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        yield bytes(source)
+    elif isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as file:
+            yield from iter(lambda: file.read(CHUNK_SIZE), b'')
+    elif hasattr(source, 'read'):
+        yield from iter(lambda: source.read(CHUNK_SIZE), b'')
+    else:
+        yield from source
+
+
+class ByteStream:
+    # Exact reads over chunks of bytes, only the bytes not read yet are kept
+
+    def __init__(self, chunks):
+        self.source = iter(chunks)
+        self.buffer = bytearray()
+
+    def peek(self, size):
+        for chunk in self.source if len(self.buffer) < size else ():
+            self.buffer += chunk
+            if len(self.buffer) >= size:
+                break
+        return bytes(self.buffer[:size])
+
+    def read(self, size):
+        data = self.peek(size)
+        if len(data) < size:
+            raise ValueError('truncated binary stream: {} bytes missing'.format(size - len(data)))
+        del self.buffer[:size]
+        return data
+
+    def chunks(self):
+        # The chunks not read yet
+        if len(self.buffer) > 0:
+            yield bytes(self.buffer)
+            self.buffer = bytearray()
+        yield from self.source
+
+
+def iterate_obja(chunks):
+    # Layers of an obja text given by chunks of bytes, separated by the
+    # '# layer' comments (the whole text is one layer without them). Only
+    # the complete lines are searched for the comments: a layer is yielded
+    # as soon as the comment of the next one (or the end of the text) comes
+    mesh = DecodedMesh()
+    pending = bytearray()
+    searched = 0
+    names = ['base']
+    # The last line may miss its end of line
+    for chunk in itertools.chain(chunks, [b'\n']):
+        pending += chunk
+        complete = pending.rfind(b'\n') + 1
+        start = 0
+        for comment in LAYER_COMMENT.finditer(pending, searched, complete):
+            if apply_obja(mesh, bytes(pending[start:comment.start()]), len(names) == 1):
+                yield names[-1], mesh
+            names.append(comment.group(1).decode())
+            start = comment.end() + 1
+        del pending[:start]
+        searched = complete - start
+    if apply_obja(mesh, bytes(pending), len(names) == 1):
+        yield names[-1], mesh
+
+
+def apply_obja(mesh, data, is_base):
+    # Apply the records of the obja text of a layer, False for a base layer
+    # without vertices nor faces (skipped)
+    buffer = np.frombuffer(data + b'\n', dtype=np.uint8)
+    ends = np.flatnonzero(buffer == ord('\n'))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    lengths = ends - starts
+    first = buffer[starts]
+    second = buffer[np.minimum(starts + 1, len(buffer) - 1)]
+    third = buffer[np.minimum(starts + 2, len(buffer) - 1)]
+    is_vertex = (lengths > 1) & (first == ord('v')) & WHITESPACE[second]
+    is_face = (lengths > 1) & (first == ord('f')) & WHITESPACE[second]
+    is_deleted = (lengths > 2) & (first == ord('d')) & (second == ord('f')) & WHITESPACE[third]
+    if is_base and not is_vertex.any() and not is_face.any():
+        return False
+
+    # Parse all the records of the layer at once
+    text, _ = record_tokens(buffer, starts, ends, is_vertex)
+    mesh.add_vertices(np.fromstring(text, dtype=np.float64, sep=' ').reshape(-1, 3))
+    text, _ = record_tokens(buffer, starts, ends, is_face)
+    mesh.add_faces(np.fromstring(text, dtype=np.int64, sep=' ').reshape(-1, 3))
+    text, _ = record_tokens(buffer, starts, ends, is_deleted, keyword_length=2)
+    mesh.delete_faces(np.fromstring(text, dtype=np.int64, sep=' '))
+    return True
+
+
+def iterate_binary(stream):
+    # Layers of a binary stream (see binary_format) read from a ByteStream,
+    # each one as soon as its header and its payload have arrived
+    magic, version, bits, nb_vertices, nb_faces, nb_twins, nb_layers = HEADER.unpack(
+        stream.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a binary file of version {}'.format(VERSION))
+    if bits > 0:
+        box = BOX.unpack(stream.read(BOX.size))
+        low, high = np.array(box[:3]), np.array(box[3:])
+        quantized = np.frombuffer(stream.read(6 * nb_vertices), dtype='<u2')
+        quantized = quantized.reshape(-1, 3).astype(np.int64)
+        vertices = dequantize(quantized, low, high, bits)
+    else:
+        vertices = np.frombuffer(stream.read(24 * nb_vertices), dtype='<f8').reshape(-1, 3)
+    faces = np.frombuffer(stream.read(12 * nb_faces), dtype='<i4').reshape(-1, 3)
+    twins = np.frombuffer(stream.read(8 * nb_twins), dtype='<i4').reshape(-1, 2)
+
+    mesh = DecodedMesh()
+    mesh.add_vertices(vertices)
+    mesh.add_faces(faces)
+    decoder = BinaryDecoder(faces, nb_vertices)
+    decoder.mesh.opposite[twins[:, 0]] = twins[:, 1]
+    if bits > 0:
+        decoder.quantized = grow(quantized, len(quantized))
+    yield 'base', mesh
+
+    for _ in range(nb_layers):
+        kind, nb_inserted, connectivity_size, geometry_size = LAYER_HEADER.unpack(
+            stream.read(LAYER_HEADER.size))
+        connectivity = stream.read(connectivity_size)
+        geometry = stream.read(geometry_size)
+
+        decoder.mesh.grow_vertices(decoder.nb_vertices + nb_inserted)
+        if kind == DECIMATING:
+            added = decoder.decimating(connectivity, nb_inserted)
+        elif kind == CLEANING:
+            added = decoder.cleaning(connectivity, nb_inserted)
+        elif kind == SEWING:
+            added = decoder.sewing(connectivity, nb_inserted)
+        else:
+            raise ValueError('unknown layer kind {}'.format(kind))
+        inserted = np.arange(mesh.nb_vertices + 1, mesh.nb_vertices + nb_inserted + 1)
+        if bits > 0:
+            positions = dequantize(decoder.residuals(geometry, inserted, added), low, high, bits)
+        else:
+            positions = np.frombuffer(geometry, dtype='<f8').reshape(-1, 3)
+        mesh.add_vertices(positions)
+        mesh.add_faces(added)
+        mesh.delete_faces(decoder.dead)
+        yield LAYER_NAMES[kind], mesh
+
+
+class BinaryDecoder:
+    # Half-edge mesh of the binary decoder. The faces are numbered in the
+    # order they are created, as in the obja file: face_edge[n - 1] is the
+    # half-edge of face n starting at its first vertex, face_of[h] the
+    # number of the face of the half-edge h.
+
+    def __init__(self, faces, nb_vertices):
+        self.mesh = Mesh.from_faces(faces, nb_vertices)
+        self.nb_vertices = nb_vertices
+        self.nb_faces = len(faces)
+        self.face_edge = np.arange(0, 3 * len(faces), 3, dtype=np.int64)
+        self.face_of = np.repeat(np.arange(1, len(faces) + 1), 3)
+        self.quantized = None
+        self.dead = []
+
+    def new_vertex(self):
+        self.nb_vertices += 1
+        return self.nb_vertices
+
+    def new_faces(self, spokes):
+        # The faces starting with the spokes (vertex, chain[i], chain[i+1])
+        origin = self.mesh.origin
+        next = self.mesh.next
+        if len(self.face_of) < len(origin):
+            self.face_of = grow(self.face_of, len(origin))
+        end = self.nb_faces + len(spokes)
+        if end > len(self.face_edge):
+            self.face_edge = grow(self.face_edge, end)
+        added = []
+        for spoke in spokes:
+            self.nb_faces += 1
+            self.face_edge[self.nb_faces - 1] = spoke
+            edge = next[spoke]
+            self.face_of[[spoke, edge, next[edge]]] = self.nb_faces
+            added.append((origin[spoke], origin[edge], origin[next[edge]]))
+        return added
+
+    def decimating(self, connectivity, nb_inserted):
+        # Replay the decimating conquest on the coarse mesh: the same gates
+        # are visited in the same order, each free one reads its code
+        mesh = self.mesh
+        left, right, front = GATE.unpack_from(connectivity)
+        stream = RangeDecoder(connectivity[GATE.size:])
+        model = AdaptiveModel(NB_CODES)
+        mesh.reset_status()
+        plus_minus = mesh.plus_minus
+        plus_minus[left] = MINUS
+        plus_minus[right] = PLUS
+        fifo = ConquestQueue(len(mesh.origin))
+        fifo.push(mesh.find_half_edge(left, right, front))
+        first_vertex = self.nb_vertices
+        self.dead = []
+        added = []
+        while len(fifo) > 0:
+            gate = fifo.pop()
+            origin = mesh.origin
+            next = mesh.next
+            opposite = mesh.opposite
+            faces_status = mesh.faces_status
+            if faces_status[gate] != FREE:
+                continue
+            left, right = origin[gate], origin[next[gate]]
+            code = stream.decode_symbol(model)
+
+            if code == STOP:
+                faces_status[gate] = NULL
+                continue
+
+            if code == NULL_PATCH:
+                faces_status[gate] = NULL
+                front = origin[next[next[gate]]]
+                if plus_minus[front] == 0:
+                    plus_minus[front] = PLUS
+                for edge in (opposite[next[gate]], opposite[next[next[gate]]]):
+                    if edge >= 0:
+                        fifo.push(edge)
+                continue
+
+            valence = code + 2
+            rule = PATCHES[patch_case(valence, plus_minus[left], plus_minus[right])]
+            border, diagonals = self.walk_patch(gate, valence, rule.triangles)
+            chain = origin[border]
+            for edge in border[:-1]:
+                if opposite[edge] >= 0:
+                    fifo.push(opposite[edge])
+                faces_status[edge] = CONQUERED
+            faces_status[gate] = CONQUERED
+            for vertex, sign in zip(chain[1:-1], rule.signs):
+                if plus_minus[vertex] == 0:
+                    plus_minus[vertex] = sign
+            spokes = mesh.insert_vertex(self.new_vertex(), border, diagonals)
+            added.extend(self.new_faces(spokes))
+
+        if self.nb_vertices - first_vertex != nb_inserted:
+            raise ValueError('corrupted decimating layer')
+        return np.array(added, dtype=np.int64).reshape(-1, 3)
+
+    def walk_patch(self, gate, valence, triangles):
+        # Border of the patch (border[i] goes from chain[i] to chain[i+1],
+        # the gate is the last one) and its diagonals, from the triangles
+        next = self.mesh.next
+        opposite = self.mesh.opposite
+        third = {}
+        for a, b, c in triangles:
+            third[(a, b)] = c
+            third[(b, c)] = a
+            third[(c, a)] = b
+        border = [-1] * (valence - 1) + [gate]
+        diagonals = []
+        stack = [(gate, valence - 1, 0)]
+        while stack:
+            half_edge, a, b = stack.pop()
+            c = third[(a, b)]
+            self.dead.append(self.face_of[half_edge])
+            edge = next[half_edge]
+            for x, y in ((b, c), (c, a)):
+                if y == (x + 1) % valence:
+                    border[x] = edge
+                else:
+                    diagonals.extend((edge, opposite[edge]))
+                    stack.append((opposite[edge], y, x))
+                edge = next[edge]
+        return border, diagonals
+
+    def cleaning(self, connectivity, nb_inserted):
+        # Split the given faces with a new vertex
+        mesh = self.mesh
+        stream = RangeDecoder(connectivity)
+        deltas = AdaptiveModel(NB_LENGTHS)
+        rotations = AdaptiveModel(3)
+        self.dead = []
+        added = []
+        number = 0
+        for _ in range(nb_inserted):
+            number += stream.decode_int(deltas)
+            edge = self.face_edge[number - 1]
+            for _ in range(stream.decode_symbol(rotations)):
+                edge = mesh.next[edge]
+            border = [edge, mesh.next[edge], mesh.next[mesh.next[edge]]]
+            self.dead.append(number)
+            spokes = mesh.insert_vertex(self.new_vertex(), border, [])
+            added.extend(self.new_faces(spokes))
+        return np.array(added, dtype=np.int64).reshape(-1, 3)
+
+    def sewing(self, connectivity, nb_inserted):
+        # Split the given edges with two faces around a new vertex, from the
+        # last sewed one (an edge can be sewed several times), the vertices
+        # and the faces being numbered in the order of the obja file
+        mesh = self.mesh
+        stream = RangeDecoder(connectivity)
+        model = AdaptiveModel(NB_LENGTHS)
+        self.dead = []
+        edges = [[stream.decode_uint(model) for _ in range(3)] for _ in range(nb_inserted)]
+        spokes = [None] * nb_inserted
+        for k in reversed(range(nb_inserted)):
+            half_edge = mesh.find_half_edge(*edges[k])
+            if half_edge < 0:
+                raise ValueError('corrupted sewing layer: no edge {} {}'.format(*edges[k]))
+            spokes[k] = mesh.unsew(self.nb_vertices + k + 1, half_edge)
+        self.nb_vertices += nb_inserted
+        added = self.new_faces([spoke for pair in spokes for spoke in pair])
+        return np.array(added, dtype=np.int64).reshape(-1, 3)
+
+    def residuals(self, geometry, inserted, added):
+        # Quantized positions of the inserted vertices: prediction + residuals
+        stream = RangeDecoder(geometry)
+        models = [AdaptiveModel(NB_LENGTHS) for _ in range(3)]
+        residuals = np.array([[stream.decode_int(model) for model in models]
+                              for _ in range(len(inserted))], dtype=np.int64).reshape(-1, 3)
+        if self.nb_vertices > len(self.quantized):
+            self.quantized = grow(self.quantized, self.nb_vertices)
+        quantized = predict(inserted, added, self.quantized) + residuals
+        self.quantized[inserted - 1] = quantized
+
+        # The chain of a sewed vertex can hold vertices sewed after it in the
+        # same layer (their valence fell to 2), inserted before it: these
+        # ones are predicted one at a time, from the last sewed one
+        if len(inserted) == 0:
+            return quantized
+        owner = added[:, 0] - inserted[0]
+        for k in np.unique(owner[added[:, 1] >= inserted[0]])[::-1].tolist():
+            chain = self.quantized[added[owner == k, 1] - 1]
+            prediction = np.floor(chain.sum(axis=0) / len(chain) + 0.5).astype(np.int64)
+            self.quantized[inserted[k] - 1] = prediction + residuals[k]
+        return self.quantized[inserted - 1]
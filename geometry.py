@@ -0,0 +1,46 @@
+import struct
+
+import numpy as np
+
+# Bounding box of the quantization grid (low x y z, high x y z)
+BOX = struct.Struct('<6d')
+MAX_BITS = 16
+
+
+def bounding_box(vertices):
+    if len(vertices) == 0:
+        return np.zeros(3), np.zeros(3)
+    return vertices.min(axis=0), vertices.max(axis=0)
+
+
+def grid_step(low, high, bits):
+    extent = np.asarray(high, dtype=np.float64) - low
+    return np.where(extent > 0, extent / ((1 << bits) - 1), 1.0)
+
+
+def quantize(vertices, low, high, bits):
+    # Integer coordinates on a grid of 2^bits values per axis over the box
+    if not 1 <= bits <= MAX_BITS:
+        raise ValueError('quantization bits must be between 1 and {}, got {}'.format(MAX_BITS, bits))
+    quantized = np.rint((vertices - low) / grid_step(low, high, bits))
+    return np.clip(quantized, 0, (1 << bits) - 1).astype(np.int64)
+
+
+def dequantize(quantized, low, high, bits):
+    return low + quantized * grid_step(low, high, bits)
+
+
+def predict(inserted, faces, quantized):
+    # Barycenter of the chain of each inserted vertex, from the faces added
+    # around it by the layer (vertex, chain[i], chain[i+1])
+    if len(inserted) == 0:
+        return np.zeros((0, 3), dtype=np.int64)
+    order = np.argsort(inserted, kind='stable')
+    owner = order[np.minimum(np.searchsorted(inserted[order], faces[:, 0]), len(inserted) - 1)]
+    count = np.maximum(np.bincount(owner, minlength=len(inserted)), 1)
+    chain = quantized[faces[:, 1] - 1]
+    prediction = np.zeros((len(inserted), 3), dtype=np.int64)
+    for axis in range(3):
+        total = np.bincount(owner, weights=chain[:, axis], minlength=len(inserted))
+        prediction[:, axis] = np.floor(total / count + 0.5)
+    return prediction
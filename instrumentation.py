@@ -0,0 +1,66 @@
+import contextlib
+import json
+import time
+
+
+class Instrumentation:
+    # Counters, phase timers and event callbacks of the pipeline.
+    # The conquests count in local variables and add their counters once at
+    # the end, callbacks are only called when some are registered, so the
+    # cost is negligible (the conquests take instrumentation=None to skip it).
+    # Events: 'vertex_removed' (conquest, vertex, valence),
+    #         'phase' (name, seconds)
+
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+        self.callbacks = {}
+
+    def add(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_counters(self, prefix, counters):
+        for name, value in counters.items():
+            self.add('{}.{}'.format(prefix, name), value)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timers[name] = self.timers.get(name, 0.0) + elapsed
+            self.emit('phase', name, elapsed)
+
+    def on(self, event, callback):
+        self.callbacks.setdefault(event, []).append(callback)
+
+    def callback(self, event):
+        # Function calling the callbacks of the event, None without callbacks
+        callbacks = self.callbacks.get(event)
+        if not callbacks:
+            return None
+        if len(callbacks) == 1:
+            return callbacks[0]
+        return lambda *args: [callback(*args) for callback in callbacks]
+
+    def emit(self, event, *args):
+        for callback in self.callbacks.get(event, ()):
+            callback(*args)
+
+    def to_dict(self):
+        return {'counters': dict(sorted(self.counters.items())),
+                'timers': dict(sorted(self.timers.items()))}
+
+    def dump(self, path):
+        # Serialized before the file is opened, no truncated file on error
+        text = json.dumps(self.to_dict(), indent=2)
+        with open(path, 'w') as file:
+            file.write(text)
+
+
+def event_callback(instrumentation, event):
+    if instrumentation is None:
+        return None
+    return instrumentation.callback(event)
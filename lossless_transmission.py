@@ -1,92 +1,398 @@
 # -*- coding: utf-8 -*-
-import numpy as np
 """
 CSI Project.
 
 @author: Pierre Barroso + Fabio + Amar + Younes
+
+python lossless_transmission.py                       encode OBJ_PATH
+python lossless_transmission.py OBJ/cow.obj 'OBJ/*'   encode files, directories or globs
+python lossless_transmission.py OBJ -j 4 -o out       4 meshes at a time, outputs in out
+python lossless_transmission.py big.obj --out-of-core /scratch --memory 512
+                                                      mesh and layers in files of /scratch
+python lossless_transmission.py --help                all the options
 """
+import argparse
+import concurrent.futures
+import glob
+import os
+import random
+import re
+import sys
+import time
+
 from tools import (preprocessing, decimating_conquest, cleaning_conquest,
-                   sew_conquest, write_obj, postprocessing, write_last_obja)
+                   sew_conquest, fused_conquest, write_obj, write_ply, write_obja,
+                   write_last_obja)
+from obja_writer import ObjaWriter, DECIMATING, CLEANING, SEWING
+from binary_format import write_binary, print_report
+from geometry import MAX_BITS
+from instrumentation import Instrumentation
+from parallel import RegionPool
+from checkpoint import save_checkpoint, load_checkpoint
+from mesh_cache import MeshCache, MAX_BYTES
+from mapped_arrays import MappedArrays
+from out_of_core import (ChunkedConquest, mapped_preprocessing, mapped_mesh, peak_memory,
+                         write_mapped_obj, write_mapped_ply, write_mapped_last_obja, MEMORY)
+from verifier import verify, verification_summary
+from stopping import StopCriteria
 
 
 OBJ_PATH = './OBJ/icosphere.obj'
 NB_ITERATIONS = 6
-obja = ""
-obj_to_obja = {}
-
-# Preprocessing
-gates, valences, patches, active_vertices, vertices, faces = preprocessing(OBJ_PATH)
-nb_vertex = len(vertices)
-count_v = nb_vertex +1
-
-# Repeat the 3 steps of the algorithm
-for current_it in range(NB_ITERATIONS):
-    if len(active_vertices) >= 10 and current_it < NB_ITERATIONS-1:
-
-        # decimating conquest + retriangulation
-        obj_to_obja_iter = {}
-        obja_iter = ""
-        count_v_iter = 1
-        obja_iter, count_v_iter = decimating_conquest(
-            gates, valences, patches, active_vertices, -1, vertices, faces, obja_iter, count_v_iter, obj_to_obja_iter )
-
-        # Update obja
-        a = {}
-        for k in range(1,count_v_iter):
-            a[count_v - k] = obj_to_obja_iter[count_v_iter -k]
-        obj_to_obja.update(a)
-        count_v -= count_v_iter -1
-        obja = obja_iter + obja
-
-        # Cleaning Conquest
-        fifo = []
-        obj_to_obja_iter = {}
-        obja_iter = ""
-        count_v_iter = 1
-        obja_iter, count_v_iter = cleaning_conquest(gates, patches,
-                                             valences, active_vertices, fifo, vertices, faces,
-                                             obja_iter, count_v_iter, obj_to_obja_iter)
-        # Update obja
-        a = {}
-        for k in range(1,count_v_iter):
-            a[count_v - k] = obj_to_obja_iter[count_v_iter -k]
-        obj_to_obja.update(a)
-        count_v -= count_v_iter -1
-        obja = obja_iter + obja
-
-        # sew conquest
-        obj_to_obja_iter = {}
-        obja_iter = ""
-        count_v_iter = 1
-        obja_iter, count_v_iter = sew_conquest(gates, patches, 
-                                        active_vertices, valences, 
-                                        vertices, faces, obja_iter, count_v_iter, obj_to_obja_iter)
-        # Update obja
-        a = {}
-        for k in range(1,count_v_iter):
-            a[count_v - k] = obj_to_obja_iter[count_v_iter -k]
-        obj_to_obja.update(a)
-        count_v -= count_v_iter -1        
-        obja = obja_iter + obja
-        
-        # create current obj
-        path = '{}_{}.obj'.format(OBJ_PATH.split('.obj')[0], current_it)
-        write_obj(path, active_vertices, gates, vertices)
-
-    else:
-        a = {}
-        path = '{}_{}.obj'.format(OBJ_PATH.split('.obj')[0], current_it)
-        write_obj(path, active_vertices, gates, vertices)
-        obj_f = write_last_obja(active_vertices, gates, vertices,  1, a)
-        obj_to_obja.update(a)
-        obja = obj_f + obja
-        break
-
-# Postprocessing
-obja = postprocessing(obja, vertices, obj_to_obja)
-f = open(OBJ_PATH + "a", "w")
-f.write(obja)
-f.close()
-
-print('\n')
-print('Final vertices: {}'.format(len(active_vertices)))
+# 'obja' (text file .obja) or 'binary' (compressed file .objb)
+OUTPUT_FORMAT = 'obja'
+# Bits per axis of the quantized coordinates of the binary file
+# (1 to geometry.MAX_BITS = 16 bits, None to keep the float64 coordinates)
+QUANTIZATION_BITS = None
+# Decimating, cleaning and sewing in one conquest (see tools.fused_conquest)
+FUSED = False
+# Processes of the decimating conquest, one region of the mesh each
+# (1 for the sequential conquest)
+NB_PROCESSES = 1
+# Meshes encoded at the same time, and meshes waiting for a process
+NB_JOBS = 1
+QUEUE_SIZE = 2
+EXTENSIONS = {'obja': '.obja', 'binary': '.objb'}
+# Mesh of each iteration: 'obj', 'ply' (binary) or None
+LOD_FORMAT = 'obj'
+
+
+def encode(obj_path, output_base, nb_iterations=NB_ITERATIONS, output_format=OUTPUT_FORMAT,
+           quantization_bits=QUANTIZATION_BITS, fused=FUSED, nb_processes=NB_PROCESSES,
+           instrumentation=None, checkpoint=False, cache=None, lod_format=LOD_FORMAT,
+           work_directory=None, memory=MEMORY, stopping=None, seed=None):
+    # Compress one mesh to output_base + .obja or .objb (and the mesh of each
+    # iteration to output_base_<iteration>.obj or .ply), return the number of
+    # vertices before and after the decimation and the report of the
+    # binary file (None for obja). With checkpoint, the state of the encoder
+    # is saved after each iteration and the encoding resumes from the last
+    # checkpoint of the mesh. The preprocessed meshes are kept in the cache
+    # (mesh_cache.MeshCache) if there is one. With a work directory, the
+    # mesh is encoded out of core: its arrays and the layers written so far
+    # are in files of the work directory, and the decimating conquest goes
+    # by chunks of about memory bytes (out_of_core.ChunkedConquest). The
+    # iterations stop on the criteria of stopping (stopping.StopCriteria,
+    # by default when an iteration removes no vertex). The random gates
+    # start from seed if given
+    if seed is not None:
+        random.seed(seed)
+    storage = None
+    spool_path = None
+    if work_directory is not None:
+        storage = MappedArrays(work_directory, memory)
+        spool_path = os.path.join(storage.directory, 'layers')
+    try:
+        return encode_mesh(obj_path, output_base, nb_iterations, output_format,
+                           quantization_bits, fused, nb_processes, instrumentation, checkpoint,
+                           cache, lod_format, storage, spool_path, memory,
+                           StopCriteria() if stopping is None else stopping, seed)
+    finally:
+        if storage is not None:
+            storage.close()
+
+
+def encode_mesh(obj_path, output_base, nb_iterations, output_format, quantization_bits, fused,
+                nb_processes, instrumentation, checkpoint, cache, lod_format, storage,
+                spool_path, memory, stopping, seed):
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    pool = RegionPool(nb_processes) if nb_processes > 1 and storage is None else None
+    # The workers of the pool and the spool files of the layers are closed
+    # whatever happens (the batch goes on with the next mesh)
+    obja = None
+    try:
+        # Preprocessing, or the last checkpoint of the same options (all those
+        # the layers depend on but the number of iterations)
+        resumed = None
+        settings = repr((seed, output_format, quantization_bits, fused,
+                         nb_processes if pool is not None else 1,
+                         memory if storage is not None else None,
+                         stopping.target_vertices, stopping.max_bytes, stopping.min_ratio))
+        if checkpoint:
+            resumed = load_checkpoint(output_base, obj_path, settings, nb_iterations - 2,
+                                      spool_path)
+        if resumed is None:
+            with instrumentation.phase('preprocessing'):
+                if storage is None:
+                    mesh, active_vertices, vertices, faces = preprocessing(obj_path, cache,
+                                                                           instrumentation)
+                else:
+                    mesh, active_vertices, vertices, faces = mapped_preprocessing(
+                        obj_path, storage, cache, instrumentation)
+            obja = ObjaWriter(spool_path)
+            first_it = 0
+            nb_active = None
+        else:
+            last_it, nb_active, mesh, active_vertices, vertices, faces, obja = resumed
+            first_it = last_it + 1
+        nb_vertices = len(vertices)
+        stopping.start(vertices, output_format, quantization_bits)
+        if storage is not None:
+            if resumed is not None:
+                with instrumentation.phase('out_of_core'):
+                    mesh, active_vertices, vertices, faces = mapped_mesh(
+                        storage, mesh, active_vertices, vertices, faces)
+            pool = ChunkedConquest(storage, memory)
+
+        # Repeat the 3 steps of the algorithm, until a stop criterion is met
+        for current_it in range(first_it, nb_iterations):
+            progress = not stopping.stop(len(active_vertices), nb_active, obja, mesh)
+            nb_active = len(active_vertices)
+            if progress and current_it < nb_iterations-1:
+
+                if fused:
+                    with instrumentation.phase('fused_conquest'):
+                        obja = fused_conquest(mesh, active_vertices, vertices, obja,
+                                              instrumentation, pool)
+
+                else:
+                    # decimating conquest + retriangulation
+                    obja.new_layer(DECIMATING)
+                    with instrumentation.phase('decimating_conquest'):
+                        obja = decimating_conquest(
+                            mesh, active_vertices, vertices, obja, instrumentation, pool)
+
+                    # Cleaning Conquest
+                    obja.new_layer(CLEANING)
+                    with instrumentation.phase('cleaning_conquest'):
+                        obja = cleaning_conquest(mesh, active_vertices, vertices, obja,
+                                                 instrumentation)
+
+                    # sew conquest
+                    obja.new_layer(SEWING)
+                    with instrumentation.phase('sew_conquest'):
+                        obja = sew_conquest(mesh, active_vertices, vertices, obja,
+                                            instrumentation)
+
+                # create current obj
+                with instrumentation.phase('write_obj'):
+                    write_lod(output_base, current_it, lod_format, active_vertices, mesh, vertices,
+                              storage)
+                if checkpoint:
+                    with instrumentation.phase('checkpoint'):
+                        save_checkpoint(output_base, obj_path, settings, current_it, nb_active,
+                                        mesh, active_vertices, vertices, faces, obja)
+                if storage is not None:
+                    storage.release()
+
+            else:
+                instrumentation.add('stopping.' + (stopping.reason or 'iterations'))
+                with instrumentation.phase('write_obj'):
+                    write_lod(output_base, current_it, lod_format, active_vertices, mesh, vertices,
+                              storage)
+                obja.new_layer()
+                if storage is None:
+                    write_last_obja(active_vertices, mesh, vertices, obja)
+                else:
+                    write_mapped_last_obja(active_vertices, mesh, vertices, obja)
+                break
+
+        # Postprocessing
+        report = None
+        with instrumentation.phase('postprocessing'):
+            if output_format == 'binary':
+                report = write_binary(obja, vertices, output_base + EXTENSIONS['binary'],
+                                      quantization_bits, storage)
+            else:
+                write_obja(obja, vertices, output_base + EXTENSIONS['obja'], storage)
+        return nb_vertices, len(active_vertices), report
+    finally:
+        if pool is not None:
+            pool.close()
+        if obja is not None:
+            obja.close()
+
+
+def write_lod(output_base, iteration, lod_format, active_vertices, mesh, vertices, storage=None):
+    # By blocks for the mapped arrays of storage
+    if lod_format == 'obj':
+        writer = write_obj if storage is None else write_mapped_obj
+        writer('{}_{}.obj'.format(output_base, iteration), active_vertices, mesh, vertices)
+    elif lod_format == 'ply':
+        writer = write_ply if storage is None else write_mapped_ply
+        writer('{}_{}.ply'.format(output_base, iteration), active_vertices, mesh, vertices)
+
+
+def find_meshes(patterns):
+    # Obj files of the patterns (files, directories or globs), without the
+    # obj of the iterations written next to their mesh
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.obj')
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        paths.extend(path for path in matches if path.endswith('.obj'))
+    meshes = set(paths)
+    iteration = re.compile(r'(.*)_\d+\.obj$')
+    paths = [path for path in paths
+             if not (iteration.match(path) and iteration.match(path).group(1) + '.obj' in meshes)]
+    return list(dict.fromkeys(paths))
+
+
+def output_base(obj_path, output_directory=None):
+    directory = os.path.dirname(obj_path) if output_directory is None else output_directory
+    return os.path.join(directory, os.path.splitext(os.path.basename(obj_path))[0])
+
+
+def up_to_date(obj_path, output_path):
+    return (os.path.exists(obj_path) and os.path.exists(output_path)
+            and os.path.getmtime(output_path) >= os.path.getmtime(obj_path))
+
+
+def encode_job(obj_path, base, options):
+    # Encode one mesh of the batch, return its line of the summary
+    # (the error instead of the counts when it fails)
+    instrumentation = Instrumentation()
+    start = time.perf_counter()
+    try:
+        nb_vertices, nb_final, report = encode(
+            obj_path, base, options['iterations'], options['format'], options['bits'],
+            options['fused'], options['processes'], instrumentation, options['checkpoint'],
+            options['cache'], options['lods'], options['out_of_core'], options['memory'],
+            StopCriteria(options['target_vertices'], options['max_bytes'], options['min_ratio']),
+            options['seed'])
+        if options['verify']:
+            with instrumentation.phase('verify'):
+                check = verify(obj_path, base + EXTENSIONS[options['format']],
+                               options['bits'] if options['format'] == 'binary' else None)
+        if options['instrumentation']:
+            instrumentation.dump(base + '.json')
+        if options['verify'] and not check['same']:
+            return {'path': obj_path, 'error': verification_summary(check)}
+    except Exception as error:
+        return {'path': obj_path, 'error': '{}: {}'.format(type(error).__name__, error)}
+    return {
+        'path': obj_path,
+        'vertices': nb_vertices,
+        'final_vertices': nb_final,
+        'seconds': time.perf_counter() - start,
+        'output_bytes': os.path.getsize(base + EXTENSIONS[options['format']]),
+        'peak_memory': peak_memory(),
+        'report': report,
+    }
+
+
+def encode_all(jobs, options, nb_jobs=NB_JOBS, queue_size=QUEUE_SIZE):
+    # Encode the (obj path, output base) jobs, nb_jobs at a time in a process
+    # pool holding at most queue_size jobs per process, results in job order
+    if nb_jobs <= 1:
+        return [encode_job(obj_path, base, options) for obj_path, base in jobs]
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(nb_jobs) as executor:
+        pending = {}
+        for k, (obj_path, base) in enumerate(jobs):
+            if len(pending) >= queue_size * nb_jobs:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    results[pending.pop(future)] = future.result()
+            pending[executor.submit(encode_job, obj_path, base, options)] = k
+        for future in concurrent.futures.as_completed(pending):
+            results[pending[future]] = future.result()
+    return [results[k] for k in range(len(jobs))]
+
+
+def print_summary(results, skipped, seconds):
+    # Peak resident memory of the process that encoded the mesh (of the
+    # meshes it encoded before as well)
+    print('{:<32}{:>10}{:>10}{:>10}{:>12}{:>12}{:>10}'.format(
+        'mesh', 'vertices', 'final', 'seconds', 'v/s', 'bytes', 'peak MB'))
+    for result in results:
+        name = os.path.basename(result['path'])
+        if 'error' in result:
+            print('{:<32}{}'.format(name, result['error']))
+            continue
+        print('{:<32}{:>10}{:>10}{:>10.2f}{:>12.0f}{:>12}{:>10.0f}'.format(
+            name, result['vertices'], result['final_vertices'], result['seconds'],
+            result['vertices'] / max(result['seconds'], 1e-9), result['output_bytes'],
+            result['peak_memory'] / (1 << 20)))
+    encoded = [result for result in results if 'error' not in result]
+    nb_vertices = sum(result['vertices'] for result in encoded)
+    print('{} encoded, {} failed, {} up to date in {:.2f} s ({:.1f} meshes/s, {:.0f} v/s)'.format(
+        len(encoded), len(results) - len(encoded), skipped, seconds,
+        len(encoded) / max(seconds, 1e-9), nb_vertices / max(seconds, 1e-9)))
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Progressive lossless compression of obj meshes')
+    parser.add_argument('meshes', nargs='*', default=[OBJ_PATH],
+                        help='obj files, directories or glob patterns')
+    parser.add_argument('-n', '--iterations', type=int, default=NB_ITERATIONS)
+    parser.add_argument('-s', '--seed', type=int, default=None,
+                        help='seed of the random gates (the same for every mesh)')
+    parser.add_argument('-o', '--output-directory', default=None,
+                        help='directory of the outputs (default: next to each mesh)')
+    parser.add_argument('-f', '--format', choices=sorted(EXTENSIONS), default=OUTPUT_FORMAT)
+    parser.add_argument('-b', '--bits', type=int, default=QUANTIZATION_BITS,
+                        choices=range(1, MAX_BITS + 1), metavar='BITS',
+                        help='bits per axis of the binary coordinates, 1 to {} '
+                             '(default: float64)'.format(MAX_BITS))
+    parser.add_argument('--fused', action='store_true', default=FUSED)
+    parser.add_argument('--lods', choices=['obj', 'ply', 'none'], default=LOD_FORMAT or 'none',
+                        help='format of the mesh written after each iteration')
+    parser.add_argument('--target-vertices', type=int, default=None,
+                        help='stop once the base mesh has at most this number of vertices')
+    parser.add_argument('--max-bytes', type=int, default=None,
+                        help='stop before the estimated output size exceeds this number of bytes')
+    parser.add_argument('--min-ratio', type=float, default=0.0,
+                        help='stop after an iteration removing at most this fraction of the '
+                             'vertices (default: stop when it removes none)')
+    parser.add_argument('-j', '--jobs', type=int, default=NB_JOBS,
+                        help='meshes encoded at the same time')
+    parser.add_argument('-p', '--processes', type=int, default=NB_PROCESSES,
+                        help='processes of the decimating conquest of a mesh (with --jobs 1)')
+    parser.add_argument('--force', action='store_true',
+                        help='encode the meshes whose output is up to date')
+    parser.add_argument('--checkpoint', action='store_true',
+                        help='save the encoder after each iteration and resume from its last save')
+    parser.add_argument('--cache', default=None,
+                        help='directory of the cache of the preprocessed meshes')
+    parser.add_argument('--cache-size', type=int, default=MAX_BYTES >> 20,
+                        help='size of the cache in MB (least recently used meshes removed)')
+    parser.add_argument('--out-of-core', default=None, metavar='DIRECTORY',
+                        help='encode with the mesh and the layers in files of this work directory')
+    parser.add_argument('--memory', type=int, default=MEMORY >> 20,
+                        help='memory of the mesh arrays in MB when out of core '
+                             '(the decimating conquest goes by chunks of this size)')
+    parser.add_argument('--verify', action='store_true',
+                        help='decode each output and check it against its obj file')
+    parser.add_argument('--instrumentation', action='store_true',
+                        help='write the counters and phase timers of each mesh to a json file')
+    args = parser.parse_args(arguments)
+    if args.jobs > 1 and args.processes > 1:
+        parser.error('--processes needs --jobs 1')
+    if args.out_of_core is not None and args.processes > 1:
+        parser.error('--out-of-core needs --processes 1')
+    if args.bits is not None and args.format != 'binary':
+        parser.error('--bits needs --format binary')
+
+    if args.output_directory is not None:
+        os.makedirs(args.output_directory, exist_ok=True)
+    jobs = []
+    skipped = 0
+    for obj_path in find_meshes(args.meshes):
+        base = output_base(obj_path, args.output_directory)
+        if not args.force and up_to_date(obj_path, base + EXTENSIONS[args.format]):
+            skipped += 1
+            continue
+        jobs.append((obj_path, base))
+
+    options = {'iterations': args.iterations, 'seed': args.seed, 'format': args.format,
+               'bits': args.bits, 'fused': args.fused, 'processes': args.processes,
+               'lods': None if args.lods == 'none' else args.lods,
+               'checkpoint': args.checkpoint, 'instrumentation': args.instrumentation,
+               'out_of_core': args.out_of_core, 'memory': args.memory << 20,
+               'verify': args.verify, 'target_vertices': args.target_vertices,
+               'max_bytes': args.max_bytes, 'min_ratio': args.min_ratio,
+               'cache': None if args.cache is None else MeshCache(args.cache, args.cache_size << 20)}
+    start = time.perf_counter()
+    results = encode_all(jobs, options, args.jobs)
+    seconds = time.perf_counter() - start
+    if len(results) == 1 and results[0].get('report') is not None:
+        print_report(results[0]['report'])
+    print_summary(results, skipped, seconds)
+    return 1 if any('error' in result for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
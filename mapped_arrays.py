@@ -0,0 +1,123 @@
+import mmap
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+
+# Bytes of the temporary arrays of a pass per entry of its blocks (the
+# sorts of the preprocessing take the most), and smallest block
+ENTRY_BYTES = 256
+MIN_BLOCK = 1 << 12
+
+
+class MappedArrays:
+    # Arrays in the files of a work directory, mapped in shared memory: the
+    # kernel writes their pages to the files, and release drops them from
+    # the resident memory of the process (they are read back when touched).
+    # The passes over whole arrays go by blocks of block_size entries
+    # (about memory bytes of temporary arrays), released after each block.
+
+    def __init__(self, directory, memory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix='.encode-', dir=directory)
+        self.memory = memory
+        self.block_size = max(memory // ENTRY_BYTES, MIN_BLOCK)
+        # The mappings of the arrays still alive
+        self.maps = weakref.WeakSet()
+        self.nb_files = 0
+
+    def zeros(self, shape, dtype):
+        # New array of zeros, in a file removed at once (its pages stay
+        # valid until the array is freed)
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if nbytes == 0:
+            return np.zeros(shape, dtype=dtype)
+        self.nb_files += 1
+        path = os.path.join(self.directory, 'array_{}'.format(self.nb_files))
+        with open(path, 'w+b') as file:
+            file.truncate(nbytes)
+            mapped = mmap.mmap(file.fileno(), nbytes)
+        os.remove(path)
+        self.maps.add(mapped)
+        return np.frombuffer(mapped, dtype=dtype).reshape(shape)
+
+    def full(self, shape, fill, dtype):
+        array = self.zeros(shape, dtype)
+        flat = array.reshape(-1)
+        for start, stop in self.blocks(len(flat)):
+            flat[start:stop] = fill
+        return array
+
+    def map(self, array):
+        # Mapped copy of the array
+        array = np.asarray(array)
+        copy = self.zeros(array.shape, array.dtype)
+        source = array.reshape(-1)
+        target = copy.reshape(-1)
+        for start, stop in self.blocks(len(source)):
+            target[start:stop] = source[start:stop]
+        return copy
+
+    def read(self, file, shape, dtype):
+        # Mapped array of the next bytes of the file
+        array = self.zeros(shape, dtype)
+        target = array.reshape(-1).view(np.uint8)
+        step = self.block_size * array.itemsize
+        for start in range(0, len(target), step):
+            view = target[start:start + step]
+            if file.readinto(view) != len(view):
+                raise ValueError('truncated array in {}'.format(getattr(file, 'name', file)))
+            self.release()
+        return array
+
+    def load(self, path):
+        # Mapped copy of a npy file
+        with open(path, 'rb') as file:
+            shape, dtype = read_npy_header(file)
+            return self.read(file, shape, dtype)
+
+    def blocks(self, size):
+        # Slices (start, stop) of an array of size entries, the pages of the
+        # mapped arrays are released after each one
+        for start in range(0, size, self.block_size):
+            yield start, min(start + self.block_size, size)
+            self.release()
+
+    def release(self):
+        for mapped in list(self.maps):
+            mapped.madvise(mmap.MADV_DONTNEED)
+
+    def close(self):
+        # The mappings stay valid until the arrays are freed
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def blocks(size, storage=None):
+    # Slices of an array of size entries: the whole array in memory, blocks
+    # of the storage for the mapped arrays
+    if storage is None:
+        yield 0, size
+    else:
+        yield from storage.blocks(size)
+
+
+def read_npy_header(file):
+    if np.lib.format.read_magic(file) == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+    if fortran_order:
+        raise ValueError('fortran order array in {}'.format(getattr(file, 'name', file)))
+    return shape, dtype
+
+
+def write_npy(file, array, storage=None):
+    # np.save to an open file, by blocks for the mapped arrays
+    array = np.asarray(array)
+    np.lib.format.write_array_header_1_0(file, np.lib.format.header_data_from_array_1_0(array))
+    flat = array.reshape(-1)
+    for start, stop in blocks(len(flat), storage):
+        file.write(np.ascontiguousarray(flat[start:stop]).data)
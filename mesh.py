@@ -0,0 +1,582 @@
+import numpy as np
+import random
+
+# Status of the half-edges / vertices during a conquest
+FREE = 0
+CONQUERED = 1
+NULL = 2
+
+# Signs of the vertices
+PLUS = 1
+MINUS = -1
+
+# Slots drawn by Mesh.random_gate before it lists the live half-edges
+MAX_DRAWS = 64
+
+# Valences with a bucket of their vertices (the seeds of the cleaning and
+# sewing passes)
+INDEXED_VALENCES = (2, 3)
+
+# Arrays of the connectivity (the status arrays are reset by each conquest)
+CONNECTIVITY = ('origin', 'next', 'opposite', 'half_edge', 'valences', 'boundary',
+                'face_half_edge', 'face_of', 'generation', 'next_free_face')
+
+
+def split_non_manifold_vertices(faces, nb_vertices):
+    # Split the vertices whose faces form several chains (fans).
+    # The corner of vertex v in the face (v, a, b) is followed around v
+    # by the corner of v whose face starts with the edge (v, b)
+    faces = np.array(faces, dtype=np.int32).reshape(-1, 3)
+    corners = faces.reshape(-1)
+    if len(corners) == 0:
+        return faces, np.zeros(0, dtype=np.int32)
+    index = np.arange(len(corners))
+    face_start = index - index % 3
+    following = corners[face_start + (index + 1) % 3]
+    previous = corners[face_start + (index + 2) % 3]
+    label, other = corner_chains(corners, following, previous, nb_vertices)
+
+    # The other chains get new vertices
+    chains, new_vertex = np.unique(label[other], return_inverse=True)
+    duplicated = corners[chains]
+    corners[other] = nb_vertices + 1 + new_vertex
+    return faces, duplicated
+
+
+def corner_chains(corners, following, previous, nb_vertices):
+    # Chain of each corner (vertex, following and previous vertex in its
+    # face) and whether it is not the chain of the first corner of its
+    # vertex. All the corners of a vertex must be given, the chains are
+    # labelled by their position in the arrays
+    nb_corners = len(corners)
+    index = np.arange(nb_corners)
+
+    # Sort the corners by (vertex, following vertex)
+    keys = corners.astype(np.int64) * (nb_vertices + 1) + following
+    targets = corners.astype(np.int64) * (nb_vertices + 1) + previous
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    k = np.minimum(np.searchsorted(sorted_keys, targets), nb_corners - 1)
+    successor = np.where(sorted_keys[k] == targets, order[k], -1)
+
+    # Non-manifold edges end the chains
+    repeated = np.zeros(nb_corners, dtype=bool)
+    same = sorted_keys[1:] == sorted_keys[:-1]
+    repeated[order[1:][same]] = True
+    repeated[order[:-1][same]] = True
+    sorted_targets = np.sort(targets)
+    k = np.searchsorted(sorted_targets, targets)
+    shared = (k + 1 < nb_corners) & (sorted_targets[np.minimum(k + 1, nb_corners - 1)] == targets)
+    successor[repeated | shared] = -1
+    successor[repeated[successor] & (successor >= 0)] = -1
+
+    # Corners of each vertex
+    by_vertex = np.argsort(corners, kind='stable')
+    starts = np.flatnonzero(np.diff(corners[by_vertex], prepend=-1))
+    sizes = np.diff(np.append(starts, nb_corners))
+
+    # Label each chain by pointer jumping: the smallest corner of a closed
+    # chain, the last corner of an open one
+    end = successor < 0
+    jump = np.where(end, index, successor)
+    label = index.copy()
+    for _ in range(int(np.ceil(np.log2(sizes.max()))) + 1):
+        label = np.minimum(label, label[jump])
+        jump = jump[jump]
+    label = np.where(end[jump], jump, label)
+
+    # The chain of the first face of a vertex keeps the vertex
+    first = np.repeat(label[by_vertex[starts]], sizes)
+    other = np.empty(nb_corners, dtype=bool)
+    other[by_vertex] = label[by_vertex] != first
+    return label, other
+
+
+def match_half_edges(origin, destination, nb_vertices):
+    # Opposite of each half-edge (a, b): the half-edge (b, a), by position
+    # in the arrays (-1 for none). Only the symmetric matches are kept
+    # (non-manifold edges become borders), all the half-edges of an edge
+    # must be given
+    nb_half_edges = len(origin)
+    if nb_half_edges == 0:
+        return np.zeros(0, dtype=np.int64)
+    keys = origin.astype(np.int64) * (nb_vertices + 1) + destination
+    reverse = destination.astype(np.int64) * (nb_vertices + 1) + origin
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    k = np.minimum(np.searchsorted(sorted_keys, reverse), nb_half_edges - 1)
+    opposite = np.where(sorted_keys[k] == reverse, order[k], -1)
+    matched = opposite >= 0
+    matched[matched] = opposite[opposite[matched]] == np.flatnonzero(matched)
+    return np.where(matched, opposite, -1)
+
+
+def connected_components(faces, nb_vertices, labels=None):
+    # Component of each vertex (its smallest vertex, itself if it has no
+    # face) by union-find over the edges of the faces, all the edges being
+    # hooked at once then compressed by pointer jumping. With labels, only
+    # the edges between vertices of the same label join two vertices
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    first = faces.reshape(-1)
+    second = faces[:, [1, 2, 0]].reshape(-1)
+    if labels is not None:
+        same = labels[first] == labels[second]
+        first, second = first[same], second[same]
+    parent = np.arange(nb_vertices + 1)
+    while True:
+        # Hook the root of the larger vertex of each edge to the smaller root
+        root_1, root_2 = parent[first], parent[second]
+        joined = root_1 != root_2
+        if not np.any(joined):
+            return parent
+        root_1, root_2 = root_1[joined], root_2[joined]
+        np.minimum.at(parent, np.maximum(root_1, root_2), np.minimum(root_1, root_2))
+        while True:
+            grand_parent = parent[parent]
+            if np.array_equal(grand_parent, parent):
+                break
+            parent = grand_parent
+        first, second = first[joined], second[joined]
+
+
+class Mesh:
+    # Half-edge mesh stored in contiguous arrays.
+    # A half-edge h goes from origin[h] to origin[next[h]] and the third
+    # vertex of its face (the front vertex of the gate) is origin[next[next[h]]].
+    # Vertices are indexed from 1 as in the obj files.
+    # The faces keep their id while they live, a face id is reused (with
+    # the next generation) by a face created after its removal.
+
+    # Gates visited by a conquest between two calls of release_pages
+    # (0 for never)
+    release_gates = 0
+
+    def __init__(self, nb_vertices, nb_half_edges):
+        # Half-edges
+        self.origin = np.full(nb_half_edges, -1, dtype=np.int32)
+        self.next = np.full(nb_half_edges, -1, dtype=np.int32)
+        self.opposite = np.full(nb_half_edges, -1, dtype=np.int32)
+        self.faces_status = np.zeros(nb_half_edges, dtype=np.int8)
+        self.free_half_edge = -1
+
+        # Faces: one half-edge of each face (-1 for the free ids, chained
+        # by next_free_face), face of each half-edge, generation of each id
+        nb_faces = nb_half_edges // 3
+        self.face_half_edge = np.full(nb_faces, -1, dtype=np.int32)
+        self.face_of = np.full(nb_half_edges, -1, dtype=np.int32)
+        self.generation = np.zeros(nb_faces, dtype=np.int32)
+        self.next_free_face = np.full(nb_faces, -1, dtype=np.int32)
+        self.free_face = -1
+
+        # Vertices
+        self.half_edge = np.full(nb_vertices + 1, -1, dtype=np.int32)
+        self.valences = np.zeros(nb_vertices + 1, dtype=np.int32)
+        self.plus_minus = np.zeros(nb_vertices + 1, dtype=np.int8)
+        self.vertices_status = np.zeros(nb_vertices + 1, dtype=np.int8)
+        self.boundary = np.zeros(nb_vertices + 1, dtype=bool)
+
+        # Vertices of each indexed valence, and component of each vertex
+        # (built when first needed)
+        self.buckets = None
+        self.component = None
+
+    @classmethod
+    def from_faces(cls, faces, nb_vertices):
+        faces = np.asarray(faces, dtype=np.int32).reshape(-1, 3)
+        nb_half_edges = 3 * len(faces)
+        mesh = cls(nb_vertices, nb_half_edges)
+
+        # The three half-edges of a face are stored one after the other
+        half_edges = np.arange(nb_half_edges, dtype=np.int32)
+        mesh.origin[:] = faces.reshape(-1)
+        mesh.next[:] = half_edges - half_edges % 3 + (half_edges + 1) % 3
+        destination = mesh.origin[mesh.next]
+
+        # Match each half-edge (a, b) with the half-edge (b, a)
+        opposite = match_half_edges(mesh.origin, destination, nb_vertices)
+        mesh.opposite[:] = opposite
+
+        # Faces, numbered as in the list
+        mesh.face_half_edge[:] = half_edges[::3]
+        mesh.face_of[:] = half_edges // 3
+
+        # Vertices
+        mesh.half_edge[mesh.origin] = half_edges
+        mesh.valences[:] = np.bincount(mesh.origin, minlength=nb_vertices + 1)
+        border = opposite < 0
+        mesh.boundary[mesh.origin[border]] = True
+        mesh.boundary[destination[border]] = True
+        return mesh
+
+    @classmethod
+    def from_arrays(cls, arrays, free_half_edge=-1, free_face=-1, zeros=np.zeros):
+        # Mesh on the connectivity arrays (not copied), with new status arrays
+        # (created by zeros)
+        mesh = cls(0, 0)
+        for name in CONNECTIVITY:
+            setattr(mesh, name, arrays[name])
+        mesh.free_half_edge = free_half_edge
+        mesh.free_face = free_face
+        mesh.faces_status = zeros(len(mesh.origin), np.int8)
+        mesh.vertices_status = zeros(len(mesh.half_edge), np.int8)
+        mesh.plus_minus = zeros(len(mesh.half_edge), np.int8)
+        return mesh
+
+    def zeros(self, size, dtype):
+        # Array of zeros for a conquest (mapped for out_of_core.MappedMesh)
+        return np.zeros(size, dtype=dtype)
+
+    def release_pages(self):
+        # Drop the pages of the mapped arrays (out_of_core.MappedMesh)
+        pass
+
+    def reset_status(self):
+        self.faces_status[:] = FREE
+        self.vertices_status[:] = FREE
+        self.plus_minus[:] = 0
+
+    def allocate(self):
+        # Grow the arrays when the free-list is empty
+        if self.free_half_edge < 0:
+            size = len(self.origin)
+            new_size = max(2 * size, 16)
+            for name in ('origin', 'next', 'opposite', 'face_of'):
+                array = np.full(new_size, -1, dtype=np.int32)
+                array[:size] = getattr(self, name)
+                setattr(self, name, array)
+            status = np.zeros(new_size, dtype=np.int8)
+            status[:size] = self.faces_status
+            self.faces_status = status
+            self.next[size:-1] = np.arange(size + 1, new_size, dtype=np.int32)
+            self.free_half_edge = size
+
+        half_edge = self.free_half_edge
+        self.free_half_edge = int(self.next[half_edge])
+        self.faces_status[half_edge] = FREE
+        return half_edge
+
+    def allocate_face(self, half_edge):
+        # Give an id to the face of the half-edge, grow the arrays of the
+        # faces when their free-list is empty
+        if self.free_face < 0:
+            size = len(self.face_half_edge)
+            new_size = max(2 * size, 16)
+            for name, fill in (('face_half_edge', -1), ('generation', -1), ('next_free_face', -1)):
+                array = np.full(new_size, fill, dtype=np.int32)
+                array[:size] = getattr(self, name)
+                setattr(self, name, array)
+            self.next_free_face[size:-1] = np.arange(size + 1, new_size, dtype=np.int32)
+            self.free_face = size
+
+        face = self.free_face
+        self.free_face = int(self.next_free_face[face])
+        next = self.next
+        self.face_half_edge[face] = half_edge
+        self.face_of[[half_edge, next[half_edge], next[next[half_edge]]]] = face
+        self.generation[face] += 1
+        return face
+
+    def release_face(self, face):
+        self.face_half_edge[face] = -1
+        self.next_free_face[face] = self.free_face
+        self.free_face = int(face)
+
+    def face_keys(self, half_edges, created=False):
+        # Id and generation of the faces of the half-edges (generation << 32
+        # | id), the next generation for the faces about to be created
+        faces = self.face_of[half_edges]
+        generation = self.generation[faces].astype(np.int64) + created
+        return (generation << 32) | faces
+
+    def grow_vertices(self, nb_vertices):
+        # Make room for the vertices up to nb_vertices
+        size = len(self.half_edge)
+        if nb_vertices + 1 <= size:
+            return
+        new_size = max(nb_vertices + 1, 2 * size)
+        for name, fill in (('half_edge', -1), ('valences', 0), ('plus_minus', 0),
+                           ('vertices_status', 0), ('boundary', False)):
+            array = getattr(self, name)
+            grown = np.full(new_size, fill, dtype=array.dtype)
+            grown[:size] = array
+            setattr(self, name, grown)
+
+    def release(self, half_edge):
+        self.origin[half_edge] = -1
+        self.opposite[half_edge] = -1
+        self.face_of[half_edge] = -1
+        self.next[half_edge] = self.free_half_edge
+        self.free_half_edge = int(half_edge)
+
+    def vertices_of_valence(self, valence):
+        # Vertices of the valence not on a border (the removed vertices have
+        # valence 0), in increasing order. The indexed valences come from
+        # their bucket, filled at the first call and then kept up to date by
+        # the changes of valence (update_buckets)
+        if valence not in INDEXED_VALENCES:
+            return np.flatnonzero((self.valences == valence) & ~self.boundary)
+        if self.buckets is None:
+            inside = ~self.boundary
+            self.buckets = {indexed: set(np.flatnonzero((self.valences == indexed) & inside).tolist())
+                            for indexed in INDEXED_VALENCES}
+        return np.array(sorted(self.buckets[valence]), dtype=np.int64)
+
+    def update_buckets(self, vertices):
+        # Move the vertices whose valence changed to the bucket of their new
+        # valence
+        if self.buckets is None:
+            return
+        vertices = np.asarray(vertices).reshape(-1)
+        listed = vertices.tolist()
+        for bucket in self.buckets.values():
+            bucket.difference_update(listed)
+        valences = self.valences[vertices]
+        inside = ~self.boundary[vertices]
+        for valence, bucket in self.buckets.items():
+            bucket.update(vertices[(valences == valence) & inside].tolist())
+
+    def front(self, gate):
+        return self.origin[self.next[self.next[gate]]]
+
+    def random_gate(self):
+        # Uniform among the live half-edges: slots drawn until a live one
+        # (the first draw before any half-edge is freed, as choosing in the
+        # list of the live ones), the list is only built after MAX_DRAWS
+        # freed slots. -1 when no half-edge is live
+        size = len(self.origin)
+        if size == 0:
+            return -1
+        for _ in range(MAX_DRAWS):
+            half_edge = random.randrange(size)
+            if self.origin[half_edge] >= 0:
+                return half_edge
+        live = np.flatnonzero(self.origin >= 0)
+        return random.choice(live) if len(live) > 0 else -1
+
+    def find_half_edge(self, a, b, c=None):
+        # Half-edge from a to b (-1 if there is none), turning around a
+        # in both directions because of the borders. The third vertex c of
+        # its face chooses between the half-edges of a non-manifold edge
+        start = self.half_edge[a]
+        if start < 0:
+            return -1
+        origin = self.origin
+        next = self.next
+        current = start
+        while current >= 0:
+            if origin[next[current]] == b and (c is None or origin[next[next[current]]] == c):
+                return current
+            current = self.opposite[next[next[current]]]
+            if current == start:
+                return -1
+        current = self.opposite[start]
+        while current >= 0:
+            current = next[current]
+            if origin[next[current]] == b and (c is None or origin[next[next[current]]] == c):
+                return current
+            current = self.opposite[current]
+        return -1
+
+    def one_ring(self, half_edge):
+        # Outgoing half-edges of a vertex, counterclockwise from half_edge
+        ring = [half_edge]
+        current = self.opposite[self.next[self.next[half_edge]]]
+        while current != half_edge and current >= 0:
+            ring.append(current)
+            current = self.opposite[self.next[self.next[current]]]
+        return ring
+
+    def chain(self, ring):
+        return self.origin[self.next[ring]]
+
+    def retriangulate(self, spokes, rule):
+        # Remove the vertices and retriangulate their holes with the rule
+        # (see patches.Rule), one row of spokes per vertex, counterclockwise
+        # from the spoke to chain[0]. The patches must be disjoint, their
+        # half-edges are reused for the diagonals and the rest is released.
+        spokes = np.asarray(spokes, dtype=np.int64).reshape(-1, rule.valence)
+        if len(spokes) == 0:
+            return
+        origin = self.origin
+        next = self.next
+        border = next[spokes]
+        incoming = next[border]
+        chain = origin[border]
+        vertex = origin[spokes[:, 0]]
+
+        faces = self.face_of[spokes]
+        released = np.concatenate([spokes, incoming], axis=1)
+        nb_diagonals = len(rule.diagonal_origins)
+        diagonals = released[:, :nb_diagonals]
+        rest = released[:, nb_diagonals:].reshape(-1)
+        origin[rest] = -1
+        self.opposite[rest] = -1
+        self.face_of[rest] = -1
+        next[rest[:-1]] = rest[1:]
+        next[rest[-1]] = self.free_half_edge
+        self.free_half_edge = int(rest[0])
+
+        # The new faces take the ids of the faces of the first spokes
+        nb_triangles = len(rule.triangles)
+        kept = faces[:, :nb_triangles]
+        dropped = faces[:, nb_triangles:].reshape(-1)
+        self.face_half_edge[dropped] = -1
+        self.next_free_face[dropped[:-1]] = dropped[1:]
+        self.next_free_face[dropped[-1]] = self.free_face
+        self.free_face = int(dropped[0])
+
+        origin[diagonals] = chain[:, rule.diagonal_origins]
+        self.opposite[diagonals] = diagonals[:, rule.twins]
+        self.faces_status[diagonals] = FREE
+        triangles = np.concatenate([border, diagonals], axis=1)[:, rule.edges]
+        next[triangles] = triangles[:, :, [1, 2, 0]]
+        self.face_of[triangles] = kept[:, :, None]
+        self.face_half_edge[kept] = triangles[:, :, 0]
+        self.generation[kept] += 1
+
+        np.add.at(self.valences, chain, rule.valence_delta)
+        self.half_edge[chain] = border
+        self.half_edge[vertex] = -1
+        self.valences[vertex] = 0
+        self.update_buckets(np.concatenate([chain.reshape(-1), vertex]))
+
+    def insert_vertex(self, vertex, border, diagonals):
+        # Inverse of retriangulate: remove the diagonals of the hole
+        # and connect the vertex to the border, return the spokes
+        # (spokes[i] goes from the vertex to the origin of border[i])
+        for face in set(self.face_of[border].tolist()):
+            self.release_face(face)
+        for diagonal in diagonals:
+            self.valences[self.origin[diagonal]] -= 1
+            self.release(diagonal)
+        size = len(border)
+        chain = self.origin[border]
+        spokes = [self.allocate() for _ in range(size)]
+        incoming = [self.allocate() for _ in range(size)]
+        origin = self.origin
+        next = self.next
+        opposite = self.opposite
+        for i in range(size):
+            spoke, edge, back = spokes[i], border[i], incoming[i]
+            following = spokes[(i + 1) % size]
+            origin[spoke] = vertex
+            origin[back] = chain[(i + 1) % size]
+            next[spoke] = edge
+            next[edge] = back
+            next[back] = spoke
+            opposite[back] = following
+            opposite[following] = back
+            self.half_edge[chain[i]] = edge
+        for spoke in spokes:
+            self.allocate_face(spoke)
+        self.valences[chain] += 1
+        self.half_edge[vertex] = spokes[0]
+        self.valences[vertex] = size
+        self.update_buckets(np.append(chain, vertex))
+        self.component = None
+        return spokes
+
+    def unsew(self, vertex, half_edge):
+        # Inverse of sew: split the edge of half_edge (from chain[0] to
+        # chain[1]) with two faces around the vertex, return their spokes
+        outer_1 = half_edge
+        outer_0 = self.opposite[outer_1]
+        first, border_0, back_0, second, border_1, back_1 = [self.allocate() for _ in range(6)]
+        origin = self.origin
+        next = self.next
+        opposite = self.opposite
+        chain = origin[[outer_1, outer_0]]
+        origin[[first, border_0, back_0]] = vertex, chain[0], chain[1]
+        origin[[second, border_1, back_1]] = vertex, chain[1], chain[0]
+        for a, b, c in ((first, border_0, back_0), (second, border_1, back_1)):
+            next[a] = b
+            next[b] = c
+            next[c] = a
+        for a, b in ((border_0, outer_0), (border_1, outer_1), (first, back_1), (second, back_0)):
+            opposite[a] = b
+            opposite[b] = a
+        self.allocate_face(first)
+        self.allocate_face(second)
+        self.valences[chain] += 2
+        self.half_edge[vertex] = first
+        self.valences[vertex] = 2
+        self.update_buckets(np.append(chain, vertex))
+        self.component = None
+        return first, second
+
+    def sew(self, vertex):
+        # Remove a vertex of valence 2 and glue the two faces around it
+        ring = self.one_ring(self.half_edge[vertex])
+        if len(ring) != 2:
+            return None
+        first, second = ring
+        border_0 = self.next[first]
+        border_1 = self.next[second]
+        outer_0 = self.opposite[border_0]
+        outer_1 = self.opposite[border_1]
+        if outer_0 < 0 or outer_1 < 0 or outer_0 == border_1:
+            return None
+
+        chain = self.origin[[border_0, border_1]]
+        self.opposite[outer_0] = outer_1
+        self.opposite[outer_1] = outer_0
+        self.valences[chain] -= 2
+        self.half_edge[chain[0]] = outer_1
+        self.half_edge[chain[1]] = outer_0
+        self.release_face(self.face_of[first])
+        self.release_face(self.face_of[second])
+        for half_edge in (first, border_0, self.next[border_0],
+                          second, border_1, self.next[border_1]):
+            self.release(half_edge)
+        self.half_edge[vertex] = -1
+        self.valences[vertex] = 0
+        self.update_buckets(np.append(chain, vertex))
+        return chain, outer_0, outer_1
+
+    def nb_faces(self):
+        return np.count_nonzero(self.face_half_edge >= 0)
+
+    def components(self, labels=None):
+        # Connected component of each vertex (see connected_components). The
+        # components of the mesh itself come from component_ids, only their
+        # smallest vertex is found again
+        if labels is not None:
+            return connected_components(self.faces(), len(self.half_edge) - 1, labels)
+        component = self.component_ids()
+        alive = np.flatnonzero(self.half_edge >= 0)
+        ids, first = np.unique(component[alive], return_index=True)
+        smallest = np.zeros(len(component), dtype=np.int64)
+        smallest[ids] = alive[first]
+        labels = np.arange(len(self.half_edge))
+        labels[alive] = smallest[component[alive]]
+        return labels
+
+    def component_ids(self):
+        # Id of the component of each vertex, the same for the vertices of a
+        # component. Computed once: the retriangulations and the sewing keep
+        # the vertices of a component connected (the insertions of the
+        # decoder compute it again)
+        if self.component is None or len(self.component) != len(self.half_edge):
+            self.component = connected_components(self.faces(), len(self.half_edge) - 1)
+        return self.component
+
+    def nb_components(self):
+        return len(np.unique(self.component_ids()[self.half_edge >= 0]))
+
+    def face_half_edges(self, start=0, stop=None):
+        # One row per face, by id (of the ids from start to stop)
+        half_edges = self.face_half_edge[start:stop]
+        half_edges = half_edges[half_edges >= 0]
+        next = self.next[half_edges]
+        return np.stack([half_edges, next, self.next[next]], axis=1)
+
+    def faces(self):
+        return self.origin[self.face_half_edges()]
+
+    def corner_opposites(self):
+        # Opposites of the half-edges of faces(), numbered as in from_faces
+        # (3 * face + corner, -1 on the borders)
+        half_edges = self.face_half_edges().reshape(-1)
+        corner = np.full(len(self.origin) + 1, -1, dtype=np.int64)
+        corner[half_edges] = np.arange(len(half_edges))
+        return corner[self.opposite[half_edges]]
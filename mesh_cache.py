@@ -0,0 +1,93 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from mesh import CONNECTIVITY
+from mapped_arrays import write_npy
+
+# Changes with the loader or the preprocessing (load_obj,
+# split_non_manifold_vertices, Mesh.from_faces), the previous entries are
+# then never found again and end up evicted
+VERSION = 2
+MAX_BYTES = 1 << 30
+BLOCK_SIZE = 1 << 24
+ARRAYS = CONNECTIVITY + ('vertices', 'faces', 'duplicated')
+
+
+class MeshCache:
+    # Preprocessed meshes on disk, one directory of npy files per content of
+    # obj file, mapped copy-on-write when loaded (the conquests modify the
+    # arrays, never the files). The least recently used entries are removed
+    # when the cache gets larger than max_bytes.
+
+    def __init__(self, directory, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, obj_path):
+        digest = hashlib.blake2b(str(VERSION).encode())
+        with open(obj_path, 'rb') as file:
+            while True:
+                data = file.read(BLOCK_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+        return digest.hexdigest()[:32]
+
+    def load(self, key):
+        # Arrays of the entry, None if it is not in the cache
+        paths = self.paths(key)
+        if paths is None:
+            return None
+        try:
+            return {name: np.asarray(np.load(path, mmap_mode='c')) for name, path in paths.items()}
+        except (OSError, ValueError):
+            return None
+
+    def paths(self, key):
+        # Npy file of each array of the entry, None if it is not in the cache
+        entry = os.path.join(self.directory, key)
+        paths = {name: os.path.join(entry, name + '.npy') for name in ARRAYS}
+        try:
+            os.utime(entry)
+        except OSError:
+            return None
+        if not all(os.path.exists(path) for path in paths.values()):
+            return None
+        return paths
+
+    def store(self, key, arrays, storage=None):
+        # The entry is written in a temporary directory then renamed, the
+        # processes sharing the cache never see it half written (the mapped
+        # arrays of the storage are written by blocks)
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+        for name in ARRAYS:
+            with open(os.path.join(temporary, name + '.npy'), 'wb') as file:
+                write_npy(file, arrays[name], storage)
+        try:
+            os.rename(temporary, os.path.join(self.directory, key))
+        except OSError:
+            # Stored by another process in the meantime
+            shutil.rmtree(temporary, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            try:
+                size = sum(file.stat().st_size for file in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries)[:-1]:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
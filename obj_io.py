@@ -0,0 +1,159 @@
+import numpy as np
+
+BLOCK_SIZE = 1 << 26
+
+WHITESPACE = np.zeros(256, dtype=bool)
+WHITESPACE[[9, 10, 11, 12, 13, 32]] = True
+
+
+def load_obj(obj_path, block_size=BLOCK_SIZE):
+    vertices = []
+    faces = []
+    for block_vertices, block_faces in obj_blocks(obj_path, block_size):
+        vertices.append(block_vertices)
+        faces.append(block_faces)
+    vertices = np.concatenate(vertices) if vertices else np.zeros((0, 3))
+    faces = np.concatenate(faces) if faces else np.zeros((0, 3), dtype=np.int32)
+    return vertices, faces
+
+
+def obj_blocks(obj_path, block_size=BLOCK_SIZE):
+    # Vertices and faces of the obj file read by large blocks cut on line ends
+    nb_vertices = 0
+    with open(obj_path, 'rb') as file:
+        rest = b''
+        while True:
+            data = file.read(block_size)
+            if not data:
+                block, rest = rest, b''
+            else:
+                block = rest + data
+                cut = block.rfind(b'\n') + 1
+                block, rest = block[:cut], block[cut:]
+            if block:
+                block_vertices, block_faces = parse_obj_block(block, nb_vertices)
+                yield block_vertices, block_faces
+                nb_vertices += len(block_vertices)
+            if not data:
+                break
+
+
+def parse_obj_block(block, nb_vertices=0):
+    # Parse the 'v' and 'f' records of a block of complete lines,
+    # nb_vertices is the number of vertices read in the previous blocks
+    buffer = np.frombuffer(block + b'\n', dtype=np.uint8)
+
+    # Split the lines
+    ends = np.flatnonzero(buffer == ord('\n'))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    lengths = ends - starts
+    first = buffer[starts]
+    second = buffer[np.minimum(starts + 1, len(buffer) - 1)]
+    separated = (lengths > 1) & WHITESPACE[second]
+
+    # Only keep 'v x y z' and 'f a b c ...' (not 'vn', 'vt', ...)
+    is_vertex = separated & (first == ord('v'))
+    is_face = separated & (first == ord('f'))
+
+    # Vertices
+    text, tokens = record_tokens(buffer, starts, ends, is_vertex)
+    coordinates = np.fromstring(text, dtype=np.float64, sep=' ')
+    vertices = first_tokens(coordinates, tokens, 3)
+
+    # Faces, keep the vertex index of 'a/b/c' records
+    text, tokens = record_tokens(buffer, starts, ends, is_face, attributes=True)
+    indices = np.fromstring(text, dtype=np.int64, sep=' ')
+
+    # Negative indices are relative to the last vertex read
+    declared = nb_vertices + np.cumsum(is_vertex)[is_face]
+    declared = np.repeat(declared, tokens)
+    indices = np.where(indices < 0, declared + indices + 1, indices)
+
+    # Triangulate the polygons as fans
+    offsets = np.cumsum(tokens) - tokens
+    nb_triangles = np.maximum(tokens - 2, 0)
+    offsets = np.repeat(offsets, nb_triangles)
+    corner = np.arange(len(offsets)) - np.repeat(np.cumsum(nb_triangles) - nb_triangles, nb_triangles) + 1
+    faces = np.stack([indices[offsets], indices[offsets + corner],
+                      indices[offsets + corner + 1]], axis=1).astype(np.int32)
+    return vertices, faces
+
+
+def record_tokens(buffer, starts, ends, selected, attributes=False, keyword_length=1):
+    # Gather the selected lines (without their keyword) in one text
+    # and count the tokens of each line
+    line = np.repeat(np.arange(len(starts)), ends - starts + 1)
+    mask = selected[line]
+    keyword = np.zeros(len(buffer), dtype=bool)
+    for k in range(keyword_length):
+        keyword[starts[selected] + k] = True
+    mask &= ~keyword
+    text = buffer[mask]
+    line = line[mask]
+
+    space = WHITESPACE[text]
+    token_start = ~space
+    token_start[1:] &= space[:-1]
+
+    if attributes:
+        # Blank everything after the first '/' of each token
+        slashes = np.cumsum(text == ord('/'))
+        token = np.cumsum(token_start) - 1
+        before = (slashes - (text == ord('/')))[token_start]
+        attribute = np.zeros(len(text), dtype=bool)
+        inside = token >= 0
+        attribute[inside] = slashes[inside] > before[token[inside]]
+        text = np.where(attribute, ord(' '), text).astype(np.uint8)
+
+    tokens = np.bincount(line[token_start], minlength=len(starts))[selected]
+    return text.tobytes(), tokens
+
+
+def first_tokens(values, tokens, size):
+    # Keep the first size values of each record
+    if np.all(tokens == size):
+        return values.reshape(-1, size)
+    offsets = np.cumsum(tokens) - tokens
+    return values[offsets[:, None] + np.arange(size)]
+
+
+def save_obj(path, vertices, faces, block_size=BLOCK_SIZE):
+    save_obj_blocks(path, [vertices], [faces], block_size)
+
+
+def save_obj_blocks(path, vertex_blocks, face_blocks, block_size=BLOCK_SIZE):
+    # Write the vertices and the faces (numbered from 1), given as iterables
+    # of arrays, by blocks of lines formatted at once (the coordinates as
+    # repr of the floats)
+    rows = max(block_size // 64, 1)
+    with open(path, 'w', buffering=1 << 20) as file:
+        for vertices in vertex_blocks:
+            for start in range(0, len(vertices), rows):
+                block = vertices[start:start + rows]
+                file.write(('v {} {} {}\n' * len(block)).format(*block.reshape(-1).tolist()))
+        for faces in face_blocks:
+            for start in range(0, len(faces), rows):
+                block = faces[start:start + rows]
+                file.write(('f {} {} {}\n' * len(block)).format(*block.reshape(-1).tolist()))
+
+
+def save_ply(path, vertices, faces):
+    save_ply_blocks(path, len(vertices), len(faces), [vertices], [faces])
+
+
+def save_ply_blocks(path, nb_vertices, nb_faces, vertex_blocks, face_blocks):
+    # Binary little endian ply, double coordinates and faces numbered from 0
+    # (given as iterables of arrays)
+    header = ('ply\nformat binary_little_endian 1.0\n'
+              'element vertex {}\nproperty double x\nproperty double y\nproperty double z\n'
+              'element face {}\nproperty list uchar int vertex_indices\nend_header\n'
+              ).format(nb_vertices, nb_faces)
+    with open(path, 'wb') as file:
+        file.write(header.encode('ascii'))
+        for vertices in vertex_blocks:
+            np.ascontiguousarray(vertices, dtype='<f8').tofile(file)
+        for faces in face_blocks:
+            records = np.zeros(len(faces), dtype=[('count', 'u1'), ('indices', '<i4', 3)])
+            records['count'] = 3
+            records['indices'] = faces - 1
+            records.tofile(file)
@@ -0,0 +1,285 @@
+from array import array
+
+import numpy as np
+
+from mapped_arrays import blocks
+
+# Kinds of records
+VERTEX = 0
+FACE = 1
+DELETED_FACE = 2
+
+# Faces carry the key of the face of the mesh (generation << 32 | id,
+# see Mesh.face_keys): a deleted face is the face recorded with its key
+RECORD = np.dtype([('kind', np.int8), ('a', np.int32), ('b', np.int32), ('c', np.int32),
+                   ('face', np.int64)])
+
+# Kinds of layers
+BASE = 0
+DECIMATING = 1
+CLEANING = 2
+SEWING = 3
+LAYER_NAMES = {BASE: 'base', DECIMATING: 'decimating', CLEANING: 'cleaning', SEWING: 'sewing'}
+
+# Records of the current layer kept in memory by a spooled writer
+SPILL_SIZE = 1 << 16
+
+# Codes of the decimating conquest: null patch, valence of the removed vertex
+# (valence - 2), or gate leaving the region of the conquest
+NULL_PATCH = 0
+STOP = 5
+
+
+class RecordNumbers:
+    # Numbers of the records in the order of the obja file, by passes over
+    # the blocks of the writer (obja.blocks) into arrays of the storage:
+    # obja_vertex[vertex] is the number of a vertex, and deleted gives the
+    # number of the face each deleted face of a block deletes (a deleted
+    # face that matches no face is an error of the conquests). Each (id, generation) of the faces gets an entry of
+    # number, the generations of an id follow each other
+
+    def __init__(self, obja, nb_vertices, block_size=None, storage=None):
+        zeros = np.zeros if storage is None else storage.zeros
+        self.obja_vertex = zeros(nb_vertices + 1, np.int64)
+        nb_added = 0
+        max_id = -1
+        for index, records in obja.blocks(block_size, storage):
+            added = records['a'][records['kind'] == VERTEX]
+            self.obja_vertex[added] = np.arange(nb_added + 1, nb_added + len(added) + 1)
+            nb_added += len(added)
+            keys = records['face'][records['kind'] != VERTEX]
+            max_id = max(max_id, int((keys & 0xffffffff).max(initial=-1)))
+
+        # Last generation of each id, then its first entry
+        self.first_entry = zeros(max_id + 1, np.int64)
+        for index, records in obja.blocks(block_size, storage):
+            keys = records['face'][records['kind'] != VERTEX]
+            np.maximum.at(self.first_entry, keys & 0xffffffff, keys >> 32)
+        nb_entries = 0
+        for start, stop in blocks(max_id + 1, storage):
+            sizes = self.first_entry[start:stop] + 1
+            self.first_entry[start:stop] = nb_entries + np.cumsum(sizes) - sizes
+            nb_entries += int(np.sum(sizes))
+
+        # Number the faces in the order of the obja file
+        self.number = zeros(nb_entries, np.int64)
+        nb_faces = 0
+        for index, records in obja.blocks(block_size, storage):
+            faces = records[records['kind'] == FACE]
+            self.number[self.entries(faces)] = np.arange(nb_faces + 1, nb_faces + len(faces) + 1)
+            nb_faces += len(faces)
+
+    def entries(self, records):
+        keys = records['face']
+        return self.first_entry[keys & 0xffffffff] + (keys >> 32)
+
+    def deleted(self, records):
+        is_deleted = records['kind'] == DELETED_FACE
+        deleted = np.zeros(len(records), dtype=np.int64)
+        deleted[is_deleted] = self.number[self.entries(records[is_deleted])]
+        unmatched = np.flatnonzero(is_deleted & (deleted <= 0))
+        if len(unmatched) > 0:
+            key = int(records['face'][unmatched[0]])
+            raise ValueError('{} deleted faces match no face (face {} generation {})'.format(
+                len(unmatched), key & 0xffffffff, key >> 32))
+        return deleted
+
+
+class ObjaWriter:
+    # Operations of the obja file grouped by layer (one conquest = one layer):
+    # vertex additions, face additions and face deletions, with the vertices
+    # given by their index in the obj file. The decoder starts from the last
+    # layer, so the layers come out in reverse order. The layers can be
+    # streamed to a spool file instead of being kept in memory, the current
+    # one every SPILL_SIZE records.
+    # The decimating layers also keep the codes of their conquest
+    # (one per visited gate) and their first gate (left, right, and third
+    # vertex of its face in the coarse mesh), the sewing layers the third
+    # vertex of the face of each sewed edge as codes, and the base layer the
+    # twins of the half-edges of its non-manifold edges. The codes are
+    # spooled with the records (to a file next to the spool file).
+
+    def __init__(self, spool_path=None):
+        self.layers = []
+        self.layer_kinds = []
+        self.codes = []
+        self.first_gates = []
+        self.base_twins = np.zeros((0, 2), dtype=np.int64)
+        self.kinds = None
+        self.indices = None
+        self.faces = None
+        self.spool = None
+        self.code_spool = None
+        self.offsets = []
+        self.code_offsets = []
+        self.kind_counts = np.zeros(3, dtype=np.int64)
+        self.layer_counts = []
+        if spool_path is not None:
+            self.spool = open(spool_path, 'w+b')
+            self.code_spool = open(spool_path + '.codes', 'w+b')
+
+    def new_layer(self, kind=BASE):
+        self.flush_layer()
+        self.kinds = array('b')
+        self.indices = array('i')
+        self.faces = array('q')
+        self.layer_kinds.append(kind)
+        self.codes.append(array('i'))
+        self.first_gates.append((0, 0, 0))
+        self.layer_counts.append(np.zeros(3, dtype=np.int64))
+        if self.spool is not None:
+            self.offsets.append([self.spool.tell(), 0])
+            self.code_offsets.append([self.code_spool.tell(), 0])
+
+    def set_first_gate(self, left, right, front):
+        self.first_gates[-1] = (left, right, front)
+
+    def add_code(self, code):
+        self.codes[-1].append(code)
+        if self.spool is not None and len(self.codes[-1]) >= SPILL_SIZE:
+            self.spill()
+
+    def add_codes(self, codes):
+        self.codes[-1].frombytes(np.asarray(codes, dtype=np.int32).tobytes())
+        if self.spool is not None and len(self.codes[-1]) >= SPILL_SIZE:
+            self.spill()
+
+    def add_records(self, records):
+        # Append records (as returned by layer) to the current layer
+        self.kinds.frombytes(records['kind'].astype(np.int8).tobytes())
+        indices = np.stack([records['a'], records['b'], records['c']], axis=1)
+        self.indices.frombytes(indices.astype(np.int32).tobytes())
+        self.faces.frombytes(records['face'].astype(np.int64).tobytes())
+        if self.spool is not None and len(self.kinds) >= SPILL_SIZE:
+            self.spill()
+
+    def add_vertex(self, vertex):
+        if self.spool is not None and len(self.kinds) >= SPILL_SIZE:
+            self.spill()
+        self.kinds.append(VERTEX)
+        self.indices.extend((vertex, 0, 0))
+        self.faces.append(0)
+
+    def add_face(self, a, b, c, face):
+        self.kinds.append(FACE)
+        self.indices.extend((a, b, c))
+        self.faces.append(face)
+
+    def delete_face(self, a, b, c, face):
+        self.kinds.append(DELETED_FACE)
+        self.indices.extend((a, b, c))
+        self.faces.append(face)
+
+    def take_records(self):
+        # Records of the current layer added since the last call
+        layer = np.zeros(len(self.kinds), dtype=RECORD)
+        layer['kind'] = np.frombuffer(self.kinds, dtype=np.int8)
+        indices = np.frombuffer(self.indices, dtype=np.int32).reshape(-1, 3)
+        layer['a'], layer['b'], layer['c'] = indices.T
+        layer['face'] = np.frombuffer(self.faces, dtype=np.int64)
+        counts = np.bincount(layer['kind'], minlength=3)
+        self.kind_counts += counts
+        self.layer_counts[-1] += counts
+        self.kinds = array('b')
+        self.indices = array('i')
+        self.faces = array('q')
+        return layer
+
+    def spill(self):
+        # Append the records and the codes of the current layer so far to
+        # the spool files
+        layer = self.take_records()
+        layer.tofile(self.spool)
+        self.offsets[-1][1] += len(layer)
+        self.code_spool.write(self.codes[-1].tobytes())
+        self.code_offsets[-1][1] += len(self.codes[-1])
+        self.codes[-1] = array('i')
+
+    def flush_layer(self):
+        if self.kinds is None:
+            return
+        if self.spool is None:
+            self.layers.append(self.take_records())
+        else:
+            self.spill()
+        self.kinds = None
+        self.indices = None
+        self.faces = None
+
+    def layer(self, index):
+        return self.layer_block(index, 0, self.layer_size(index))
+
+    def layer_size(self, index):
+        self.flush_layer()
+        if self.spool is None:
+            return len(self.layers[index])
+        return self.offsets[index][1]
+
+    def layer_block(self, index, start, stop):
+        # Records of a layer from start to stop
+        self.flush_layer()
+        if self.spool is None:
+            return self.layers[index][start:stop]
+        offset, count = self.offsets[index]
+        stop = min(stop, count)
+        self.spool.flush()
+        return np.fromfile(self.spool.name, dtype=RECORD, count=max(stop - start, 0),
+                           offset=offset + start * RECORD.itemsize)
+
+    def layer_blocks(self, index, block_size=None):
+        # Records of a layer by blocks of at most block_size records (the
+        # whole layer for None), cut before a vertex record: the faces added
+        # around a vertex follow it, they stay in its block
+        size = self.layer_size(index)
+        start = 0
+        while start < size:
+            records = self.layer_block(index, start, size if block_size is None
+                                      else start + block_size)
+            if start + len(records) < size:
+                vertices = np.flatnonzero(records['kind'] == VERTEX)
+                if len(vertices) > 0 and vertices[-1] > 0:
+                    records = records[:vertices[-1]]
+            yield records
+            start += len(records)
+
+    def blocks(self, block_size=None, storage=None):
+        # Records of all the layers, last layer first, by blocks of
+        # layer_blocks: (index of the layer, records), the pages of the
+        # mapped arrays of the storage released after each block
+        for index in reversed(range(len(self.layer_kinds))):
+            for records in self.layer_blocks(index, block_size):
+                yield index, records
+                if storage is not None:
+                    storage.release()
+
+    def layer_codes(self, index, start=0, stop=None):
+        # Codes of a layer (from start to stop)
+        self.flush_layer()
+        if self.spool is None:
+            return np.frombuffer(self.codes[index], dtype=np.int32)[start:stop].copy()
+        offset, count = self.code_offsets[index]
+        stop = count if stop is None else min(stop, count)
+        self.code_spool.flush()
+        return np.fromfile(self.code_spool.name, dtype=np.int32, count=max(stop - start, 0),
+                           offset=offset + 4 * start)
+
+    def code_blocks(self, index, block_size=None):
+        # Codes of a layer by blocks of block_size codes (all of them for
+        # None)
+        self.flush_layer()
+        size = len(self.codes[index]) if self.spool is None else self.code_offsets[index][1]
+        step = size if block_size is None else block_size
+        for start in range(0, size, max(step, 1)):
+            yield self.layer_codes(index, start, start + step)
+
+    def counts(self):
+        # Number of vertex, face and deleted face records of all the layers
+        self.flush_layer()
+        return self.kind_counts.copy()
+
+    def close(self):
+        if self.spool is not None:
+            self.spool.close()
+            self.code_spool.close()
+            self.spool = None
+            self.code_spool = None
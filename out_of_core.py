@@ -0,0 +1,550 @@
+import os
+import random
+import resource
+
+import numpy as np
+
+from mesh import Mesh, CONNECTIVITY, FREE, corner_chains, match_half_edges
+from conquest_queue import ConquestQueue
+from obj_io import obj_blocks, save_obj_blocks, save_ply_blocks
+from obja_writer import RECORD, VERTEX, FACE
+from parallel import MIN_REGION_VERTICES
+from tools import separate_conquest, merge_conquests
+
+# Resident memory of the mesh arrays during a decimating conquest, the mesh
+# is conquered by chunks of about this size
+MEMORY = 1 << 30
+# Memory of the parsing of the obj file per byte parsed at once
+# (obj_io.parse_obj_block)
+PARSE_BYTES = 32
+MIN_PARSE_BLOCK = 1 << 16
+# Memory of the pages a conquest touches per gate (at most), the pages are
+# released every memory / GATE_BYTES gates
+GATE_BYTES = 1 << 16
+
+
+def mapped_mesh(storage, mesh, active_vertices, vertices, faces):
+    # Mesh, active vertices, vertices and faces on mapped arrays
+    arrays = {name: storage.map(getattr(mesh, name)) for name in CONNECTIVITY}
+    mesh = MappedMesh.from_arrays(arrays, storage, mesh.free_half_edge, mesh.free_face)
+    active_vertices = ActiveVertices(storage, len(mesh.half_edge), np.fromiter(
+        active_vertices, dtype=np.int64, count=len(active_vertices)))
+    return mesh, active_vertices, storage.map(vertices), storage.map(faces)
+
+
+def mapped_preprocessing(obj_path, storage, cache=None, instrumentation=None):
+    # tools.preprocessing into mapped arrays without the whole mesh in
+    # memory: the obj file is parsed by blocks and its arrays are built by
+    # ranges of vertices (the same arrays as in memory), a cached mesh is
+    # copied by blocks
+    arrays = None
+    if cache is not None:
+        key = cache.key(obj_path)
+        paths = cache.paths(key)
+        if paths is not None:
+            try:
+                arrays = {name: storage.load(path) for name, path in paths.items()}
+            except (OSError, ValueError):
+                arrays = None
+    if arrays is None:
+        arrays = preprocessed_arrays(obj_path, storage)
+        if cache is not None:
+            cache.store(key, arrays, storage)
+
+    if instrumentation is not None:
+        instrumentation.add('preprocessing.duplicated', len(arrays['duplicated']))
+    mesh = MappedMesh.from_arrays(arrays, storage)
+    active_vertices = ActiveVertices(storage, len(mesh.half_edge))
+    return mesh, active_vertices, arrays['vertices'], arrays['faces']
+
+
+def preprocessed_arrays(obj_path, storage):
+    # Vertices and faces of the obj file written to files block by block
+    paths = [os.path.join(storage.directory, name) for name in ('vertices', 'faces')]
+    nb_vertices = 0
+    nb_faces = 0
+    block_size = max(storage.memory // PARSE_BYTES, MIN_PARSE_BLOCK)
+    with open(paths[0], 'wb') as vertex_file, open(paths[1], 'wb') as face_file:
+        for block_vertices, block_faces in obj_blocks(obj_path, block_size):
+            vertex_file.write(np.ascontiguousarray(block_vertices, dtype=np.float64).data)
+            face_file.write(np.ascontiguousarray(block_faces, dtype=np.int32).data)
+            nb_vertices += len(block_vertices)
+            nb_faces += len(block_faces)
+    with open(paths[1], 'rb') as file:
+        faces = storage.read(file, (nb_faces, 3), np.int32)
+
+    # Split the vertices with multiple chains of faces, the new vertices
+    # are appended to the file
+    duplicated = split_mapped_vertices(storage, faces, nb_vertices)
+    if len(duplicated) > 0:
+        source = np.memmap(paths[0], dtype=np.float64, mode='r', shape=(nb_vertices, 3))
+        copies = source[duplicated - 1]
+        del source
+        with open(paths[0], 'ab') as file:
+            file.write(copies.data)
+    with open(paths[0], 'rb') as file:
+        vertices = storage.read(file, (nb_vertices + len(duplicated), 3), np.float64)
+    for path in paths:
+        os.remove(path)
+
+    arrays = mapped_connectivity(storage, faces, len(vertices))
+    arrays.update(vertices=vertices, faces=faces, duplicated=duplicated)
+    return arrays
+
+
+def vertex_ranges(storage, nb_entries, nb_vertices):
+    # Ranges of vertices of about one block of entries each
+    nb_ranges = -(-nb_entries // storage.block_size)
+    bounds = np.linspace(0, nb_vertices + 1, nb_ranges + 1).astype(np.int64)
+    return zip(bounds[:-1].tolist(), bounds[1:].tolist())
+
+
+def split_mapped_vertices(storage, faces, nb_vertices):
+    # mesh.split_non_manifold_vertices on mapped faces (changed in place):
+    # the corners of each range of vertices are gathered and their chains
+    # labelled as in memory, the new vertices are numbered at the end
+    others = []
+    labels = []
+    for low, high in vertex_ranges(storage, 3 * len(faces), nb_vertices):
+        gathered = []
+        for start, stop in storage.blocks(len(faces)):
+            block = faces[start:stop]
+            corners = block.reshape(-1)
+            inside = np.flatnonzero((corners >= low) & (corners < high))
+            row = inside // 3
+            column = inside % 3
+            gathered.append((3 * start + inside, corners[inside], block[row, (column + 1) % 3],
+                             block[row, (column + 2) % 3]))
+        index, corners, following, previous = (np.concatenate(arrays) for arrays in zip(*gathered))
+        if len(index) == 0:
+            continue
+        label, other = corner_chains(corners, following, previous, nb_vertices)
+        others.append(index[other])
+        labels.append(index[label[other]])
+
+    corners = faces.reshape(-1)
+    if len(others) == 0:
+        return np.zeros(0, dtype=np.int32)
+    chains, new_vertex = np.unique(np.concatenate(labels), return_inverse=True)
+    duplicated = corners[chains]
+    corners[np.concatenate(others)] = nb_vertices + 1 + new_vertex
+    storage.release()
+    return duplicated
+
+
+def mapped_connectivity(storage, faces, nb_vertices):
+    # Arrays of Mesh.from_faces on mapped faces, the half-edges being
+    # matched by ranges of the smaller vertex of their edge
+    nb_faces = len(faces)
+    nb_half_edges = 3 * nb_faces
+    arrays = {
+        'origin': storage.zeros(nb_half_edges, np.int32),
+        'next': storage.zeros(nb_half_edges, np.int32),
+        'opposite': storage.full(nb_half_edges, -1, np.int32),
+        'half_edge': storage.full(nb_vertices + 1, -1, np.int32),
+        'valences': storage.zeros(nb_vertices + 1, np.int32),
+        'boundary': storage.zeros(nb_vertices + 1, bool),
+        'face_half_edge': storage.zeros(nb_faces, np.int32),
+        'face_of': storage.zeros(nb_half_edges, np.int32),
+        'generation': storage.zeros(nb_faces, np.int32),
+        'next_free_face': storage.full(nb_faces, -1, np.int32),
+    }
+    origin = arrays['origin']
+    half_edge = arrays['half_edge']
+    valences = arrays['valences']
+    for start, stop in storage.blocks(nb_faces):
+        half_edges = np.arange(3 * start, 3 * stop, dtype=np.int32)
+        corners = faces[start:stop].reshape(-1)
+        origin[3 * start:3 * stop] = corners
+        arrays['next'][3 * start:3 * stop] = half_edges - half_edges % 3 + (half_edges + 1) % 3
+        arrays['face_half_edge'][start:stop] = half_edges[::3]
+        arrays['face_of'][3 * start:3 * stop] = half_edges // 3
+        half_edge[corners] = half_edges
+        vertices, counts = np.unique(corners, return_counts=True)
+        valences[vertices] += counts.astype(np.int32)
+
+    opposite = arrays['opposite']
+    boundary = arrays['boundary']
+    for low, high in vertex_ranges(storage, nb_half_edges, nb_vertices):
+        gathered = []
+        for start, stop in storage.blocks(nb_faces):
+            block = faces[start:stop]
+            first = block.reshape(-1)
+            second = block[:, [1, 2, 0]].reshape(-1)
+            smaller = np.minimum(first, second)
+            inside = np.flatnonzero((smaller >= low) & (smaller < high))
+            gathered.append((3 * start + inside, first[inside], second[inside]))
+        half_edges, first, second = (np.concatenate(arrays) for arrays in zip(*gathered))
+        matches = match_half_edges(first, second, nb_vertices)
+        opposite[half_edges] = np.where(matches >= 0, half_edges[matches], -1)
+        border = matches < 0
+        boundary[first[border]] = True
+        boundary[second[border]] = True
+    storage.release()
+    return arrays
+
+
+def peak_memory():
+    # Peak resident memory of the process in bytes (ru_maxrss is in
+    # kilobytes on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MappedMesh(Mesh):
+    # Mesh on mapped arrays, with the status arrays and the queues of the
+    # conquests: the passes over the whole mesh go by blocks, and the
+    # conquests release the pages every release_gates gates
+
+    @classmethod
+    def from_arrays(cls, arrays, storage, free_half_edge=-1, free_face=-1):
+        mesh = super().from_arrays(arrays, free_half_edge, free_face, storage.zeros)
+        mesh.storage = storage
+        mesh.release_gates = max(storage.memory // GATE_BYTES, 1)
+        return mesh
+
+    def zeros(self, size, dtype):
+        return self.storage.zeros(size, dtype)
+
+    def release_pages(self):
+        self.storage.release()
+
+    def reset_status(self):
+        for array in (self.faces_status, self.vertices_status, self.plus_minus):
+            for start, stop in self.storage.blocks(len(array)):
+                array[start:stop] = FREE
+
+    def vertices_of_valence(self, valence):
+        found = [start + np.flatnonzero((self.valences[start:stop] == valence)
+                                        & ~self.boundary[start:stop])
+                 for start, stop in self.storage.blocks(len(self.valences))]
+        return np.concatenate(found + [np.zeros(0, dtype=np.int64)])
+
+    def component_ids(self):
+        # Not kept in memory, the components by blocks
+        return self.components()
+
+    def nb_faces(self):
+        return sum(np.count_nonzero(self.face_half_edge[start:stop] >= 0)
+                   for start, stop in self.storage.blocks(len(self.face_half_edge)))
+
+    def nb_alive_vertices(self):
+        return sum(np.count_nonzero(self.half_edge[start:stop] >= 0)
+                   for start, stop in self.storage.blocks(len(self.half_edge)))
+
+    def face_blocks(self):
+        # Rows of face_half_edges by blocks of face ids
+        for start, stop in self.storage.blocks(len(self.face_half_edge)):
+            yield self.face_half_edges(start, stop)
+
+    def edge_blocks(self, labels=None):
+        # Edges of the faces (both vertices), by blocks of faces, only those
+        # between vertices of the same label with labels
+        for half_edges in self.face_blocks():
+            faces = self.origin[half_edges]
+            first = faces.reshape(-1)
+            second = faces[:, [1, 2, 0]].reshape(-1)
+            if labels is not None:
+                same = labels[first] == labels[second]
+                first, second = first[same], second[same]
+            yield first, second
+
+    def components(self, labels=None):
+        # connected_components by blocks of faces: the roots of the edges of
+        # each block are hooked at once, and the forest is compressed by
+        # blocks after each pass over the faces, until a pass joins no trees
+        # (the same labels, the smallest vertex of each component)
+        storage = self.storage
+        parent = storage.zeros(len(self.half_edge), np.int64)
+        for start, stop in storage.blocks(len(parent)):
+            parent[start:stop] = np.arange(start, stop)
+        joined = True
+        while joined:
+            joined = False
+            for first, second in self.edge_blocks(labels):
+                root_1, root_2 = roots(parent, first), roots(parent, second)
+                hooked = root_1 != root_2
+                if np.any(hooked):
+                    root_1, root_2 = root_1[hooked], root_2[hooked]
+                    np.minimum.at(parent, np.maximum(root_1, root_2), np.minimum(root_1, root_2))
+                    joined = True
+            # The parents are smaller than the vertices, so the blocks
+            # before a block are compressed already
+            for start, stop in storage.blocks(len(parent)):
+                parent[start:stop] = roots(parent, parent[start:stop])
+        return parent
+
+
+def roots(parent, vertices):
+    # Roots of the vertices in the forest of parents
+    while True:
+        grand_parent = parent[vertices]
+        if np.array_equal(grand_parent, vertices):
+            return vertices
+        vertices = grand_parent
+
+
+class ActiveVertices:
+    # Set of the active vertices of a mapped mesh (the operations of a set
+    # the encoder uses): a flag per vertex in a mapped array and their
+    # number, iterated in increasing order. All the vertices from 1 to
+    # size - 1 without vertices
+
+    def __init__(self, storage, size, vertices=None):
+        self.storage = storage
+        self.flags = storage.zeros(size, bool)
+        if vertices is None:
+            for start, stop in storage.blocks(size):
+                self.flags[max(start, 1):stop] = True
+            self.count = max(size - 1, 0)
+        else:
+            self.flags[vertices] = True
+            self.count = len(np.unique(vertices))
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, vertex):
+        return bool(self.flags[vertex])
+
+    def __iter__(self):
+        for vertices in self.blocks():
+            yield from vertices.tolist()
+
+    def remove(self, vertex):
+        if not self.flags[vertex]:
+            raise KeyError(vertex)
+        self.flags[vertex] = False
+        self.count -= 1
+
+    def difference_update(self, vertices):
+        vertices = np.unique(np.asarray(vertices, dtype=np.int64))
+        self.count -= np.count_nonzero(self.flags[vertices])
+        self.flags[vertices] = False
+
+    def blocks(self):
+        # The active vertices by blocks, in increasing order
+        for start, stop in self.storage.blocks(len(self.flags)):
+            yield start + np.flatnonzero(self.flags[start:stop])
+
+
+class ChunkedConquest:
+    # Decimating conquest of a mapped mesh by spatial chunks: slabs of about
+    # the same number of vertices along a random axis (as the regions of
+    # parallel.RegionPool), enough of them for the arrays of a slab to fit
+    # in the memory budget (at least MIN_REGION_VERTICES vertices per slab).
+    # The slabs are conquered one after the other, their conquests written
+    # to the layers and retriangulated before the next slab (they never
+    # cross the faces between two slabs), and their pages are dropped after
+    # each one. Only passes by blocks go over the whole mesh.
+    # Used as the pool of tools.decimating_conquest.
+
+    def __init__(self, storage, memory=MEMORY):
+        self.storage = storage
+        self.memory = memory
+
+    def decimate(self, mesh, active_vertices, vertices, obja, instrumentation=None):
+        storage = self.storage
+        nbytes = sum(getattr(mesh, name).nbytes for name in CONNECTIVITY) + vertices.nbytes
+        nb_chunks = int(max(1, min(-(-nbytes // max(self.memory, 1)),
+                                   mesh.nb_alive_vertices() // MIN_REGION_VERTICES)))
+        chunks = mapped_slabs(storage, mesh, vertices, nb_chunks) if nb_chunks > 1 else None
+        labels = mesh.components(chunks)
+        gates = mapped_first_gates(storage, mesh, labels)
+        frozen = None
+        if len(gates) <= 1:
+            gates = [mesh.random_gate()]
+            labels = None
+            if gates[0] < 0:
+                return obja
+        elif chunks is not None:
+            frozen = mapped_frozen_vertices(storage, mesh, labels)
+        else:
+            # The conquests of the components stay in them
+            labels = None
+
+        # One conquest per label, slab by slab
+        mesh.reset_status()
+        fifo = ConquestQueue(len(mesh.origin), zeros=mesh.zeros)
+        chunk = np.zeros(len(gates), dtype=np.int64) if chunks is None \
+            else chunks[mesh.origin[gates]]
+        order = np.argsort(chunk, kind='stable')
+        starts = np.flatnonzero(np.diff(chunk[order], prepend=-1)).tolist()
+        for k, (start, stop) in enumerate(zip(starts, starts[1:] + [len(order)])):
+            batch = order[start:stop].tolist()
+            results = [separate_conquest(mesh, gates[i], labels, frozen, fifo)
+                       for i in batch]
+            merge_conquests(mesh, active_vertices, obja, [gates[i] for i in batch], results,
+                            instrumentation, first_layer=k == 0)
+            storage.release()
+        if instrumentation is not None:
+            instrumentation.add_counters('out_of_core', {'chunks': nb_chunks})
+        return obja
+
+    def close(self):
+        self.storage.release()
+
+
+def mapped_slabs(storage, mesh, vertices, nb_regions):
+    # parallel.slabs by blocks: the bounds of the slabs are the quantiles
+    # of a sample of the alive vertices (-1 for the removed ones)
+    axis = random.randrange(3)
+    half_edge = mesh.half_edge
+    nb_alive = mesh.nb_alive_vertices()
+    step = max(nb_alive // storage.block_size, 1)
+    sample = []
+    offset = 0
+    for start, stop in storage.blocks(len(half_edge)):
+        alive = start + np.flatnonzero(half_edge[start:stop] >= 0)
+        sample.append(vertices[alive[(-offset) % step::step] - 1, axis])
+        offset += len(alive)
+    bounds = np.quantile(np.concatenate(sample + [np.zeros(0)]),
+                         np.arange(1, nb_regions) / nb_regions)
+    labels = storage.zeros(len(half_edge), np.int32)
+    for start, stop in storage.blocks(len(half_edge)):
+        alive = half_edge[start:stop] >= 0
+        coordinates = vertices[np.maximum(np.arange(start, stop) - 1, 0), axis]
+        labels[start:stop] = np.where(alive, np.searchsorted(bounds, coordinates, side='right'),
+                                      -1)
+    return labels
+
+
+def mapped_first_gates(storage, mesh, labels):
+    # tools.first_gates by blocks of half-edges (the same gates): the
+    # candidates of each label are counted, the rank of the gate of each
+    # label drawn in the order of the labels, and the gates found in a
+    # second pass
+    origin = mesh.origin
+    next = mesh.next
+
+    def candidates(start, stop):
+        half_edges = start + np.flatnonzero(origin[start:stop] >= 0)
+        label = labels[origin[half_edges]]
+        inside = ((label == labels[origin[next[half_edges]]])
+                  & (label == labels[origin[next[next[half_edges]]]]) & (label >= 0))
+        return half_edges[inside], label[inside]
+
+    counts = storage.zeros(len(labels), np.int64)
+    for start, stop in storage.blocks(len(origin)):
+        label, count = np.unique(candidates(start, stop)[1], return_counts=True)
+        counts[label] += count
+    found = np.concatenate([start + np.flatnonzero(counts[start:stop])
+                            for start, stop in storage.blocks(len(counts))]
+                           + [np.zeros(0, dtype=np.int64)])
+    if len(found) <= 1:
+        return []
+    # counts becomes the rank of the gate of each label
+    for label in found.tolist():
+        counts[label] = random.randrange(counts[label])
+
+    seen = storage.zeros(len(labels), np.int64)
+    gates = {}
+    for start, stop in storage.blocks(len(origin)):
+        half_edges, label = candidates(start, stop)
+        order = np.argsort(label, kind='stable')
+        half_edges, label = half_edges[order], label[order]
+        first = np.flatnonzero(np.diff(label, prepend=-1))
+        sizes = np.diff(np.append(first, len(label)))
+        rank = seen[label] + np.arange(len(label)) - np.repeat(first, sizes)
+        chosen = rank == counts[label]
+        gates.update(zip(label[chosen].tolist(), half_edges[chosen].tolist()))
+        seen[label[first]] += sizes
+    return [gates[label] for label in found.tolist()]
+
+
+def mapped_frozen_vertices(storage, mesh, labels):
+    # parallel.frozen_vertices by blocks of half-edges
+    origin = mesh.origin
+    next = mesh.next
+    frozen = storage.zeros(len(labels), bool)
+    for start, stop in storage.blocks(len(origin)):
+        half_edges = start + np.flatnonzero(origin[start:stop] >= 0)
+        across = half_edges[labels[origin[half_edges]] != labels[origin[next[half_edges]]]]
+        frozen[origin[across]] = True
+        frozen[origin[next[across]]] = True
+    return frozen
+
+
+def mapped_lod_blocks(active_vertices, mesh, vertices):
+    # tools.lod_arrays by blocks: the number of the active vertices in a
+    # mapped array, the coordinates and the faces by blocks
+    number = mesh.zeros(len(mesh.half_edge), np.int64)
+    nb_active = 0
+    for active in active_vertices.blocks():
+        number[active] = np.arange(nb_active + 1, nb_active + len(active) + 1)
+        nb_active += len(active)
+    vertex_blocks = (vertices[active - 1] for active in active_vertices.blocks())
+    face_blocks = (number[mesh.origin[half_edges]] for half_edges in mesh.face_blocks())
+    return vertex_blocks, face_blocks
+
+
+def write_mapped_obj(path, active_vertices, mesh, vertices):
+    save_obj_blocks(path, *mapped_lod_blocks(active_vertices, mesh, vertices))
+
+
+def write_mapped_ply(path, active_vertices, mesh, vertices):
+    save_ply_blocks(path, len(active_vertices), mesh.nb_faces(),
+                    *mapped_lod_blocks(active_vertices, mesh, vertices))
+
+
+def write_mapped_last_obja(active_vertices, mesh, vertices, obja):
+    # tools.write_last_obja by blocks: the records of the active vertices
+    # then of the faces, and the twins of the corners of the edges of more
+    # than two faces found by ranges of the smaller vertex of the edges
+    storage = mesh.storage
+    for active in active_vertices.blocks():
+        records = np.zeros(len(active), dtype=RECORD)
+        records['kind'] = VERTEX
+        records['a'] = active
+        obja.add_records(records)
+    for half_edges in mesh.face_blocks():
+        faces = mesh.origin[half_edges]
+        records = np.zeros(len(faces), dtype=RECORD)
+        records['kind'] = FACE
+        records['a'], records['b'], records['c'] = faces.T
+        records['face'] = mesh.face_keys(half_edges[:, 0])
+        obja.add_records(records)
+
+    # Corners (3 * face + corner, the faces numbered in the order of their
+    # ids) and half-edges of the edges of more than two faces
+    corners = []
+    shared = []
+    for low, high in vertex_ranges(storage, 3 * mesh.nb_faces(), len(mesh.half_edge) - 1):
+        gathered = []
+        nb_faces = 0
+        for half_edges in mesh.face_blocks():
+            faces = mesh.origin[half_edges]
+            first = faces.reshape(-1)
+            second = faces[:, [1, 2, 0]].reshape(-1)
+            smaller = np.minimum(first, second)
+            inside = np.flatnonzero((smaller >= low) & (smaller < high))
+            gathered.append((3 * nb_faces + inside, half_edges.reshape(-1)[inside],
+                             smaller[inside], np.maximum(first, second)[inside]))
+            nb_faces += len(faces)
+        corner, half_edge, smaller, larger = (np.concatenate(arrays) for arrays in zip(*gathered))
+        if len(corner) == 0:
+            continue
+        _, inverse, counts = np.unique(np.stack([smaller, larger], axis=1), axis=0,
+                                       return_inverse=True, return_counts=True)
+        many = counts[inverse.reshape(-1)] > 2
+        corners.append(corner[many])
+        shared.append(half_edge[many])
+    corners = np.concatenate(corners + [np.zeros(0, dtype=np.int64)])
+    order = np.argsort(corners)
+    corners = corners[order]
+    opposites = mesh.opposite[np.concatenate(shared + [np.zeros(0, dtype=np.int64)])[order]]
+
+    # Corners of the opposites: rank of their face among the faces and
+    # position of the half-edge in the face
+    face = mesh.face_of[opposites]
+    first = mesh.face_half_edge[face]
+    position = np.where(opposites == first, 0, np.where(opposites == mesh.next[first], 1, 2))
+    rank = np.zeros(len(face), dtype=np.int64)
+    nb_faces = 0
+    for start, stop in storage.blocks(len(mesh.face_half_edge)):
+        alive = np.cumsum(mesh.face_half_edge[start:stop] >= 0)
+        inside = (face >= start) & (face < stop)
+        rank[inside] = nb_faces + alive[face[inside] - start] - 1
+        nb_faces += alive[-1]
+    obja.base_twins = np.stack([corners, np.where(opposites >= 0, 3 * rank + position, -1)],
+                               axis=1)
+    return obja
@@ -0,0 +1,187 @@
+import itertools
+import multiprocessing
+import random
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from mesh import Mesh
+from conquest_queue import ConquestQueue
+from tools import decimating_conquest, first_gates, separate_conquest, merge_conquests
+
+# Arrays of the mesh read by the conquests of the workers
+SHARED = ('origin', 'next', 'opposite', 'valences', 'boundary', 'face_of', 'generation')
+# Smaller meshes are conquered by one process (the vertices around the
+# regions are not decimated in the layer)
+MIN_REGION_VERTICES = 5000
+
+
+class RegionPool:
+    # Parallel decimating conquest: one conquest per connected component of
+    # the mesh, the large components being cut in slabs (one per process,
+    # same number of vertices, along a random axis at each layer). The
+    # conquests are run by the workers from the mesh arrays in shared memory
+    # (SharedArrays, kept for the whole encode). The workers are forked, with
+    # the modules already imported.
+
+    def __init__(self, nb_processes):
+        self.nb_processes = nb_processes
+        # The workers share the tracker of the shared memory blocks
+        resource_tracker.ensure_running()
+        self.pool = multiprocessing.get_context('fork').Pool(nb_processes)
+        self.shared = SharedArrays()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.shared.close()
+
+    def decimate(self, mesh, active_vertices, vertices, obja, instrumentation=None):
+        faces = mesh.faces()
+        labels = mesh.components()
+        largest = np.bincount(labels[mesh.half_edge >= 0]).max(initial=0)
+        nb_regions = min(self.nb_processes, largest // MIN_REGION_VERTICES)
+        if nb_regions > 1:
+            labels = mesh.components(slabs(mesh, vertices, nb_regions))
+        if len(np.unique(labels[faces.reshape(-1)])) <= 1:
+            return decimating_conquest(mesh, active_vertices, vertices, obja,
+                                       instrumentation)
+        return region_conquests(mesh, active_vertices, obja, labels, self.shared,
+                                self.pool.starmap, 4 * self.nb_processes, instrumentation)
+
+
+def slabs(mesh, vertices, nb_regions):
+    # Label of each vertex of the mesh (-1 for the removed ones)
+    alive = np.flatnonzero(mesh.half_edge >= 0)
+    axis = random.randrange(3)
+    order = np.argsort(vertices[alive - 1, axis], kind='stable')
+    labels = np.full(len(mesh.half_edge), -1, dtype=np.int32)
+    labels[alive[order]] = np.arange(len(alive)) * nb_regions // max(len(alive), 1)
+    return labels
+
+
+def region_conquests(mesh, active_vertices, obja, labels, shared, starmap=itertools.starmap,
+                     nb_tasks=1, instrumentation=None):
+    # One decimating conquest per label of the vertices, from a random gate
+    # whose face has the label, run through starmap in nb_tasks batches. The
+    # vertices on an edge between two labels are frozen and the conquests
+    # stop at the faces with several labels, so the patches are disjoint and
+    # each conquest becomes a decimating layer of its own, decoded without
+    # the labels.
+    origin = mesh.origin
+    half_edges = np.flatnonzero(origin >= 0)
+    frozen = frozen_vertices(mesh, labels)
+
+    # Batches of conquests of about the same size, the largest regions first
+    gates = first_gates(mesh, labels)
+    sizes = np.bincount(labels[origin[half_edges]])[labels[origin[gates]]]
+    order = np.argsort(-sizes, kind='stable').tolist()
+    batches = [order[k::nb_tasks] for k in range(min(nb_tasks, len(order)))]
+
+    specs = shared.share(mesh, labels, frozen)
+    done = list(starmap(region_conquest,
+                        [(specs, [gates[k] for k in batch]) for batch in batches]))
+    results = [None] * len(gates)
+    for batch, batch_results in zip(batches, done):
+        for k, result in zip(batch, batch_results):
+            results[k] = result
+    return merge_conquests(mesh, active_vertices, obja, gates, results, instrumentation)
+
+
+def frozen_vertices(mesh, labels):
+    # Vertices on an edge between two labels
+    origin = mesh.origin
+    next = mesh.next
+    half_edges = np.flatnonzero(origin >= 0)
+    across = half_edges[labels[origin[half_edges]] != labels[origin[next[half_edges]]]]
+    frozen = np.zeros(len(labels), dtype=bool)
+    frozen[origin[across]] = True
+    frozen[origin[next[across]]] = True
+    return frozen
+
+
+class SharedArrays:
+    # Shared memory blocks of the arrays read by the workers, one per name of
+    # array, created on the first layer and kept until close (a block is only
+    # replaced by a larger one when its array grows). The arrays of the mesh
+    # are moved to their blocks: the conquests of the main process update
+    # them in place, nothing is copied from a layer to the next but the
+    # labels and the frozen vertices of the layer.
+
+    def __init__(self):
+        self.blocks = {}
+        self.views = {}
+        self.mesh = None
+
+    def place(self, name, array):
+        # Copy of the array in the block of name
+        block = self.blocks.get(name)
+        if block is None or block.size < array.nbytes:
+            self.release(name)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            self.blocks[name] = block
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        view[:] = array
+        self.views[name] = view
+        return view
+
+    def share(self, mesh, labels, frozen):
+        # Description (block name, shape, dtype) of the arrays for the
+        # workers. The arrays of the mesh not in their block yet (the first
+        # layer, or reallocated by the mesh since) are moved there
+        self.mesh = mesh
+        for name in SHARED:
+            if getattr(mesh, name) is not self.views.get(name):
+                setattr(mesh, name, self.place(name, getattr(mesh, name)))
+        self.place('labels', labels)
+        self.place('frozen', frozen)
+        return {name: (self.blocks[name].name, view.shape, view.dtype.str)
+                for name, view in self.views.items()}
+
+    def release(self, name):
+        self.views.pop(name, None)
+        block = self.blocks.pop(name, None)
+        if block is not None:
+            block.close()
+            block.unlink()
+
+    def close(self):
+        # The mesh gets back arrays of its own
+        if self.mesh is not None:
+            for name in SHARED:
+                if getattr(self.mesh, name) is self.views.get(name):
+                    setattr(self.mesh, name, self.views[name].copy())
+            self.mesh = None
+        for name in list(self.blocks):
+            self.release(name)
+
+
+# Blocks attached by a worker, by block name
+attached = {}
+
+
+def region_conquest(specs, first_gates):
+    # Conquests of a worker, the status arrays are its own. The blocks stay
+    # attached from a task to the next, those replaced since are closed
+    names = {spec[0] for spec in specs.values()}
+    for name in list(attached):
+        if name not in names:
+            attached.pop(name).close()
+    for name in names - attached.keys():
+        attached[name] = shared_memory.SharedMemory(name=name)
+    return attached_conquests(specs, first_gates)
+
+
+def attached_conquests(specs, first_gates):
+    arrays = {name: np.ndarray(shape, dtype=dtype, buffer=attached[block_name].buf)
+              for name, (block_name, shape, dtype) in specs.items()}
+    mesh = Mesh(0, 0)
+    for name in SHARED:
+        setattr(mesh, name, arrays[name])
+    mesh.faces_status = np.zeros(len(mesh.origin), dtype=np.int8)
+    mesh.vertices_status = np.zeros(len(mesh.valences), dtype=np.int8)
+    mesh.plus_minus = np.zeros(len(mesh.valences), dtype=np.int8)
+    fifo = ConquestQueue(len(mesh.origin))
+    return [separate_conquest(mesh, gate, labels=arrays['labels'], frozen=arrays['frozen'],
+                              fifo=fifo)
+            for gate in first_gates]
@@ -0,0 +1,69 @@
+import numpy as np
+
+from mesh import PLUS, MINUS
+
+
+class Rule:
+    # Retriangulation of the patch of a removed vertex of valence v, the
+    # vertices are given by their index in the chain (chain[0] is the right
+    # vertex of the gate, chain[-1] the left one):
+    #   triangles       new faces
+    #   signs           signs given to chain[1:-1] (when they have none)
+    #   deleted         deleted faces, as recorded in the obja file
+    #                   (deleted_triangles: their index in triangles)
+    # and the plan of Mesh.retriangulate, the edges of the new faces being
+    # numbered border[0..v-1] then diagonal half-edges:
+    #   diagonal_origins, twins, edges, valence_delta
+
+    def __init__(self, valence, triangles, signs, deleted):
+        self.valence = valence
+        self.triangles = triangles
+        self.signs = signs
+        self.deleted = deleted
+        rotations = [triangle[k:] + triangle[:k] for triangle in triangles for k in range(3)]
+        self.deleted_triangles = [rotations.index(face) // 3 for face in deleted]
+
+        diagonals = []
+        for triangle in triangles:
+            for a, b in zip(triangle, triangle[1:] + triangle[:1]):
+                if b != (a + 1) % valence:
+                    diagonals.append((a, b))
+        self.diagonal_origins = np.array([a for a, b in diagonals], dtype=np.int64)
+        self.twins = np.array([diagonals.index((b, a)) for a, b in diagonals], dtype=np.int64)
+        self.edges = np.array([[a if b == (a + 1) % valence else valence + diagonals.index((a, b))
+                                for a, b in zip(triangle, triangle[1:] + triangle[:1])]
+                               for triangle in triangles], dtype=np.int64)
+        # Each chain vertex loses its edge to the removed vertex
+        # and gains its diagonals
+        self.valence_delta = np.bincount(self.diagonal_origins, minlength=valence) - 1
+
+
+PATCHES = {
+    'v3.plus_plus': Rule(3, ((0, 1, 2),), (MINUS,), ((0, 1, 2),)),
+    'v3': Rule(3, ((0, 1, 2),), (PLUS,), ((0, 1, 2),)),
+    'v4.right_minus': Rule(4, ((0, 1, 3), (1, 2, 3)), (PLUS, MINUS),
+                           ((3, 1, 2), (0, 1, 3))),
+    'v4.plus': Rule(4, ((0, 1, 2), (0, 2, 3)), (MINUS, PLUS),
+                    ((0, 2, 3), (2, 0, 1))),
+    'v5.right_minus': Rule(5, ((0, 1, 4), (1, 2, 3), (1, 3, 4)), (PLUS, MINUS, PLUS),
+                           ((4, 0, 1), (1, 3, 4), (1, 2, 3))),
+    'v5.left_minus': Rule(5, ((0, 1, 3), (1, 2, 3), (0, 3, 4)), (PLUS, MINUS, PLUS),
+                          ((4, 0, 3), (0, 1, 3), (1, 2, 3))),
+    'v5.plus': Rule(5, ((0, 1, 2), (2, 3, 4), (0, 2, 4)), (MINUS, PLUS, MINUS),
+                    ((4, 0, 2), (0, 1, 2), (4, 2, 3))),
+    'v6.right_minus': Rule(6, ((0, 1, 5), (1, 2, 3), (3, 4, 5), (1, 3, 5)), (PLUS, MINUS, PLUS, MINUS),
+                           ((5, 0, 1), (1, 2, 3), (3, 4, 5), (1, 3, 5))),
+    'v6.plus': Rule(6, ((0, 1, 2), (2, 3, 4), (0, 4, 5), (0, 2, 4)), (MINUS, PLUS, MINUS, PLUS),
+                    ((2, 0, 1), (2, 3, 4), (4, 5, 0), (0, 2, 4))),
+}
+
+
+def patch_case(valence, left_sign, right_sign):
+    # Key of the rule of a patch, from the signs of the gate
+    if valence == 3:
+        return 'v3.plus_plus' if left_sign == PLUS and right_sign == PLUS else 'v3'
+    if right_sign == MINUS:
+        return 'v{}.right_minus'.format(valence)
+    if valence == 5 and left_sign == MINUS:
+        return 'v5.left_minus'
+    return 'v{}.plus'.format(valence)
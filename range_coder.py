@@ -0,0 +1,141 @@
+TOP = 1 << 24
+MAX_TOTAL = 1 << 16
+
+
+class AdaptiveModel:
+    # Frequencies of the symbols of a small alphabet, updated after each
+    # coded symbol (the decoder updates its copy the same way)
+
+    def __init__(self, nb_symbols, increment=24):
+        self.frequencies = [1] * nb_symbols
+        self.total = nb_symbols
+        self.increment = increment
+
+    def interval(self, symbol):
+        cumulative = sum(self.frequencies[:symbol])
+        return cumulative, self.frequencies[symbol]
+
+    def find(self, value):
+        cumulative = 0
+        for symbol, frequency in enumerate(self.frequencies):
+            if value < cumulative + frequency:
+                return symbol, cumulative, frequency
+            cumulative += frequency
+        raise ValueError('corrupted range coder stream')
+
+    def update(self, symbol):
+        self.frequencies[symbol] += self.increment
+        self.total += self.increment
+        if self.total > MAX_TOTAL:
+            self.frequencies = [(frequency + 1) // 2 for frequency in self.frequencies]
+            self.total = sum(self.frequencies)
+
+
+class RangeEncoder:
+    # 32 bits range coder with carry propagation (LZMA style)
+
+    def __init__(self):
+        self.low = 0
+        self.range = 0xFFFFFFFF
+        self.cache = 0
+        self.cache_size = 1
+        self.output = bytearray()
+
+    def encode(self, cumulative, frequency, total):
+        r = self.range // total
+        self.low += r * cumulative
+        self.range = r * frequency
+        while self.range < TOP:
+            self.range <<= 8
+            self.shift_low()
+
+    def encode_symbol(self, model, symbol):
+        cumulative, frequency = model.interval(symbol)
+        self.encode(cumulative, frequency, model.total)
+        model.update(symbol)
+
+    def encode_bits(self, value, nb_bits):
+        # Equiprobable bits, by chunks of 16
+        while nb_bits > 0:
+            size = min(nb_bits, 16)
+            nb_bits -= size
+            self.encode((value >> nb_bits) & ((1 << size) - 1), 1, 1 << size)
+
+    def encode_uint(self, model, value):
+        # Elias-gamma like: the bit length with an adaptive model
+        # (model of 33 symbols), then the bits below the leading one
+        length = value.bit_length()
+        self.encode_symbol(model, length)
+        if length > 1:
+            self.encode_bits(value, length - 1)
+
+    def encode_int(self, model, value):
+        self.encode_uint(model, 2 * value if value >= 0 else -2 * value - 1)
+
+    def shift_low(self):
+        if self.low < 0xFF000000 or self.low > 0xFFFFFFFF:
+            carry = self.low >> 32
+            temp = self.cache
+            while True:
+                self.output.append((temp + carry) & 0xFF)
+                temp = 0xFF
+                self.cache_size -= 1
+                if self.cache_size == 0:
+                    break
+            self.cache = (self.low >> 24) & 0xFF
+        self.cache_size += 1
+        self.low = (self.low << 8) & 0xFFFFFFFF
+
+    def finish(self):
+        for _ in range(5):
+            self.shift_low()
+        return bytes(self.output)
+
+
+class RangeDecoder:
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 5
+        self.range = 0xFFFFFFFF
+        self.code = int.from_bytes(data[:5].rjust(5, b'\0'), 'big') & 0xFFFFFFFF
+
+    def decode(self, total):
+        # Return the value in [0, total), then call consume
+        self.r = self.range // total
+        return min(self.code // self.r, total - 1)
+
+    def consume(self, cumulative, frequency):
+        self.code -= self.r * cumulative
+        self.range = self.r * frequency
+        while self.range < TOP:
+            self.range <<= 8
+            byte = self.data[self.position] if self.position < len(self.data) else 0
+            self.position += 1
+            self.code = ((self.code << 8) | byte) & 0xFFFFFFFF
+
+    def decode_symbol(self, model):
+        symbol, cumulative, frequency = model.find(self.decode(model.total))
+        self.consume(cumulative, frequency)
+        model.update(symbol)
+        return symbol
+
+    def decode_bits(self, nb_bits):
+        value = 0
+        while nb_bits > 0:
+            size = min(nb_bits, 16)
+            nb_bits -= size
+            bits = self.decode(1 << size)
+            self.consume(bits, 1)
+            value = (value << size) | bits
+        return value
+
+    def decode_uint(self, model):
+        length = self.decode_symbol(model)
+        if length <= 1:
+            return length
+        return (1 << (length - 1)) | self.decode_bits(length - 1)
+
+    def decode_int(self, model):
+        value = self.decode_uint(model)
+        return value // 2 if value % 2 == 0 else -(value + 1) // 2
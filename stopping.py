@@ -0,0 +1,93 @@
+import numpy as np
+
+from obja_writer import VERTEX, FACE, DELETED_FACE
+
+# The iterations stop below this number of active vertices in any case
+MIN_VERTICES = 10
+# Upper bound of the range coded connectivity of a removed vertex in the
+# binary format (codes, cleaning and sewing records), in bytes
+CONNECTIVITY_BYTES = 1
+# Vertices formatted to measure the length of the vertex lines of an obja file
+SAMPLE_SIZE = 1000
+# Before the first iteration: ratio of the vertices it removes, and vertex,
+# face and deleted face records per removed vertex (measured on the meshes
+# of OBJ, 0.35 to 0.65 and 4.5 to 4.9 faces)
+FIRST_RATIO = 0.5
+RECORDS_PER_VERTEX = np.array([1, 4.7, 2.7])
+
+
+class StopCriteria:
+    # When the encoder stops iterating, checked before each iteration:
+    # - the mesh has no face left (nothing to conquer),
+    # - the base mesh has at most target_vertices vertices,
+    # - the last iteration removed at most min_ratio of the active vertices
+    #   (the next one would remove even less, 0 stops when nothing was
+    #   removed),
+    # - the next iteration would make the output grow over max_bytes. The
+    #   size is estimated from the records written so far and the base mesh
+    #   left, the next iteration removing the same ratio of vertices as the
+    #   last one at the average cost of the removed vertices so far (typical
+    #   values before the first iteration). The binary files usually shrink
+    #   with the iterations, the obja files grow.
+    # The reason of the stop is kept in reason.
+
+    def __init__(self, target_vertices=None, max_bytes=None, min_ratio=0.0):
+        self.target_vertices = target_vertices
+        self.max_bytes = max_bytes
+        self.min_ratio = min_ratio
+        self.reason = None
+        self.record_bytes = None
+        self.base_bytes = None
+
+    def start(self, vertices, output_format='obja', bits=None):
+        # Estimated bytes of the vertex, face and deleted face records of the
+        # layers, and of a vertex and a face of the base mesh
+        if output_format == 'binary':
+            geometry = 24 if bits is None else 3 * bits / 8
+            self.record_bytes = np.array([geometry + CONNECTIVITY_BYTES, 0, 0])
+            self.base_bytes = (24 if bits is None else 6, 12)
+            return
+        sample = np.asarray(vertices[::max(len(vertices) // SAMPLE_SIZE, 1)])
+        vertex_line = len(('v {} {} {}\n' * len(sample)).format(*sample.reshape(-1).tolist()))
+        vertex_line /= max(len(sample), 1)
+        number = len(str(len(vertices))) + 1
+        self.record_bytes = np.zeros(3)
+        self.record_bytes[[VERTEX, FACE, DELETED_FACE]] = (vertex_line, 2 + 3 * number, 3 + number)
+        self.base_bytes = (vertex_line, 2 + 3 * number)
+
+    def stop(self, nb_active, previous, obja, mesh):
+        # nb_active vertices now, previous before the last iteration (None
+        # before the first one)
+        self.reason = self.check(nb_active, previous, obja, mesh)
+        return self.reason is not None
+
+    def check(self, nb_active, previous, obja, mesh):
+        if nb_active < MIN_VERTICES:
+            return 'min_vertices'
+        if mesh.nb_faces() == 0:
+            return 'no_faces'
+        if self.target_vertices is not None and nb_active <= self.target_vertices:
+            return 'target_vertices'
+        if previous is not None and previous - nb_active <= self.min_ratio * previous:
+            return 'min_ratio'
+        if self.max_bytes is not None:
+            size, next_size = self.estimate(nb_active, previous, obja, mesh)
+            if next_size > max(size, self.max_bytes):
+                return 'max_bytes'
+        return None
+
+    def estimate(self, nb_active, previous, obja, mesh):
+        # Bytes of the output now and after the next iteration
+        counts = obja.counts()
+        layers = float(np.dot(counts, self.record_bytes))
+        nb_faces = mesh.nb_faces()
+        vertex_bytes, face_bytes = self.base_bytes
+        size = layers + nb_active * vertex_bytes + nb_faces * face_bytes
+        if previous is None or counts[VERTEX] == 0:
+            ratio = FIRST_RATIO
+            layer_bytes = float(np.dot(RECORDS_PER_VERTEX, self.record_bytes))
+        else:
+            ratio = (previous - nb_active) / previous
+            layer_bytes = layers / counts[VERTEX]
+        per_vertex = layer_bytes - vertex_bytes - nb_faces / max(nb_active, 1) * face_bytes
+        return size, size + ratio * nb_active * per_vertex
@@ -1,904 +1,605 @@
-import numpy as np
+import heapq
 import random
 
-def postprocessing(obja, vertices, obj_to_obja):
-    #create obja_face
-    obja_face = {}
-    res = obja.split("\n")
-    count_face = 0
-    for  line in res:
-        try:
-            if line[0] == 'f':
-                temp = list(map(int, line[2:].split(' ')))            
-                obja_face[tuple(sorted(temp))] = count_face+1
-                count_face += 1
-        except:
-            continue
-        
-    # Modifed df fonction in obja
-    for idx, line in enumerate(res.copy()):
-        try:
-            if line[0] == 'd':
-                temp = tuple(sorted(list(map(int, line[3:].split(' ')))))           
-                res[idx] = line.replace(line[3:], str(obja_face[temp]))
-        except:
-            res[idx] = ""
-            continue
-    
-    # Modifed face number
-    obja_to_obj = {v:k for k,v in obj_to_obja.items()}
-    for idx, line in enumerate(res.copy()):
-        try:
-            if line[0] == 'f':
-                temp = list(map(int, line[2:].split(' ')))        
-                res[idx] = line.replace(line[2:], f"{obja_to_obj[int(temp[0])]} {obja_to_obj[int(temp[1])]} {obja_to_obj[int(temp[2])]}")
-        except:
-            continue
-    return "\n".join(res)
-
-def update_obja(obja, obja_iter, count_v, count_v_iter, obj_to_obja, obj_to_obja_iter):
-            # Update obja
-        a = {}
-        for k in range(1,count_v_iter):
-            a[count_v - k] = obj_to_obja_iter[count_v_iter -k]
-        obj_to_obja.update(a)
-        count_v -= count_v_iter -1
-        obja = obja_iter + obja
-        obj_to_obja_iter = {}
-        obja_iter = ""
-        count_v_iter = 1
-        return obj_to_obja
-        
-def preprocessing(obj_path):
-    # Variables
-    faces = []
-    vertices = []
-    gates = {}
-    valences = {}
-    patches = {}
-    active_vertices = set()
-    current_vertex = 1
+import numpy as np
 
+from mesh import (Mesh, split_non_manifold_vertices, CONNECTIVITY, FREE,
+                  CONQUERED, NULL, PLUS, MINUS)
+from obj_io import load_obj, save_obj, save_ply
+from conquest_queue import ConquestQueue
+from obja_writer import (ObjaWriter, RECORD, VERTEX, FACE, DELETED_FACE, NULL_PATCH, STOP,
+                         LAYER_NAMES, DECIMATING, CLEANING, SEWING, RecordNumbers)
+from instrumentation import event_callback
+from patches import PATCHES, patch_case
+
+# Records formatted at once when writing the obja file, format of each kind
+# of record
+RECORDS_BLOCK = 1 << 16
+LINE_FORMATS = np.array(['v {} {} {}\n', 'f {} {} {}\n', 'df {}\n'], dtype=object)
+LINE_VALUES = np.array([3, 3, 1])
+
+def write_obja(obja, vertices, path, storage=None):
+    # By blocks of storage for its mapped arrays
+    block_size = RECORDS_BLOCK if storage is None else storage.block_size
+    with open(path, 'w', buffering=1 << 20) as file:
+        for text in obja_text(obja, vertices, block_size, storage):
+            file.write(text)
+
+def obja_text(obja, vertices, block_size=RECORDS_BLOCK, storage=None):
+    # Text of the obja file, by blocks of block_size records each formatted
+    # with one call (the values of the records gathered in one list). The
+    # numbers of the records are made by passes over the blocks, in mapped
+    # arrays of storage if given
+    numbers = RecordNumbers(obja, len(vertices), block_size, storage)
+    obja_vertex = numbers.obja_vertex
+
+    # Write the records with the obja indices
+    previous = None
+    for index, block in obja.blocks(block_size, storage):
+        deleted = numbers.deleted(block)
+        kinds = block['kind'].astype(np.int64)
+        formats = LINE_FORMATS[kinds]
+        # A comment starts each layer, for the progressive decoders
+        if index != previous:
+            formats[0] = '# layer {}\n'.format(LAYER_NAMES[obja.layer_kinds[index]]) + formats[0]
+            previous = index
+
+        nb_values = LINE_VALUES[kinds]
+        offsets = np.cumsum(nb_values) - nb_values
+        values = np.empty(int(np.sum(nb_values)), dtype=object)
+        indices = np.stack([block['a'], block['b'], block['c']], axis=1)
+        is_vertex = kinds == VERTEX
+        is_face = kinds == FACE
+        is_deleted = kinds == DELETED_FACE
+        values[(offsets[is_vertex, None] + np.arange(3)).reshape(-1)] = \
+            vertices[indices[is_vertex, 0] - 1].reshape(-1).tolist()
+        values[(offsets[is_face, None] + np.arange(3)).reshape(-1)] = \
+            obja_vertex[indices[is_face]].reshape(-1).tolist()
+        values[offsets[is_deleted]] = deleted[is_deleted].tolist()
+        yield ''.join(formats.tolist()).format(*values.tolist())
+
+def preprocessing(obj_path, cache=None, instrumentation=None):
+    # With a cache (mesh_cache.MeshCache), the arrays of an obj file already
+    # preprocessed are mapped from the cache instead. The vertices split
+    # for their multiple chains of faces are counted in
+    # preprocessing.duplicated
+    arrays = None
+    if cache is not None:
+        key = cache.key(obj_path)
+        arrays = cache.load(key)
+    if arrays is None:
+        arrays = preprocessed_arrays(obj_path)
+        if cache is not None:
+            cache.store(key, arrays)
+
+    if instrumentation is not None:
+        instrumentation.add('preprocessing.duplicated', len(arrays['duplicated']))
+    vertices = arrays['vertices']
+    active_vertices = set(range(1, len(vertices) + 1))
+    mesh = Mesh.from_arrays(arrays)
+    return mesh, active_vertices, vertices, arrays['faces']
+
+def preprocessed_arrays(obj_path):
     # Retrieve the data from the obj file
-    with open(obj_path) as file:
-        # Loop over the lines of the obj file
-        for line in file:
-            # Case of a vertex
-            if line[0] == 'v':
-                # Store the coordinates x, y, z
-                x, y, z = line.split(' ')[1:]
-                vertices.append([float(x), float(y), float(z)])
-                active_vertices.add(current_vertex)
-                current_vertex += 1
-
-            # Case of a face
-            elif line[0] == 'f':
-                # The indices of the face vertices
-                a, b, c = line.split(' ')[1:]
-                a, b, c = int(a), int(b), int(c)
-                faces.append([a, b, c])
-
-                # Add the different gates
-                gates[(a, b)] = c
-                gates[(b, c)] = a
-                gates[(c, a)] = b
-
-                # Update the valences
-                if valences.get(a) is None:
-                    valences[a] = 1
-                else:
-                    valences[a] += 1
-
-                if valences.get(b) is None:
-                    valences[b] = 1
-                else:
-                    valences[b] += 1
-
-                if valences.get(c) is None:
-                    valences[c] = 1
-                else:
-                    valences[c] += 1
-
-                # Add the patches
-                if patches.get(a) is None:
-                    patches[a] = [(b, c)]
-                else:
-                    patches[a].append((b, c))
-
-                if patches.get(b) is None:
-                    patches[b] = [(c, a)]
-                else:
-                    patches[b].append((c, a))
-
-                if patches.get(c) is None:
-                    patches[c] = [(a, b)]
-                else:
-                    patches[c].append((a, b))
-
-    to_edit = {}
-    # Order the edges in the patches
-    for vertex, edges in patches.copy().items():
-        start, end = edges.pop(0)
-        chained_list = [start, end]
-
-        while len(edges) > 1:
-            for edge in edges:
-                if edge[0] == end:
-                    end = edge[1]
-                    chained_list.append(end)
-                    break
-            else:
-                # Go out the while
-                break
-            edges.remove(edge)
-
-        if len(edges) > 1:
-            if chained_list[0] == chained_list[-1]:
-                chained_list.pop()
-
-            # Add a new point
-            vertices.append(vertices[vertex-1])
-            active_vertices.add(current_vertex)
-
-            # Modify the gates
-            for gate in edges:
-                gates[gate] = current_vertex
-
-            # Modify the valences
-            valences[vertex] -= len(edges)
-            valences[current_vertex] = len(edges)
-
-            start, end = edges.pop(0)
-            new_chain = [start, end]
-            while len(edges) > 1:
-                for edge in edges:
-                    if edge[0] == end:
-                        end = edge[1]
-                        new_chain.append(end)
-                        break
-                edges.remove(edge)
-
-            # Add the new patch
-            patches[current_vertex] = np.array(new_chain)
-
-            # Replace the interior gates
-            for point in new_chain:
-                gates[(point, current_vertex)] = gates.pop((point, vertex))
-                gates[(current_vertex, point)] = gates.pop((vertex, point))
-
-            to_edit[vertex] = (new_chain, current_vertex)
-
-            current_vertex += 1
-            print('Multiple chains detected: {} -> {} & {}'.format(
-                vertex, chained_list, new_chain))
-
-        patches[vertex] = np.array(chained_list)
-
-    # Update the patches
-    for vertex, (chain, new) in to_edit.items():
-        for point in chain:
-            patches[point][np.where(patches[point] == vertex)[0]] = new
-
-    return gates, valences, patches, active_vertices, vertices, faces
-
-def decimating_conquest(gates, valences, patches, active_vertices, it, vertices, faces , obja, count_v, obj_to_obja):
-
-    faces_status = {}
-    vertices_status = {}
-    plus_minus = {}
-    print(obja)
-
-    # Choose a random gate
-    first_gate = random.choice(list(gates.keys()))
-    left, right = first_gate
-    plus_minus[left] = '-'
-    plus_minus[right] = '+'
+    vertices, faces = load_obj(obj_path)
+
+    # Split the vertices with multiple chains of faces
+    faces, duplicated = split_non_manifold_vertices(faces, len(vertices))
+    if len(duplicated) > 0:
+        vertices = np.concatenate([vertices, vertices[duplicated - 1]])
+
+    mesh = Mesh.from_faces(faces, len(vertices))
+    arrays = {name: getattr(mesh, name) for name in CONNECTIVITY}
+    arrays.update(vertices=vertices, faces=faces, duplicated=duplicated)
+    return arrays
+
+def decimating_conquest(mesh, active_vertices, vertices, obja, instrumentation=None, pool=None):
+    # With a pool (parallel.RegionPool), one conquest per region of the mesh
+    if pool is not None:
+        return pool.decimate(mesh, active_vertices, vertices, obja, instrumentation)
+    on_removed = event_callback(instrumentation, 'vertex_removed')
+    counters = {'gates': 0, 'conquered': 0, 'null': 0}
+    mesh.reset_status()
+
+    # One conquest per connected component, each in a layer of its own
+    gates = first_gates(mesh, mesh.components()) if mesh.nb_components() > 1 else []
+    if len(gates) > 1:
+        fifo = ConquestQueue(len(mesh.origin), zeros=mesh.zeros)
+        results = [separate_conquest(mesh, gate, fifo=fifo) for gate in gates]
+        return merge_conquests(mesh, active_vertices, obja, gates, results, instrumentation)
+
+    # Choose a random gate, nothing to conquer without faces
+    first_gate = mesh.random_gate()
+    if first_gate < 0:
+        return obja
+    patches = conquer(mesh, first_gate, obja, counters, on_removed)
+
+    # The patches are disjoint and the conquest never goes back into them,
+    # so they are retriangulated together at the end (spokes by rule)
+    origin = mesh.origin
+    for case, rings in patches.items():
+        for ring in rings:
+            active_vertices.remove(origin[ring[0]])
+        mesh.retriangulate(rings, PATCHES[case])
+    set_first_gate(mesh, first_gate, obja)
+
+    if instrumentation is not None:
+        instrumentation.add_counters('decimating', counters)
+    return obja
+
+def first_gates(mesh, labels):
+    # One random gate per label of the vertices, in a face whose vertices
+    # all have the label (none for a single label, the conquest then
+    # starts from any gate)
+    origin = mesh.origin
+    next = mesh.next
+    half_edges = np.flatnonzero(origin >= 0)
+    label = labels[origin[half_edges]]
+    inside = ((label == labels[origin[next[half_edges]]])
+              & (label == labels[origin[next[next[half_edges]]]]) & (label >= 0))
+    candidates = half_edges[inside]
+    order = np.argsort(label[inside], kind='stable')
+    candidates = candidates[order]
+    starts = np.flatnonzero(np.diff(label[inside][order], prepend=-1))
+    if len(starts) <= 1:
+        return []
+    sizes = np.diff(np.append(starts, len(candidates)))
+    return [int(candidates[start + random.randrange(size)])
+            for start, size in zip(starts.tolist(), sizes.tolist())]
+
+def separate_conquest(mesh, first_gate, labels=None, frozen=None, fifo=None):
+    # Conquest written to a layer of its own, return its records, codes,
+    # patches (rings by rule), counters and removed vertices (vertex,
+    # valence), whose events merge_conquests emits (the conquest can run in
+    # a worker). The conquests of disjoint regions can share the status
+    # arrays of the mesh, and their queue (fifo, a ConquestQueue of the
+    # mesh): their cost is then the size of their region, not of the mesh
+    obja = ObjaWriter()
+    obja.new_layer(DECIMATING)
+    counters = {'gates': 0, 'conquered': 0, 'null': 0}
+    removed = []
+    on_removed = lambda conquest, vertex, valence: removed.append((vertex, valence))
+    patches = conquer(mesh, first_gate, obja, counters, on_removed, labels, frozen, fifo)
+    patches = {case: np.array(rings, dtype=np.int64) for case, rings in patches.items()}
+    removed = np.array(removed, dtype=np.int64).reshape(-1, 2)
+    return obja.layer(0), obja.layer_codes(0).astype(np.int8), patches, counters, removed
+
+def merge_conquests(mesh, active_vertices, obja, gates, results, instrumentation=None,
+                    first_layer=True):
+    # Retriangulate the patches of separate conquests together and write
+    # one decimating layer per conquest that removed vertices, the first one
+    # in the current layer (which keeps a conquest in any case), or all of
+    # them in new layers without first_layer
+    on_removed = event_callback(instrumentation, 'vertex_removed')
+    origin = mesh.origin
+    patches = {}
+    layers = []
+    for gate, (records, codes, conquest_patches, counters, removed) in zip(gates, results):
+        if instrumentation is not None:
+            instrumentation.add_counters('decimating', counters)
+        if on_removed is not None:
+            for vertex, valence in removed.tolist():
+                on_removed('decimating', vertex, valence)
+        if len(conquest_patches) == 0:
+            continue
+        for case, rings in conquest_patches.items():
+            active_vertices.difference_update(origin[rings[:, 0]].tolist())
+            patches.setdefault(case, []).append(rings)
+        layers.append((gate, records, codes))
+    if len(layers) == 0 and first_layer:
+        layers.append((gates[0], results[0][0], results[0][1]))
+    for case, rings in patches.items():
+        mesh.retriangulate(np.concatenate(rings), PATCHES[case])
+    for k, (gate, records, codes) in enumerate(layers):
+        if k > 0 or not first_layer:
+            obja.new_layer(DECIMATING)
+        obja.add_records(records)
+        obja.add_codes(codes)
+        set_first_gate(mesh, gate, obja)
+    return obja
+
+def set_first_gate(mesh, first_gate, obja):
+    # The decoder finds the first gate in the coarse mesh, with the third
+    # vertex of its face in case of non-manifold edge
+    origin = mesh.origin
+    next = mesh.next
+    obja.set_first_gate(origin[first_gate], origin[next[first_gate]],
+                        origin[next[next[first_gate]]])
+
+def conquer(mesh, first_gate, obja, counters, on_removed=None, labels=None, frozen=None,
+            fifo=None):
+    # Decimating conquest from the first gate: write its codes and records and
+    # return its patches (rings of the removed vertices by rule), without
+    # retriangulating them. With labels, the conquest stays in the faces whose
+    # vertices all have the label of the first gate (STOP code on the other
+    # ones) and the frozen vertices are not removed. The queue of a previous
+    # conquest can be given in fifo
+    faces_status = mesh.faces_status
+    vertices_status = mesh.vertices_status
+    plus_minus = mesh.plus_minus
+    origin = mesh.origin
+    next = mesh.next
+    opposite = mesh.opposite
+
+    left, right = origin[first_gate], origin[next[first_gate]]
+    plus_minus[left] = MINUS
+    plus_minus[right] = PLUS
+    region = None if labels is None else labels[left]
 
     # Create the fifo
-    fifo = [first_gate]
+    if fifo is None:
+        fifo = ConquestQueue(len(origin), zeros=mesh.zeros)
+    fifo.clear()
+    release_gates = mesh.release_gates
+    fifo.push(first_gate)
+    patches = {}
 
     # Loop over the model
     while len(fifo) > 0:
 
         # Retrieve the first element of the fifo
-        gate = fifo.pop(0)
-        left, right = gate
-        vertices_status[left] = 'conquered'
-        vertices_status[right] = 'conquered'
-
+        gate = fifo.pop()
+        counters['gates'] += 1
+        if release_gates and counters['gates'] % release_gates == 0:
+            mesh.release_pages()
+        left, right = origin[gate], origin[next[gate]]
+        vertices_status[left] = CONQUERED
+        vertices_status[right] = CONQUERED
 
         # Retrieve the front vertex
-        front = gates[gate]
+        front = origin[next[next[gate]]]
 
         # conquered or null
-        if faces_status.get(gate) is not None:
+        if faces_status[gate] != FREE:
+            counters['conquered'] += 1
             continue
 
-        elif valences[front] <= 6 and vertices_status.get(front) is None:
+        # Face of another region
+        if region is not None and not labels[left] == labels[right] == labels[front] == region:
+            faces_status[gate] = NULL
+            obja.add_code(STOP)
+            counters['stop'] = counters.get('stop', 0) + 1
+            continue
 
-            # Retrieve the border of the patch
-            chain = patches[front]
+        ring = None if frozen is not None and frozen[front] else removable_ring(mesh, gate, 6)
+        if ring is not None:
+
+            # Retrieve the border of the patch, starting from the right vertex
+            border = [next[spoke] for spoke in ring]
+            chain = mesh.chain(ring)
+            if on_removed is not None:
+                on_removed('decimating', front, len(chain))
 
             # Tag all the vertices as conquered
-            for vertex in chain:
-                vertices_status[vertex] = 'conquered'
+            vertices_status[chain] = CONQUERED
 
             # Add the following gates to the fifo
             # and tag the inner faces as conquered
-            i = np.where(chain == right)[0][0]
-            chain = np.append(chain[i:], chain[:i])
-            for gate in zip(chain[1:], chain[:-1]):
-                fifo.append(gate)
-                faces_status[(gate[-1], gate[0])] = 'conquered'
+            for edge in border[:-1]:
+                if opposite[edge] >= 0:
+                    fifo.push(opposite[edge])
+                faces_status[edge] = CONQUERED
+            # The gate can be pushed again from its other side
+            faces_status[gate] = CONQUERED
 
             # Remove the front vertex
-            active_vertices.remove(front)
-            obja += f"v {vertices[front-1][0]}  {vertices[front-1][1]}  {vertices[front-1][2]}\n"
-            obj_to_obja[count_v] = front
-            count_v += 1
-            # Remove the old gates
-            for vertex in chain:
-                gates.pop((front, vertex))
-                gates.pop((vertex, front))
+            obja.add_vertex(front)
+            obja.add_code(len(chain) - 2)
 
             # Retriangulation
-            valences, patches, gates, vertices, faces , obja, count_v = retriangulation(chain, valences, left, right,
-                                                                                        gates, patches, front, plus_minus, it, vertices, faces , obja,  count_v, obj_to_obja)
+            case = retriangulation(mesh, ring, chain, left, right, front, obja)
+            patches.setdefault(case, []).append(ring)
+            counters['removed.' + case] = counters.get('removed.' + case, 0) + 1
 
-        elif (vertices_status.get(front) is None and valences[front] > 6) or (
-                vertices_status.get(front) == 'conquered'):
+        else:
 
             # Set the front face to null
-            faces_status[gate] = 'null'
+            faces_status[gate] = NULL
+            obja.add_code(NULL_PATCH)
+            counters['null'] += 1
 
-            if plus_minus.get(front) is None:
-                plus_minus[front] = '+'
+            if plus_minus[front] == 0:
+                plus_minus[front] = PLUS
 
             # Add the other edges to the fifo
-            fifo.append((front, right))
-            fifo.append((left, front))
-
-        else:
-            print("ERROR: ELSE (decimating conquest)")
-
-    return obja, count_v
-
-def retriangulation(chain, valences, left, right, gates, patches, front, plus_minus, it, vertices, faces , obja, count_v, obj_to_obja):
-    # Retrieve the information to start the retriangulation
-    valence = valences[front]
-    left_sign = plus_minus[left]
-    right_sign = plus_minus[right]
-
-    # Select the right case
-    if valence == 3:
-        # Update the valences
-        for vertex in chain:
-            valences[vertex] -= 1
-
-        # Update the faces
-        new_front = chain[1]
-        gates[(left, right)] = new_front
-        gates[(right, new_front)] = left
-        gates[(new_front, left)] = right
-
-        # Update the patches
-        for vertex in chain:
-            patches[vertex] = patches[vertex][patches[vertex] != front]
-
-        # Update the signs
-        if plus_minus.get(new_front) is None:
-            if left_sign == '+' and right_sign == '+':
-                plus_minus[new_front] = '-'
-            else:
-                plus_minus[new_front] = '+'
-                
-        # Update obja
-        obja += f"f {front} {chain[0]} {chain[1]}\n"
-        obja += f"f {front} {chain[1]} {chain[2]}\n"
-        obja += f"f {front} {chain[2]} {chain[0]}\n"
-        obja += f"df {chain[0]} {chain[1]} {chain[2]}\n"
-
-
-    elif valence == 4:
-        if right_sign == '-':
-            # Update the signs
-            if plus_minus.get(chain[1]) is None:
-                plus_minus[chain[1]] = '+'
-            if plus_minus.get(chain[2]) is None:
-                plus_minus[chain[2]] = '-'
-
-            # Update the faces
-            gates[(left, right)] = chain[1]
-            gates[(right, chain[1])] = left
-            gates[(chain[1], chain[2])] = left
-            gates[(chain[2], left)] = chain[1]
-
-            # Add the new gates
-            gates[(left, chain[1])] = chain[2]
-            gates[(chain[1], left)] = right
-
-            # Update the valences
-            valences[right] -= 1
-            valences[chain[2]] -= 1
-
-            # Update the patches
-            patches[right] = patches[right][patches[right] != front]
-            patches[chain[2]] = patches[chain[2]][patches[chain[2]] != front]
-            patches[left][np.where(patches[left] == front)[0]] = chain[1]
-            patches[chain[1]][np.where(patches[chain[1]] == front)[0]] = left
-            
-            # Update obja
-            obja += f"f {front} {chain[0]} {chain[1]}\n"
-            obja += f"f {front} {chain[1]} {chain[2]}\n"
-            obja += f"f {front} {chain[2]} {chain[3]}\n"
-            obja += f"f {front} {chain[3]} {chain[0]}\n"
-            obja += f"df {left} {chain[1]} {chain[2]}\n"
-            obja += f"df {left} {chain[1]} {right}\n"
-
-        else:
-            # Update the signs
-            if plus_minus.get(chain[1]) is None:
-                plus_minus[chain[1]] = '-'
-            if plus_minus.get(chain[2]) is None:
-                plus_minus[chain[2]] = '+'
-
-            # Update the faces
-            gates[(left, right)] = chain[2]
-            gates[(right, chain[1])] = chain[2]
-            gates[(chain[1], chain[2])] = right
-            gates[(chain[2], left)] = right
-
-            # Add the new gates
-            gates[(right, chain[2])] = left
-            gates[(chain[2], right)] = chain[1]
-
-            # Update the valences
-            valences[left] -= 1
-            valences[chain[1]] -= 1
-
-            # Update the patches
-            patches[left] = patches[left][patches[left] != front]
-            patches[chain[1]] = patches[chain[1]][patches[chain[1]] != front]
-            patches[right][np.where(patches[right] == front)[0]] = chain[2]
-            patches[chain[2]][np.where(patches[chain[2]] == front)[0]] = right
-
-            # Update obja
-            obja += f"f {front} {chain[0]} {chain[1]}\n"
-            obja += f"f {front} {chain[1]} {chain[2]}\n"
-            obja += f"f {front} {chain[2]} {chain[3]}\n"
-            obja += f"f {front} {chain[3]} {chain[0]}\n"
-            obja += f"df {right} {chain[2]} {left}\n"
-            obja += f"df {chain[2]} {right} {chain[1]}\n"
-
-    elif valence == 5:
-        if right_sign == '-':
-            # Update the signs
-            if plus_minus.get(chain[1]) is None:
-                plus_minus[chain[1]] = '+'
-            if plus_minus.get(chain[2]) is None:
-                plus_minus[chain[2]] = '-'
-            if plus_minus.get(chain[3]) is None:
-                plus_minus[chain[3]] = '+'
-
-            # Update the faces
-            gates[(left, right)] = chain[1]
-            gates[(right, chain[1])] = left
-            gates[(chain[1], chain[2])] = chain[3]
-            gates[(chain[2], chain[3])] = chain[1]
-            gates[(chain[3], left)] = chain[1]
-
-            # Add the new gates
-            gates[(left, chain[1])] = chain[3]
-            gates[(chain[1], left)] = right
-            gates[(chain[3], chain[1])] = chain[2]
-            gates[(chain[1], chain[3])] = left
-
-            # Update the valences
-            valences[right] -= 1
-            valences[chain[1]] += 1
-            valences[chain[2]] -= 1
-
-            # Update the patches
-            patches[right] = patches[right][patches[right] != front]
-
-            patch = patches[chain[1]]
-            i = np.where(patch == front)[0][0]
-            patch = patch[patch != front]
-            patches[chain[1]] = np.insert(patch, [i, i], [chain[3], left])
-
-            patches[chain[2]] = patches[chain[2]][patches[chain[2]] != front]
-            patches[chain[3]][np.where(patches[chain[3]] == front)[0]] = chain[1]
-            patches[left][np.where(patches[left] == front)[0]] = chain[1]
-
-            # Update obja
-            obja += f"f {front} {chain[0]} {chain[1]}\n"
-            obja += f"f {front} {chain[1]} {chain[2]}\n"
-            obja += f"f {front} {chain[2]} {chain[3]}\n"
-            obja += f"f {front} {chain[3]} {chain[4]}\n"
-            obja += f"f {front} {chain[4]} {chain[0]}\n"
-            obja += f"df {left} {right} {chain[1]}\n"
-            obja += f"df {chain[1]} {left} {chain[3]}\n"
-            obja += f"df {chain[1]} {chain[2]} {chain[3]}\n"
-
-            
-        elif left_sign == '-':
-            # Update the signs
-            if plus_minus.get(chain[1]) is None:
-                plus_minus[chain[1]] = '+'
-            if plus_minus.get(chain[2]) is None:
-                plus_minus[chain[2]] = '-'
-            if plus_minus.get(chain[3]) is None:
-                plus_minus[chain[3]] = '+'
-
-            # Update the faces
-            gates[(left, right)] = chain[3]
-            gates[(right, chain[1])] = chain[3]
-            gates[(chain[1], chain[2])] = chain[3]
-            gates[(chain[2], chain[3])] = chain[1]
-            gates[(chain[3], left)] = right
-
-            # Add the new gates
-            gates[(right, chain[3])] = left
-            gates[(chain[3], right)] = chain[1]
-            gates[(chain[3], chain[1])] = chain[2]
-            gates[(chain[1], chain[3])] = right
-
-            # Update the valences
-            valences[chain[2]] -= 1
-            valences[chain[3]] += 1
-            valences[left] -= 1
-
-            # Update the patches
-            patches[right][np.where(patches[right] == front)[0]] = chain[3]
-            patches[chain[1]][np.where(patches[chain[1]] == front)[0]] = chain[3]
-            patches[chain[2]] = patches[chain[2]][patches[chain[2]] != front]
-
-            patch = patches[chain[3]]
-            i = np.where(patch == front)[0][0]
-            patch = patch[patch != front]
-            patches[chain[3]] = np.insert(patch, [i, i], [right, chain[1]])
-
-            patches[left] = patches[left][patches[left] != front]
-            
-            # Update obja
-            obja += f"f {front} {chain[0]} {chain[1]}\n"
-            obja += f"f {front} {chain[1]} {chain[2]}\n"
-            obja += f"f {front} {chain[2]} {chain[3]}\n"
-            obja += f"f {front} {chain[3]} {chain[4]}\n"
-            obja += f"f {front} {chain[4]} {chain[0]}\n"
-            obja += f"df {left} {right} {chain[3]}\n"
-            obja += f"df {chain[1]} {right} {chain[3]}\n"
-            obja += f"df {chain[1]} {chain[2]} {chain[3]}\n"
-
-        else:
-            # Update the signs
-            if plus_minus.get(chain[1]) is None:
-                plus_minus[chain[1]] = '-'
-            if plus_minus.get(chain[2]) is None:
-                plus_minus[chain[2]] = '+'
-            if plus_minus.get(chain[3]) is None:
-                plus_minus[chain[3]] = '-'
-
-            # Update the faces
-            gates[(left, right)] = chain[2]
-            gates[(right, chain[1])] = chain[2]
-            gates[(chain[1], chain[2])] = right
-            gates[(chain[2], chain[3])] = left
-            gates[(chain[3], left)] = chain[2]
-
-            # Add the new gates
-            gates[(right, chain[2])] = left
-            gates[(chain[2], right)] = chain[1]
-            gates[(chain[2], left)] = right
-            gates[(left, chain[2])] = chain[3]
-
-            # Update the valences
-            valences[chain[1]] -= 1
-            valences[chain[2]] += 1
-            valences[chain[3]] -= 1
-
-            # Update the patches
-            patches[right][np.where(patches[right] == front)[0]] = chain[2]
-            patches[chain[1]] = patches[chain[1]][patches[chain[1]] != front]
-
-            patch = patches[chain[2]]
-            i = np.where(patch == front)[0][0]
-            patch = patch[patch != front]
-            patches[chain[2]] = np.insert(patch, [i, i], [left, right])
-
-            patches[chain[3]] = patches[chain[3]][patches[chain[3]] != front]
-            patches[left][np.where(patches[left] == front)[0]] = chain[2]
-
-            # Update obja
-            obja += f"f {front} {chain[0]} {chain[1]}\n"
-            obja += f"f {front} {chain[1]} {chain[2]}\n"
-            obja += f"f {front} {chain[2]} {chain[3]}\n"
-            obja += f"f {front} {chain[3]} {chain[4]}\n"
-            obja += f"f {front} {chain[4]} {chain[0]}\n"
-            obja += f"df {left} {right} {chain[2]}\n"
-            obja += f"df {chain[1]} {right} {chain[2]}\n"
-            obja += f"df {left} {chain[2]} {chain[3]}\n"
-
-    elif valence == 6:
-
-        if right_sign == '-':
-            # Update the signs
-            if plus_minus.get(chain[1]) is None:
-                plus_minus[chain[1]] = '+'
-            if plus_minus.get(chain[2]) is None:
-                plus_minus[chain[2]] = '-'
-            if plus_minus.get(chain[3]) is None:
-                plus_minus[chain[3]] = '+'
-            if plus_minus.get(chain[4]) is None:
-                plus_minus[chain[4]] = '-'
-
-            # Update the faces
-            gates[(left, right)] = chain[1]
-            gates[(right, chain[1])] = left
-            gates[(chain[1], chain[2])] = chain[3]
-            gates[(chain[2], chain[3])] = chain[1]
-            gates[(chain[3], chain[4])] = left
-            gates[(chain[4], left)] = chain[3]
-
-            # Add the new gates
-            gates[(left, chain[1])] = chain[3]
-            gates[(chain[1], left)] = right
-            gates[(chain[3], chain[1])] = chain[2]
-            gates[(chain[1], chain[3])] = left
-            gates[(left, chain[3])] = chain[4]
-            gates[(chain[3], left)] = chain[1]
-
-            # Update the valences
-            valences[right] -= 1
-            valences[chain[1]] += 1
-            valences[chain[2]] -= 1
-            valences[chain[3]] += 1
-            valences[chain[4]] -= 1
-            valences[left] += 1
-
-            # Update the patches
-            patches[right] = patches[right][patches[right] != front]
-            patch = patches[chain[1]]
-            i = np.where(patch == front)[0][0]
-            patch = patch[patch != front]
-            patches[chain[1]] = np.insert(patch, [i, i], [chain[3], left])
-
-            patches[chain[2]] = patches[chain[2]][patches[chain[2]] != front]
-
-            patch = patches[chain[3]]
-            i = np.where(patch == front)[0][0]
-            patch = patch[patch != front]
-            patches[chain[3]] = np.insert(patch, [i, i], [left, chain[1]])
-
-            patches[chain[4]] = patches[chain[4]][patches[chain[4]] != front]
-
-            patch = patches[left]
-            i = np.where(patch == front)[0][0]
-            patch = patch[patch != front]
-            patches[left] = np.insert(patch, [i, i], [chain[1], chain[3]])
-
-            # Update obja
-            obja += f"f {front} {chain[0]} {chain[1]}\n"
-            obja += f"f {front} {chain[1]} {chain[2]}\n"
-            obja += f"f {front} {chain[2]} {chain[3]}\n"
-            obja += f"f {front} {chain[3]} {chain[4]}\n"
-            obja += f"f {front} {chain[4]} {chain[5]}\n"
-            obja += f"f {front} {chain[5]} {chain[0]}\n"
-            obja += f"df {left} {right} {chain[1]}\n"
-            obja += f"df {chain[1]} {chain[3]} {chain[2]}\n"
-            obja += f"df {chain[3]} {left} {chain[4]}\n"            
-        else:
-            # Update the signs
-            if plus_minus.get(chain[1]) is None:
-                plus_minus[chain[1]] = '-'
-            if plus_minus.get(chain[2]) is None:
-                plus_minus[chain[2]] = '+'
-            if plus_minus.get(chain[3]) is None:
-                plus_minus[chain[3]] = '-'
-            if plus_minus.get(chain[4]) is None:
-                plus_minus[chain[4]] = '+'
-
-            # Update the faces
-            gates[(left, right)] = chain[4]
-            gates[(right, chain[1])] = chain[2]
-            gates[(chain[1], chain[2])] = right
-            gates[(chain[2], chain[3])] = chain[4]
-            gates[(chain[3], chain[4])] = chain[2]
-            gates[(chain[4], left)] = right
-
-            # Add the new gates
-            gates[(right, chain[4])] = left
-            gates[(chain[4], right)] = chain[2]
-            gates[(chain[4], chain[2])] = chain[3]
-            gates[(chain[2], chain[4])] = right
-            gates[(right, chain[2])] = chain[4]
-            gates[(chain[2], right)] = chain[1]
-
-            # Update the valences
-            valences[right] += 1
-            valences[chain[1]] -= 1
-            valences[chain[2]] += 1
-            valences[chain[3]] -= 1
-            valences[chain[4]] += 1
-            valences[left] -= 1
-
-            # Update the patches
-            patch = patches[right]
-            i = np.where(patch == front)[0][0]
-            patch = patch[patch != front]
-            patches[right] = np.insert(patch, [i, i], [chain[2], chain[4]])
-
-            patches[chain[1]] = patches[chain[1]][patches[chain[1]] != front]
-
-            patch = patches[chain[2]]
-            i = np.where(patch == front)[0][0]
-            patch = patch[patch != front]
-            patches[chain[2]] = np.insert(patch, [i, i], [chain[4], right])
-
-            patches[chain[3]] = patches[chain[3]][patches[chain[3]] != front]
-
-            patch = patches[chain[4]]
-            i = np.where(patch == front)[0][0]
-            patch = patch[patch != front]
-            patches[chain[4]] = np.insert(patch, [i, i], [right, chain[2]])
-            patches[left] = patches[left][patches[left] != front]
-            
-            # Update obja
-            obja += f"f {front} {chain[0]} {chain[1]}\n"
-            obja += f"f {front} {chain[1]} {chain[2]}\n"
-            obja += f"f {front} {chain[2]} {chain[3]}\n"
-            obja += f"f {front} {chain[3]} {chain[4]}\n"
-            obja += f"f {front} {chain[4]} {chain[5]}\n"
-            obja += f"f {front} {chain[5]} {chain[0]}\n"
-            obja += f"df {chain[2]} {right} {chain[1]}\n"
-            obja += f"df {chain[2]} {chain[3]} {chain[4]}\n"
-            obja += f"df {chain[4]} {left} {right}\n"  
-          
-    return valences, patches, gates, vertices, faces , obja, count_v
-
-def cleaning_conquest(gates, patches, valences, active_vertices, fifo, vertices, faces, obja,  count_v, obj_to_obja):
+            for edge in (opposite[next[gate]], opposite[next[next[gate]]]):
+                if edge >= 0:
+                    fifo.push(edge)
+    return patches
+
+def removable_ring(mesh, gate, max_valence):
+    # One-ring of the front vertex of the gate if it can be removed, None
+    # otherwise: free, inside, of valence 3 to max_valence and without
+    # vertex linked twice to it (its patch would get degenerate faces)
+    front = mesh.front(gate)
+    if not (3 <= mesh.valences[front] <= max_valence and mesh.vertices_status[front] == FREE
+            and not mesh.boundary[front]):
+        return None
+    ring = mesh.one_ring(mesh.opposite[mesh.next[gate]])
+    chain = mesh.chain(ring)
+    if len(set(chain.tolist())) < len(chain):
+        return None
+    return ring
+
+def retriangulation(mesh, ring, chain, left, right, front, obja):
+    # Signs and obja records of the patch of the front vertex,
+    # return the key of its rule (the faces are updated by Mesh.retriangulate)
+    plus_minus = mesh.plus_minus
+    valence = len(chain)
+    case = patch_case(valence, plus_minus[left], plus_minus[right])
+    rule = PATCHES[case]
+
+    # Update the signs
+    for vertex, sign in zip(chain[1:-1], rule.signs):
+        if plus_minus[vertex] == 0:
+            plus_minus[vertex] = sign
+
+    # Update obja, the new faces take the ids of the faces of their spokes
+    keys = mesh.face_keys(ring).tolist()
+    created = mesh.face_keys(np.asarray(ring)[rule.deleted_triangles], created=True).tolist()
+    for i in range(valence):
+        obja.add_face(front, chain[i], chain[(i + 1) % valence], keys[i])
+    for (a, b, c), key in zip(rule.deleted, created):
+        obja.delete_face(chain[a], chain[b], chain[c], key)
+    return case
+
+def cleaning_conquest(mesh, active_vertices, vertices, obja, instrumentation=None):
     # Cleaning Conquest
-    faces_status = {}
-    vertices_status = {}
-    done = set()
-
-    # Choose a random gate
-    for vertex in active_vertices:
-        if valences[vertex] == 3:
-            chain = patches[vertex]
-            break
-    else:
-        return
-
-    first_gate = (chain[0], chain[1])
-
-    # Create the fifo
-    fifo.append(first_gate)
-
-    # Loop over the model
-    while len(fifo) > 0:
+    on_removed = event_callback(instrumentation, 'vertex_removed')
+    counters = {'gates': 0, 'conquered': 0, 'removed.v3': 0, 'crossed': 0, 'null': 0}
+    mesh.reset_status()
+    faces_status = mesh.faces_status
+    vertices_status = mesh.vertices_status
+    valences = mesh.valences
+    origin = mesh.origin
+    next = mesh.next
+    opposite = mesh.opposite
+
+    # First gates: a valence-3 vertex of each connected component
+    candidates = mesh.vertices_of_valence(3)
+    _, first = np.unique(mesh.component_ids()[candidates], return_index=True)
+    seeds = candidates[np.sort(first)][::-1].tolist()
+
+    # Create the fifo, each gate is only visited once
+    fifo = ConquestQueue(len(origin), unique=True, zeros=mesh.zeros)
+    release_gates = mesh.release_gates
+
+    # The patches are retriangulated together at the end: the next
+    # half-edge of each border half-edge in the face of its patch until then
+    rings = []
+    pending = {}
+
+    # Loop over the model, the next seed when a component is done
+    while len(fifo) > 0 or len(seeds) > 0:
+        if len(fifo) == 0:
+            fifo.push(next[mesh.half_edge[seeds.pop()]])
         # Retrieve the first element of the fifo
-        gate = fifo.pop(0)
-        if gate in done:
+        gate = fifo.pop()
+        if gate < 0:
             continue
-        else:
-            done.add(gate)
+        counters['gates'] += 1
+        if release_gates and counters['gates'] % release_gates == 0:
+            mesh.release_pages()
 
         # Retrieve the front vertex
-        front = gates[gate]
-        chain = patches[front]
-        left, right = gate
+        front = origin[next[next[gate]]]
+        left, right = origin[gate], origin[next[gate]]
 
         # conquered or null
-        if faces_status.get(gate) is not None:
-            print('*', end='')
+        if faces_status[gate] != FREE:
+            counters['conquered'] += 1
+            continue
+
+        # The face of a patch is null (its vertices are conquered)
+        if gate in pending:
+            counters['null'] += 1
+            faces_status[gate] = NULL
+            following = pending[gate]
+            for edge in (opposite[following], opposite[pending[following]]):
+                if edge >= 0:
+                    fifo.push(edge)
             continue
 
-        elif valences[front] == 3 and vertices_status.get(front) is None:
-            print('.', end='')
+        ring = removable_ring(mesh, gate, 3)
+        if ring is not None:
+            counters['removed.v3'] += 1
+            chain = mesh.chain(ring)
+            if on_removed is not None:
+                on_removed('cleaning', front, 3)
 
-            # Remove the vertex
+            # Remove the vertex and forget its gates
             active_vertices.remove(front)
+            fifo.invalidate(ring + [opposite[spoke] for spoke in ring])
+            border = [next[spoke] for spoke in ring]
 
-            for left, right in fifo.copy():
-                if left == front or right == front:
-                    fifo.remove((left, right))
-                    
             # Update obja
-            obja += f"v {vertices[front-1][0]}  {vertices[front-1][1]}  {vertices[front-1][2]}\n"
-            obj_to_obja[count_v] = front
-            count_v += 1
-            
-            # Update the valences
-            for point in chain:
-                valences[point] -= 1
-                # Remove the old gates
-                gates.pop((front, point))
-                gates.pop((point, front))
+            obja.add_vertex(front)
+            keys = mesh.face_keys(ring).tolist()
+            created = int(mesh.face_keys(ring[0], created=True))
 
             # Update the faces
-            gates[(chain[0], chain[1])] = chain[2]
-            gates[(chain[1], chain[2])] = chain[0]
-            gates[(chain[2], chain[0])] = chain[1]
-
-            # Update the patches
-            for point in chain:
-                patches[point] = patches[point][patches[point] != front]
-                vertices_status[point] = 'conquered'
+            rings.append(ring)
+            for edge, following in zip(border, border[1:] + border[:1]):
+                pending[edge] = following
+            vertices_status[chain] = CONQUERED
 
             # Update face status
-            faces_status[(chain[1], chain[0])] = 'conquered'
-            faces_status[(chain[2], chain[1])] = 'conquered'
+            outer_1 = opposite[border[0]]
+            outer_2 = opposite[border[1]]
+            faces_status[outer_1] = CONQUERED
+            faces_status[outer_2] = CONQUERED
 
             # Update fifo
-            front_1 = gates[(chain[1], chain[0])]
-            front_2 = gates[(chain[2], chain[1])]
-            fifo.append((front_1, chain[0]))
-            fifo.append((chain[1], front_1))
-            fifo.append((front_2, chain[1]))
-            fifo.append((chain[2], front_2))
+            for outer in (outer_1, outer_2):
+                if outer >= 0:
+                    following = pending.get(outer, next[outer])
+                    for edge in (following, pending.get(following, next[following])):
+                        if opposite[edge] >= 0:
+                            fifo.push(opposite[edge])
             
             # Update obja
-            obja += f"f {front} {chain[0]} {chain[1]}\n"
-            obja += f"f {front} {chain[1]} {chain[2]}\n"
-            obja += f"f {front} {chain[2]} {chain[0]}\n"
-            #obja += f"df {chain[0]}  {chain[1]}  {chain[2]}\n"
+            obja.add_face(front, chain[0], chain[1], keys[0])
+            obja.add_face(front, chain[1], chain[2], keys[1])
+            obja.add_face(front, chain[2], chain[0], keys[2])
+            obja.delete_face(chain[0], chain[1], chain[2], created)
  
 
-        elif valences[front] <= 6 and vertices_status.get(front) is None:
-            print("-", end='')
-            try:
-                i = np.where(chain == right)[0][0]
-            except IndexError:
-                print(chain)
-                print(right)
-                print(front)
-            chain = np.append(chain[i:], chain[:i])
-            for gate in zip(chain[1:], chain[:-1]):
-                fifo.append(gate)
-                faces_status[(gate[-1], gate[0])] = 'conquered'
-
-        elif (vertices_status.get(front) is None and valences[front] > 6) or (
-                vertices_status.get(front) == 'conquered'):
-            print('o', end='')
+        elif valences[front] <= 6 and vertices_status[front] == FREE and not mesh.boundary[front]:
+            counters['crossed'] += 1
+            ring = mesh.one_ring(opposite[next[gate]])
+            for spoke in ring[:-1]:
+                edge = next[spoke]
+                if opposite[edge] >= 0:
+                    fifo.push(opposite[edge])
+                faces_status[edge] = CONQUERED
+
+        else:
+            counters['null'] += 1
 
             # Set the front face to null
-            faces_status[gate] = 'null'
+            faces_status[gate] = NULL
 
             # Add the other edges to the fifo
-            fifo.append((front, right))
-            fifo.append((left, front))
-    return obja, count_v
-
-def write_last_obja(active_vertices, gates, vertices, count_v, obj_to_obja):
-    obj_f = ""
-    new_indices = {}
-    local_copy = gates.copy()
-    for k, vertex in enumerate(active_vertices):
-        x, y, z = vertices[vertex-1]
-        obj_f += f"v {x} {y} {z}\n"
-        obj_to_obja[count_v] = vertex
-        count_v += 1
-        new_indices[vertex] = k + 1
-
-    for gate in gates.copy():
-        left, right = gate
-        try:
-            front = local_copy[gate]
-            local_copy.pop(gate)
-            if local_copy[(right, front)] == left:
-                local_copy.pop((right, front))
-            else:
-                print('\t\t WTF \t\t')
-                print('face: {}-{}-{}, th: {}, found: {}'.format(
-                    right, front, left, left, local_copy[(right, front)]))
-            if local_copy[(front, left)] == right:
-                local_copy.pop((front, left))
-            else:
-                print('\t\t WTF \t\t')
-                print('f: {}-{}-{}, th: {}, found: {}'.format(
-                    front, left, right, right, local_copy[(front, left)]))
-            obj_f += f"f {left} {right} {front}\n"
-        except KeyError:
+            for edge in (opposite[next[gate]], opposite[next[next[gate]]]):
+                if edge >= 0:
+                    fifo.push(edge)
+
+    mesh.retriangulate(rings, PATCHES['v3'])
+    if instrumentation is not None:
+        instrumentation.add_counters('cleaning', counters)
+    return obja
+
+def write_last_obja(active_vertices, mesh, vertices, obja):
+    half_edges = mesh.face_half_edges()
+    faces = mesh.origin[half_edges]
+    records = np.zeros(len(active_vertices) + len(faces), dtype=RECORD)
+    records['kind'][:len(active_vertices)] = VERTEX
+    records['a'][:len(active_vertices)] = np.sort(np.fromiter(active_vertices, dtype=np.int64,
+                                                               count=len(active_vertices)))
+    records['kind'][len(active_vertices):] = FACE
+    records['a'][len(active_vertices):] = faces[:, 0]
+    records['b'][len(active_vertices):] = faces[:, 1]
+    records['c'][len(active_vertices):] = faces[:, 2]
+    records['face'][len(active_vertices):] = mesh.face_keys(half_edges[:, 0])
+    obja.add_records(records)
+
+    # Twins of the half-edges of the edges shared by more than two faces,
+    # that the binary decoder cannot match from the faces alone
+    first = faces.reshape(-1)
+    second = faces[:, [1, 2, 0]].reshape(-1)
+    edges = np.stack([np.minimum(first, second), np.maximum(first, second)], axis=1)
+    _, inverse, counts = np.unique(edges, axis=0, return_inverse=True, return_counts=True)
+    corners = np.flatnonzero(counts[inverse.reshape(-1)] > 2)
+    obja.base_twins = np.stack([corners, mesh.corner_opposites()[corners]], axis=1)
+    return obja
+
+def sew_conquest(mesh, active_vertices, vertices, obja, instrumentation=None, candidates=None):
+    # Sew the valence-2 vertices (all of them or the candidates) in
+    # increasing order, with the vertices whose valence falls to 2 when
+    # their neighbor is sewed (if they come after it): the same vertices as
+    # going through all the active vertices in increasing order
+    on_removed = event_callback(instrumentation, 'vertex_removed')
+    counters = {'sewed': 0, 'rejected': 0}
+    valences = mesh.valences
+    if candidates is None:
+        candidates = mesh.vertices_of_valence(2).tolist()
+    heap = list(candidates)
+    heapq.heapify(heap)
+    release_gates = mesh.release_gates
+    nb_popped = 0
+    previous = None
+    while len(heap) > 0:
+        vertex = heapq.heappop(heap)
+        nb_popped += 1
+        if release_gates and nb_popped % release_gates == 0:
+            mesh.release_pages()
+        if vertex == previous:
             continue
-    return obj_f
-
-def sew_conquest(gates, patches, active_vertices, valences, vertices, faces , obja, count_v, obj_to_obja):
-    for vertex in active_vertices.copy():
-        if valences[vertex] == 2:
-            try:
-                active_vertices.remove(vertex)
-                chain = patches[vertex]
-                gates.pop((chain[0], vertex))
-                gates.pop((chain[1], vertex))
-                gates.pop((vertex, chain[0]))
-                gates.pop((vertex, chain[1]))
-                
-                # Update obja
-                x, y, z = vertices[vertex-1]
-                obja += f"v {x} {y} {z}\n"
-                obj_to_obja[count_v] = vertex
-                obja += f"f {vertex} {chain[0]} {chain[1]}\n"
-                count_v += 1
-                
-                patch = patches[chain[0]]
-                patches[chain[0]] = patch[patch != vertex]
-                patch = patches[chain[0]]
-                k = np.where(patch == chain[1])[0][0]
-                patches[chain[0]] = patch[np.r_[0:k, k+1:len(patch)]]
-                valences[chain[0]] -= 2
-
-                patch = patches[chain[1]]
-                patches[chain[1]] = patch[patch != vertex]
-                patch = patches[chain[1]]
-                k = np.where(patch == chain[0])[0][0]
-                patches[chain[1]] = patch[np.r_[0:k, k+1:len(patch)]]
-                valences[chain[1]] -= 2
-
-                patch = patches[chain[0]]
-                k = np.where(patch == chain[1])[0]
-                if len(k) > 1:
-                    print(patch)
-                    k = k[0]
-                gates[(chain[1], chain[0])] = int(patch[k-1])
-                obja += f"df {chain[0]}  {chain[1]}  {int(patch[k-1])}\n"
-
-
-                patch = patches[chain[1]]
-                k = np.where(patch == chain[0])[0]
-                if len(k) > 1:
-                    print(patch)
-                    k = k[0]
-                gates[(chain[0], chain[1])] = int(patch[k-1])
-                obja += f"df {chain[0]}  {chain[1]}  {int(patch[k-1])}\n"
-
-            except KeyError:
+        previous = vertex
+        if valences[vertex] == 2 and not mesh.boundary[vertex]:
+            keys = mesh.face_keys(mesh.one_ring(mesh.half_edge[vertex])).tolist()
+            sewed = mesh.sew(vertex)
+            if sewed is None:
+                counters['rejected'] += 1
                 continue
+            chain, outer_0, outer_1 = sewed
+            active_vertices.remove(vertex)
+            counters['sewed'] += 1
+            for other in chain.tolist():
+                if other > vertex and valences[other] == 2:
+                    heapq.heappush(heap, other)
+            if on_removed is not None:
+                on_removed('sewing', vertex, 2)
 
-    to_duplicate = {}
-    for front, chain in patches.items():
-        if len(set(chain)) != len(chain):
-            copy = chain.copy()
-            copy.sort()
-            to_duplicate[front] = copy[np.where(np.diff(copy) == 0)[0]][0]
-    while len(to_duplicate) > 0:
-        left, right = to_duplicate.popitem()
-        to_duplicate.pop(right)
-
-        vertices.append(vertices[left-1])
-        new_left = len(vertices)
-        vertices.append(vertices[right-1])
-        new_right = new_left + 1
-
-        # TODO: do something to treat the shared edges
-    return obja, count_v
-
-def write_obj(path, active_vertices, gates, vertices):
-    new_indices = {}
-    local_copy = gates.copy()
-    with open(path, 'w') as file:
-        for k, vertex in enumerate(active_vertices):
-            x, y, z = vertices[vertex-1]
-            file.write('v {} {} {}\n'.format(x, y, z))
-            new_indices[vertex] = k + 1
-        for gate in gates.copy():
-            left, right = gate
-            try:
-                front = local_copy[gate]
-                local_copy.pop(gate)
-                if local_copy[(right, front)] == left:
-                    local_copy.pop((right, front))
-                else:
-                    print('\t\t WTF \t\t')
-                    print('face: {}-{}-{}, th: {}, found: {}'.format(
-                        right, front, left, left, local_copy[(right, front)]))
-                if local_copy[(front, left)] == right:
-                    local_copy.pop((front, left))
-                else:
-                    print('\t\t WTF \t\t')
-                    print('f: {}-{}-{}, th: {}, found: {}'.format(
-                        front, left, right, right, local_copy[(front, left)]))
-                file.write('f {} {} {}\n'.format(
-                    new_indices[left], new_indices[right], new_indices[front]))
-            except KeyError:
-                continue
+            # Update obja
+            obja.add_vertex(vertex)
+            obja.add_face(vertex, chain[0], chain[1], keys[0])
+            obja.add_face(vertex, chain[1], chain[0], keys[1])
+            obja.add_code(mesh.front(outer_1))
+
+    if instrumentation is not None:
+        instrumentation.add_counters('sewing', counters)
+    return obja
+
+def fused_conquest(mesh, active_vertices, vertices, obja, instrumentation=None, pool=None):
+    # Decimating conquest, then removal of the valence-3 and valence-2
+    # vertices it leaves, found in the valences instead of traversing the
+    # mesh twice more. The cleaning and sewing layers give their faces
+    # explicitly, so the stream is as lossless as with the cleaning and sew
+    # conquests (but not the same). Nothing to do without faces
+    if mesh.nb_faces() == 0:
+        return obja
+    obja.new_layer(DECIMATING)
+    decimating_conquest(mesh, active_vertices, vertices, obja, instrumentation, pool)
+
+    # Valence-3 vertices, none of them next to another one
+    obja.new_layer(CLEANING)
+    on_removed = event_callback(instrumentation, 'vertex_removed')
+    counters = {'removed.v3': 0}
+    mesh.reset_status()
+    next = mesh.next
+    release_gates = mesh.release_gates
+    rings = []
+    for k, vertex in enumerate(mesh.vertices_of_valence(3).tolist(), 1):
+        if release_gates and k % release_gates == 0:
+            mesh.release_pages()
+        ring = removable_ring(mesh, next[mesh.half_edge[vertex]], 3)
+        if ring is None:
+            continue
+        chain = mesh.chain(ring)
+        mesh.vertices_status[chain] = CONQUERED
+        active_vertices.remove(vertex)
+        counters['removed.v3'] += 1
+        if on_removed is not None:
+            on_removed('cleaning', vertex, 3)
+
+        # Update obja
+        keys = mesh.face_keys(ring).tolist()
+        obja.add_vertex(vertex)
+        obja.add_face(vertex, chain[0], chain[1], keys[0])
+        obja.add_face(vertex, chain[1], chain[2], keys[1])
+        obja.add_face(vertex, chain[2], chain[0], keys[2])
+        obja.delete_face(chain[0], chain[1], chain[2], int(mesh.face_keys(ring[0], created=True)))
+        rings.append(ring)
+    mesh.retriangulate(rings, PATCHES['v3'])
+    if instrumentation is not None:
+        instrumentation.add_counters('cleaning', counters)
+
+    obja.new_layer(SEWING)
+    candidates = mesh.vertices_of_valence(2).tolist()
+    sew_conquest(mesh, active_vertices, vertices, obja, instrumentation, candidates)
+    return obja
+
+def lod_arrays(active_vertices, mesh, vertices):
+    # Coordinates of the active vertices (in increasing order) and the faces
+    # of the mesh numbered from 1 in that order
+    active = np.sort(np.fromiter(active_vertices, dtype=np.int64, count=len(active_vertices)))
+    number = np.zeros(len(mesh.half_edge), dtype=np.int64)
+    number[active] = np.arange(1, len(active) + 1)
+    return vertices[active - 1], number[mesh.faces()]
+
+def write_obj(path, active_vertices, mesh, vertices):
+    save_obj(path, *lod_arrays(active_vertices, mesh, vertices))
+
+def write_ply(path, active_vertices, mesh, vertices):
+    save_ply(path, *lod_arrays(active_vertices, mesh, vertices))
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Check that an obja or binary file decodes to the mesh of its obj file.
+
+python verifier.py OBJ/bunny.obj OBJ/bunny.obja
+python verifier.py OBJ/bunny.obj OBJ/bunny.objb -b 12    quantized coordinates
+"""
+import argparse
+import hashlib
+import sys
+import time
+
+import numpy as np
+
+from decoder import decode
+from geometry import MAX_BITS, bounding_box, quantize, dequantize
+from obj_io import load_obj
+
+
+def verify(obj_path, path, bits=None):
+    # Decode the file and compare its final mesh with the obj file, return
+    # the report of compare_meshes
+    return verify_mesh(obj_path, decode(path), bits)
+
+
+def verify_mesh(obj_path, mesh, bits=None):
+    # Compare a decoded mesh with the obj file (with the coordinates of the
+    # obj quantized as by the encoder when bits is given)
+    vertices, faces = load_obj(obj_path)
+    if bits is not None:
+        low, high = bounding_box(vertices)
+        vertices = dequantize(quantize(vertices, low, high, bits), low, high, bits)
+    return compare_meshes(vertices, faces, mesh.vertices, mesh.triangles())
+
+
+def canonical_faces(faces):
+    # Faces rotated to their smallest rotation (the orientation is kept), one
+    # row of 3 vertices each. The first two vertices choose: a face with a
+    # repeated vertex (merged by the quantization) has a single smallest one
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    best = faces
+    for shift in (1, 2):
+        rotated = np.roll(faces, -shift, axis=1)
+        smaller = (rotated[:, 0] < best[:, 0]) | \
+            ((rotated[:, 0] == best[:, 0]) & (rotated[:, 1] < best[:, 1]))
+        best = np.where(smaller[:, None], rotated, best)
+    return best
+
+
+def canonical_mesh(vertices, faces):
+    # Mesh independent of the numbering of its vertices and faces: distinct
+    # coordinates in lexicographic order (the vertices with the same
+    # coordinates are merged, as the split non-manifold vertices), faces of
+    # coordinate ranks in lexicographic order. -0.0 is taken as 0.0
+    coordinates, rank = np.unique(np.asarray(vertices, dtype=np.float64) + 0.0, axis=0,
+                                  return_inverse=True)
+    rows = canonical_faces(rank.reshape(-1)[np.asarray(faces) - 1])
+    return coordinates, rows[np.lexsort(rows.T[::-1])]
+
+
+def mesh_digest(vertices, faces):
+    coordinates, rows = canonical_mesh(vertices, faces)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.array(coordinates.shape, dtype='<i8').tobytes())
+    digest.update(np.ascontiguousarray(coordinates, dtype='<f8').tobytes())
+    digest.update(np.ascontiguousarray(rows, dtype='<i8').tobytes())
+    return digest.hexdigest()
+
+
+def compare_meshes(expected_vertices, expected_faces, vertices, faces):
+    # Digests of the two meshes and, when they differ, the coordinates and
+    # the faces (with their multiplicity) found in only one of them
+    expected_digest = mesh_digest(expected_vertices, expected_faces)
+    digest = mesh_digest(vertices, faces)
+    report = {'same': digest == expected_digest, 'digest': digest,
+              'expected_digest': expected_digest, 'faces': len(faces),
+              'expected_faces': len(expected_faces)}
+    if report['same']:
+        return report
+
+    # Ranks of the coordinates of both meshes together
+    nb_expected = len(expected_vertices)
+    coordinates = np.concatenate([np.asarray(expected_vertices, dtype=np.float64).reshape(-1, 3),
+                                  np.asarray(vertices, dtype=np.float64).reshape(-1, 3)]) + 0.0
+    _, rank = np.unique(coordinates, axis=0, return_inverse=True)
+    rank = rank.reshape(-1)
+    expected_rank, rank = rank[:nb_expected], rank[nb_expected:]
+    report['missing_vertices'] = len(np.setdiff1d(expected_rank, rank))
+    report['extra_vertices'] = len(np.setdiff1d(rank, expected_rank))
+
+    # Faces counted on both sides
+    rows = canonical_faces(np.concatenate([expected_rank[np.asarray(expected_faces) - 1],
+                                           rank[np.asarray(faces) - 1]]).reshape(-1, 3))
+    keys = np.ascontiguousarray(rows).view(np.dtype((np.void, rows.dtype.itemsize * 3)))
+    _, face = np.unique(keys.reshape(-1), return_inverse=True)
+    face = face.reshape(-1)
+    nb_expected_faces = len(expected_faces)
+    expected_counts = np.bincount(face[:nb_expected_faces], minlength=face.max(initial=-1) + 1)
+    counts = np.bincount(face[nb_expected_faces:], minlength=len(expected_counts))
+    report['missing_faces'] = int(np.maximum(expected_counts - counts, 0).sum())
+    report['extra_faces'] = int(np.maximum(counts - expected_counts, 0).sum())
+    return report
+
+
+def verification_summary(report):
+    if report['same']:
+        return 'lossless: {} faces, digest {}'.format(report['faces'], report['digest'])
+    return ('DIFFERENT: {} faces for {} expected, {} missing and {} extra faces, '
+            '{} missing and {} extra vertices'.format(
+                report['faces'], report['expected_faces'], report['missing_faces'],
+                report['extra_faces'], report['missing_vertices'], report['extra_vertices']))
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Check an encoded mesh against its obj file')
+    parser.add_argument('obj', help='obj file of the mesh')
+    parser.add_argument('encoded', help='obja or binary file of the mesh')
+    parser.add_argument('-b', '--bits', type=int, default=None,
+                        choices=range(1, MAX_BITS + 1), metavar='BITS',
+                        help='bits per axis of the binary coordinates, 1 to {} '
+                             '(default: float64)'.format(MAX_BITS))
+    args = parser.parse_args(arguments)
+    start = time.perf_counter()
+    report = verify(args.obj, args.encoded, args.bits)
+    print(verification_summary(report))
+    print('checked in {:.2f} s'.format(time.perf_counter() - start))
+    return 0 if report['same'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())